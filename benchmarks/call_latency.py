@@ -0,0 +1,49 @@
+import argparse
+import json
+import statistics
+import time
+
+import exebench
+from exebench import exebench_dict_to_dict
+from compile_latency import load_sample_rows, compile_row
+
+
+def time_calls(wrapper, inputs, repeats):
+    timings = []
+    for _ in range(repeats):
+        for inp in inputs:
+            start = time.perf_counter()
+            wrapper(inp)
+            timings.append(time.perf_counter() - start)
+    return {'mean_ms': 1000 * statistics.mean(timings), 'median_ms': 1000 * statistics.median(timings),
+            'n': len(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-call Wrapper latency for each IO transport')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    results = {}
+    memfd_available = exebench._USE_MEMFD
+    for row in load_sample_rows():
+        wrapper = compile_row(row, exebench._DefaultAssembler())
+        inputs = [exebench_dict_to_dict(inp) for inp in row['synth_io_pairs']['input']]
+        row_results = {}
+        try:
+            exebench._USE_MEMFD = False
+            row_results['temp_files'] = time_calls(wrapper, inputs, args.repeats)
+            if memfd_available:
+                exebench._USE_MEMFD = True
+                row_results['memfd'] = time_calls(wrapper, inputs, args.repeats)
+            with wrapper.start_server():
+                row_results['server'] = time_calls(wrapper, inputs, args.repeats)
+        finally:
+            exebench._USE_MEMFD = memfd_available
+            wrapper.close()
+        results[row['fname']] = row_results
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import json
+import os
+import statistics
+import time
+
+from exebench import Wrapper, _DefaultAssembler, _get_json_runtime
+
+_SAMPLE_ROWS = os.path.join(os.path.dirname(__file__), 'data', 'sample_rows.jsonl')
+
+
+def load_sample_rows(path=_SAMPLE_ROWS):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def compile_row(row, assembler):
+    return Wrapper(c_deps=row['synth_deps'] + '\n' + row['synth_io_pairs']['dummy_funcs'][0] + '\n',
+                   func_c_signature=row['func_head_types'].replace('extern', ''), func_assembly=row['asm']['code'][0],
+                   cpp_wrapper=row['synth_exe_wrapper'], assembler_backend=assembler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wrapper compile latency with and without the prebuilt JSON runtime')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.pop('EXEBENCH_CACHE_DIR', None)  # measure actual compilations
+    rows = load_sample_rows()
+    _get_json_runtime(_DefaultAssembler.compiler, _DefaultAssembler.flags)  # build it outside the timed region
+    results = {}
+    for name, assembler in [('baseline', _DefaultAssembler(use_json_runtime=False)),
+                            ('json_runtime', _DefaultAssembler(use_json_runtime=True))]:
+        timings = []
+        for _ in range(args.repeats):
+            for row in rows:
+                start = time.perf_counter()
+                wrapper = compile_row(row, assembler)
+                timings.append(time.perf_counter() - start)
+                wrapper.close()
+        results[name] = {'mean_ms': 1000 * statistics.mean(timings), 'median_ms': 1000 * statistics.median(timings),
+                         'n': len(timings)}
+    results['speedup'] = results['baseline']['median_ms'] / results['json_runtime']['median_ms']
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+import random
+import time
+from ast import literal_eval
+
+from exebench import exebench_io_pairs_to_dicts
+from compile_latency import load_sample_rows
+
+
+def literal_eval_io_pairs(io_pairs):
+    # The decoding used before exebench_io_pairs_to_dicts, for comparison
+    def fix_nested_dict(inp):
+        if isinstance(inp, dict):
+            for k in inp:
+                inp[k] = fix_nested_dict(inp[k])
+        elif isinstance(inp, list):
+            for idx, e in enumerate(inp):
+                inp[idx] = fix_nested_dict(e)
+        else:
+            return literal_eval(inp)
+        return inp
+
+    def to_dict(exebench_dict):
+        return fix_nested_dict({k: v for k, v in zip(exebench_dict['var'], exebench_dict['value'])})
+    return [(to_dict(inp), to_dict(out)) for inp, out in zip(io_pairs['input'], io_pairs['output'])]
+
+
+def synthetic_io_pairs(n_pairs, array_size, seed=0):
+    # Shaped like synth_io_pairs of a function taking an int array, a float array, a char and a size
+    rng = random.Random(seed)
+
+    def io_dict(names):
+        return {'var': names, 'value': [str([rng.randint(-2 ** 31, 2 ** 31 - 1) for _ in range(array_size)]),
+                                        str([round(rng.uniform(-1e3, 1e3), 3) for _ in range(array_size)]),
+                                        repr(rng.choice('abcxyz')), str(array_size)]}
+    return {'input': [io_dict(['ints', 'floats', 'c', 'n']) for _ in range(n_pairs)],
+            'output': [io_dict(['ints', 'floats', 'c', 'returnv']) for _ in range(n_pairs)]}
+
+
+def time_decoding(decode, io_pairs, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        decode(io_pairs)
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decoding of io_pairs: literal_eval vs exebench_io_pairs_to_dicts')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--array-sizes', type=int, nargs='+', default=[1, 100, 1000, 10000])
+    parser.add_argument('--pairs', type=int, default=10)
+    args = parser.parse_args()
+
+    workloads = {f'sample_{row["fname"]}': row['synth_io_pairs'] for row in load_sample_rows()}
+    workloads.update({f'synthetic_{size}': synthetic_io_pairs(args.pairs, size) for size in args.array_sizes})
+    results = {}
+    for name, io_pairs in workloads.items():
+        assert literal_eval_io_pairs(io_pairs) == exebench_io_pairs_to_dicts(io_pairs)
+        literal_eval_ms = time_decoding(literal_eval_io_pairs, io_pairs, args.repeats)
+        decode_ms = time_decoding(exebench_io_pairs_to_dicts, io_pairs, args.repeats)
+        results[name] = {'literal_eval_ms': literal_eval_ms, 'exebench_io_pairs_to_dicts_ms': decode_ms,
+                         'speedup': literal_eval_ms / decode_ms}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import exebench
+from exebench import Wrapper, _DefaultAssembler, diff_io, exebench_dict_to_dict
+from compile_latency import load_sample_rows
+from decode_values import synthetic_io_pairs
+
+# Benchmarks each stage of the evaluation pipeline separately, on the bundled sample rows (no network):
+#  - compile: _DefaultAssembler, i.e. building a Wrapper executable (without the compile cache)
+#  - call: Wrapper.__call__ on the sample inputs, with array inputs resized to each size
+#  - decode: exebench_dict_to_dict on synthetic IO pairs with arrays of each size
+#  - diff: diff_io on outputs with arrays of each size
+# Each (stage, row, size, concurrency) gets a record with its timings, in a JSON file that also describes the
+# machine and commit. `--compare old.json new.json` prints the ratio of the medians of two such files.
+
+STAGES = ('compile', 'call', 'decode', 'diff')
+
+
+def _summary(timings, concurrency, wall_time):
+    timings_ms = [1000 * t for t in timings]
+    return {'n': len(timings_ms), 'median_ms': statistics.median(timings_ms), 'mean_ms': statistics.mean(timings_ms),
+            'min_ms': min(timings_ms), 'stdev_ms': statistics.stdev(timings_ms) if len(timings_ms) > 1 else 0.0,
+            'throughput_per_s': len(timings_ms) / wall_time if wall_time > 0 else None, 'concurrency': concurrency}
+
+
+def _measure(fn, args_list, concurrency):
+    # Runs fn on every element of args_list with `concurrency` threads. Returns per-call timings and the wall time.
+    def timed(args):
+        start = time.perf_counter()
+        fn(*args)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        timings = [timed(args) for args in args_list]
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            timings = list(pool.map(timed, args_list))
+    return timings, time.perf_counter() - start
+
+
+def _wrapper_kwargs(row):
+    return dict(c_deps=row['synth_deps'] + '\n' + row['synth_io_pairs']['dummy_funcs'][0] + '\n',
+                func_c_signature=row['func_head_types'].replace('extern', ''), func_assembly=row['asm']['code'][0],
+                cpp_wrapper=row['synth_exe_wrapper'])
+
+
+def _resize_input(inp, size):
+    # Array arguments are repeated (or truncated) to `size` elements and the length argument `n` is updated, which is
+    # how the array functions of the sample take their arguments
+    if not any(isinstance(value, list) for value in inp.values()):
+        return None
+    resized = {k: (v * (size // len(v) + 1))[:size] if isinstance(v, list) and v else v for k, v in inp.items()}
+    if 'n' in resized:
+        resized['n'] = size
+    return resized
+
+
+def bench_compile(rows, sizes, concurrency_levels, repeats):
+    assembler = _DefaultAssembler(cache=None)
+    Wrapper(**_wrapper_kwargs(rows[0]), assembler_backend=assembler)  # builds the JSON runtime and driver once
+    for concurrency in concurrency_levels:
+        args_list = [(row,) for _ in range(repeats) for row in rows] * concurrency
+        wrappers = []
+
+        def compile_row(row):
+            wrappers.append(Wrapper(**_wrapper_kwargs(row), assembler_backend=assembler))
+        try:
+            timings, wall_time = _measure(compile_row, args_list, concurrency)
+        finally:
+            for wrapper in wrappers:
+                wrapper.close()
+        yield dict(stage='compile', row='all', size=None, **_summary(timings, concurrency, wall_time))
+
+
+def bench_call(rows, sizes, concurrency_levels, repeats):
+    for row in rows:
+        wrapper = Wrapper(**_wrapper_kwargs(row), assembler_backend=_DefaultAssembler(cache=None))
+        try:
+            inputs = [exebench_dict_to_dict(inp) for inp in row['synth_io_pairs']['input']]
+            row_sizes = sizes if _resize_input(inputs[0], 1) is not None else [None]
+            for size in row_sizes:
+                sized_inputs = inputs if size is None else [_resize_input(inp, size) for inp in inputs]
+                for concurrency in concurrency_levels:
+                    args_list = [(inp,) for _ in range(repeats) for inp in sized_inputs]
+                    timings, wall_time = _measure(wrapper, args_list, concurrency)
+                    yield dict(stage='call', row=row['fname'], size=size, **_summary(timings, concurrency, wall_time))
+        finally:
+            wrapper.close()
+
+
+def bench_decode(rows, sizes, concurrency_levels, repeats):
+    workloads = [(row['fname'], None, row['synth_io_pairs']) for row in rows]
+    workloads += [('synthetic', size, synthetic_io_pairs(10, size)) for size in sizes]
+    for name, size, io_pairs in workloads:
+        args_list = [(io_dict,) for _ in range(repeats) for io_dict in io_pairs['input'] + io_pairs['output']]
+        timings, wall_time = _measure(exebench_dict_to_dict, args_list, 1)  # pure Python: threads don't help
+        yield dict(stage='decode', row=name, size=size, **_summary(timings, 1, wall_time))
+
+
+def bench_diff(rows, sizes, concurrency_levels, repeats):
+    for size in sizes:
+        io_pairs = synthetic_io_pairs(10, size)
+        outputs = [exebench_dict_to_dict(out) for out in io_pairs['output']]
+        observed = [json.loads(json.dumps(out)) for out in outputs]  # equal values, distinct objects
+        args_list = [(o, e) for _ in range(repeats) for o, e in zip(observed, outputs)]
+        timings, wall_time = _measure(diff_io, args_list, 1)
+        yield dict(stage='diff', row='synthetic', size=size, **_summary(timings, 1, wall_time))
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        compiler = subprocess.run([_DefaultAssembler.compiler, '--version'], capture_output=True,
+                                  text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        compiler = None
+    return {'commit': commit, 'exebench_version': exebench.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'compiler': compiler,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def _key(record):
+    return record['stage'], record['row'], record['size'], record['concurrency']
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = {_key(record): record for record in json.load(f)['results']}
+    with open(new_path) as f:
+        new = {_key(record): record for record in json.load(f)['results']}
+    print(f'{"stage":8} {"row":12} {"size":>7} {"conc":>4} {"old ms":>10} {"new ms":>10} {"new/old":>8}')
+    for key in sorted(old.keys() & new.keys(), key=str):
+        stage, row, size, concurrency = key
+        old_ms, new_ms = old[key]['median_ms'], new[key]['median_ms']
+        print(f'{stage:8} {row:12} {str(size):>7} {concurrency:>4} {old_ms:10.3f} {new_ms:10.3f} '
+              f'{new_ms / old_ms:8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage benchmarks of the ExeBench evaluation pipeline')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000], help='Array sizes')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    os.environ.pop('EXEBENCH_CACHE_DIR', None)  # measure actual compilations
+    rows = load_sample_rows()
+    benches = {'compile': bench_compile, 'call': bench_call, 'decode': bench_decode, 'diff': bench_diff}
+    results = []
+    for stage in args.stages:
+        for record in benches[stage](rows, args.sizes, sorted(set(args.concurrency)), args.repeats):
+            print(f'{record["stage"]} {record["row"]} size={record["size"]} concurrency={record["concurrency"]}: '
+                  f'median {record["median_ms"]:.3f} ms', file=sys.stderr)
+            results.append(record)
+    report = json.dumps({'environment': _environment(), 'args': vars(args), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
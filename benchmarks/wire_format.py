@@ -0,0 +1,74 @@
+import argparse
+import importlib.util
+import json
+import statistics
+import time
+
+from exebench import Wrapper, exebench_dict_to_dict
+from compile_latency import load_sample_rows
+from suite import _resize_input, _wrapper_kwargs
+
+# Wrapper calls with each wire format (JSON, CBOR, MessagePack) on the array rows of the sample (sum_arr: ints,
+# poly_eval: doubles), with their array inputs resized to each size, in each execution mode:
+#  - file: a harness process per call
+#  - server: resident harness (Wrapper.start_server)
+#  - batch: all the inputs of a row in one Wrapper.run_many call (time per input)
+# Binary formats whose Python package (cbor2, msgpack) isn't installed are skipped.
+
+FORMATS = {'json': None, 'cbor': 'cbor2', 'msgpack': 'msgpack'}
+
+
+def time_mode(wrapper, mode, inputs, repeats):
+    timings = []
+    for _ in range(repeats):
+        if mode == 'batch':
+            start = time.perf_counter()
+            wrapper.run_many(inputs)
+            timings.append((time.perf_counter() - start) / len(inputs))
+            continue
+        for inp in inputs:
+            start = time.perf_counter()
+            wrapper(inp)
+            timings.append(time.perf_counter() - start)
+    return 1000 * statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wrapper call latency per wire format, on large arrays')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000], help='Array sizes')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    formats = [fmt for fmt, package in FORMATS.items() if package is None or importlib.util.find_spec(package)]
+    results = {}
+    for row in load_sample_rows():
+        inputs = [exebench_dict_to_dict(inp) for inp in row['synth_io_pairs']['input']]
+        if _resize_input(inputs[0], 1) is None:
+            continue  # no arrays
+        wrappers = {fmt: Wrapper(**_wrapper_kwargs(row), wire_format=fmt) for fmt in formats}
+        try:
+            for size in args.sizes:
+                sized_inputs = [_resize_input(inp, size) for inp in inputs[:3]]
+                expected = [wrappers['json'](inp) for inp in sized_inputs]
+                for fmt, wrapper in wrappers.items():
+                    assert [wrapper(inp) for inp in sized_inputs] == expected, fmt
+                for mode in ['file', 'server', 'batch']:
+                    timings = {}
+                    for fmt, wrapper in wrappers.items():
+                        if mode == 'server':
+                            with wrapper.start_server():
+                                timings[fmt] = time_mode(wrapper, mode, sized_inputs, args.repeats)
+                        else:
+                            timings[fmt] = time_mode(wrapper, mode, sized_inputs, args.repeats)
+                    result = {f'{fmt}_ms': ms for fmt, ms in timings.items()}
+                    result.update({f'{fmt}_speedup': timings['json'] / ms for fmt, ms in timings.items()
+                                   if fmt != 'json'})
+                    results[f'{row["fname"]}_{size}_{mode}'] = result
+        finally:
+            for wrapper in wrappers.values():
+                wrapper.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,37 @@
 import math
+import statistics
 import json
+import collections
 from pathlib import Path
 import subprocess
-from typing import Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple, List
 import tempfile
 import contextlib
 import os
 import shutil
-import glob
+import atexit
+import multiprocessing.util
 import re
+import hashlib
+import fcntl
+import resource
+import functools
+import mmap
+import select
+import signal
+import struct
+import threading
+import time
+import asyncio
+import weakref
 from ast import literal_eval
+from dataclasses import dataclass
 
-__all__ = ['diff_io', 'Wrapper', 'exebench_dict_to_dict']
+__all__ = ['diff_io', 'diff_io_batch', 'diff_io_report', 'Mismatch', 'Wrapper', 'exebench_dict_to_dict',
+           'exebench_io_pairs_to_dicts', 'CompileCache', 'ExecutionError', 'ExecutionTimeout', 'AsyncWrapper',
+           'AsyncLimits', 'Harness', 'CandidateResult', 'ResourceLimits', 'ResourceLimitExceeded', 'TimeoutPolicy',
+           'TimeoutCalibrator', 'Instrumentation', 'enable_instrumentation', 'disable_instrumentation',
+           'Workspace', 'WorkspaceFull', 'configure_workspace', 'get_workspace', 'Measurement', 'TimingStats']
 
 __version__ = 0.1
 
@@ -20,44 +40,627 @@ __version__ = 0.1
 _DEFAULT_CMD_TIMEOUT = 5
 _ROOT_PATH_FOR_JSON_HPP = os.path.dirname(__file__)
 _SYNTH_LIBS_PATH = os.path.dirname(__file__)
+_CLIB_PATH = os.path.join(os.path.dirname(__file__), 'clib')
+_SERVER_GRACE = 2  # seconds past a call's timeout before the resident harness is considered stuck and killed
+_DEFAULT_CACHE_MAX_SIZE = 2 * 1024 ** 3  # bytes
+_CACHE_RESCAN_INTERVAL = 256  # stores between full scans of the compile cache, which other processes also write to
+_CACHE_EVICT_TO = 0.9  # fraction of max_size the compile cache is evicted down to, so that it isn't rescanned per store
+_DRIVER_MARKER = b'EXEBENCH_DRIVER_5'  # see clib/exebench_driver.cpp
+_WIRE_MARKER = b'EXEBENCH_WIRE_1'  # see _DefaultAssembler._wire_io
+_WIRE_DECLARATIONS = ('nlohmann::json exebench_read_input(std::istream &in);\n'
+                      'void exebench_write_output(std::ostream &out, const nlohmann::json &output);\n'
+                      'extern "C" const char exebench_wire_version[] = "EXEBENCH_WIRE_1";\n')
+_MEASURE_MARKER = b'EXEBENCH_MEASURE_1'  # see _DefaultAssembler._measure_hook
+_MEASURE_DECLARATIONS = ('void exebench_measure(void (*call)(void *), void *context);\n'
+                         'extern "C" const char exebench_measure_version[] = "EXEBENCH_MEASURE_1";\n')
+_USE_MEMFD = hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd')
 
 
-def _run_command(command: str, stdin: Optional[str] = None, timeout: Optional[int] = _DEFAULT_CMD_TIMEOUT) -> Tuple[str, str]:
-    output = subprocess.run(command.split(), capture_output=True, text=True, input=stdin, timeout=timeout)
+class Instrumentation:
+    # Aggregated timings and counters of the compile and run stages, see enable_instrumentation. Stages:
+    #  - compile: _DefaultAssembler, including the cache lookup (counters: cache_hits, failures)
+    #  - compiler, exec: the compiler and harness processes (counters: timeouts, nonzero_exits)
+    #  - call: Wrapper.__call__ / AsyncWrapper.__call__, including JSON IO (counters: bytes_in, bytes_out, errors)
+    #  - run_many: Wrapper.run_many (counters: inputs, errors, timeouts)
+    #  - measure: the harness processes of Wrapper.measure (counters: timeouts, nonzero_exits)
+    # Hooks are called as hook(stage, seconds, fields) after every event, e.g. for tracing.
+    def __init__(self, max_recent_errors: int = 20):
+        self.hooks: List[Callable[[str, Optional[float], Dict], None]] = []
+        self.recent_errors = collections.deque(maxlen=max_recent_errors)  # (stage, stderr) of the latest failures
+        self._lock = threading.Lock()
+        self._timers = {}  # stage -> [count, total seconds, max seconds]
+        self._counters = {}  # stage_field -> sum
+
+    def record(self, stage: str, seconds: Optional[float] = None, **fields):
+        # Numeric fields are summed into counters, the others (e.g. stderr) are only passed to the hooks
+        with self._lock:
+            if seconds is not None:
+                timer = self._timers.setdefault(stage, [0, 0.0, 0.0])
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+            for field, value in fields.items():
+                if isinstance(value, (int, float)):
+                    name = f'{stage}_{field}'
+                    self._counters[name] = self._counters.get(name, 0) + value
+            if fields.get('failures') and fields.get('stderr'):
+                self.recent_errors.append((stage, fields['stderr']))
+        for hook in self.hooks:
+            hook(stage, seconds, fields)
+
+    def reset(self):
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+            self.recent_errors.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            timers = {stage: {'count': count, 'total_ms': 1000 * total, 'mean_ms': 1000 * total / count,
+                              'max_ms': 1000 * maximum}
+                      for stage, (count, total, maximum) in self._timers.items()}
+            return {'timers': timers, 'counters': dict(self._counters)}
+
+    def to_json(self) -> str:
+        return json.dumps(dict(self.stats(), recent_errors=list(self.recent_errors)), indent=2)
+
+    def to_prometheus(self, prefix: str = 'exebench') -> str:
+        # Text exposition format, e.g. for the node exporter's textfile collector
+        stats = self.stats()
+        lines = []
+        for metric, kind, help_text, key, scale in [
+                ('stage_seconds_total', 'counter', 'Time spent in each stage', 'total_ms', 1e-3),
+                ('stage_seconds_max', 'gauge', 'Longest single event of each stage', 'max_ms', 1e-3),
+                ('stage_events_total', 'counter', 'Events of each stage', 'count', 1)]:
+            lines += [f'# HELP {prefix}_{metric} {help_text}', f'# TYPE {prefix}_{metric} {kind}']
+            lines += [f'{prefix}_{metric}{{stage="{stage}"}} {timer[key] * scale}'
+                      for stage, timer in sorted(stats['timers'].items())]
+        for name, value in sorted(stats['counters'].items()):
+            lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, format: str = 'json'):
+        content = self.to_prometheus() if format == 'prometheus' else self.to_json()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)  # readers never see a partial file
+
+
+_instrumentation: Optional[Instrumentation] = None
+
+
+def enable_instrumentation(instrumentation: Optional[Instrumentation] = None) -> Instrumentation:
+    # Per process: worker processes (e.g. of exebench.evaluate) need to enable their own
+    global _instrumentation
+    _instrumentation = instrumentation or Instrumentation()
+    return _instrumentation
+
+
+def disable_instrumentation():
+    global _instrumentation
+    _instrumentation = None
+
+
+def _record(stage: str, seconds: Optional[float] = None, **fields):
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        instrumentation.record(stage, seconds, **fields)
+
+
+def _run_command(command: str, stdin: Optional[str] = None, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                 pass_fds: Tuple[int, ...] = (), stage: str = 'command') -> Tuple[str, str]:
+    start = time.perf_counter()
+    try:
+        output = subprocess.run(command.split(), capture_output=True, text=True, input=stdin, timeout=timeout,
+                                pass_fds=pass_fds)
+    except subprocess.TimeoutExpired:
+        _record(stage, time.perf_counter() - start, timeouts=1)
+        raise
+    _record(stage, time.perf_counter() - start, nonzero_exits=int(output.returncode != 0))
     stdout = output.stdout.decode('utf-8') if isinstance(output.stdout, bytes) else output.stdout
     stderr = output.stderr.decode('utf-8') if isinstance(output.stderr, bytes) else output.stderr
     return stdout, stderr
 
 
+async def _run_command_async(command: str, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                             pass_fds: Tuple[int, ...] = (), stage: str = 'command') -> Tuple[str, str]:
+    # Like _run_command, without blocking the event loop. On timeout or cancellation the child (and anything it
+    # spawned) is killed before propagating.
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*command.split(), stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE, start_new_session=True,
+                                                   pass_fds=pass_fds)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException as e:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            _record(stage, time.perf_counter() - start, timeouts=1)
+            raise subprocess.TimeoutExpired(command, timeout) from e
+        raise
+    _record(stage, time.perf_counter() - start, nonzero_exits=int(process.returncode != 0))
+    return stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace')
+
+
 def _get_host_process_id():
     process_id = 'exebench_' + os.uname()[1] + '_' + str(os.getpid())
     return process_id
 
 
-def _cleanup(path_pattern):
-    for path in glob.glob(path_pattern):
+class WorkspaceFull(OSError):
+    pass
+
+
+class Workspace:
+    # Where the temporary files of this process go (sources, executables, IO files): <root>/<host>_<pid>, a directory
+    # per process under a root that can be shared (e.g. a tmpfs), by default $EXEBENCH_WORKSPACE_DIR or
+    # <tmp>/exebench_workspace_<uid>.
+    #  - The directory is removed at interpreter shutdown, and executables when their Wrapper (or Harness) is closed.
+    #  - Each process holds a lock on its directory: directories left behind by processes that died (e.g. killed
+    #    workers) are removed by the next process that starts using the same root, or when over quota.
+    #  - With a quota (in bytes, per process; $EXEBENCH_WORKSPACE_QUOTA), files whose owner was garbage collected
+    #    without being closed are evicted, oldest first, before new ones are created. If live files alone exceed the
+    #    quota, creating new ones raises WorkspaceFull.
+    def __init__(self, root: Optional[str] = None, quota: Optional[int] = None):
+        if root is None:
+            root = os.environ.get('EXEBENCH_WORKSPACE_DIR') or os.path.join(tempfile.gettempdir(),
+                                                                            f'exebench_workspace_{os.getuid()}')
+        if quota is None and os.environ.get('EXEBENCH_WORKSPACE_QUOTA'):
+            quota = int(os.environ['EXEBENCH_WORKSPACE_QUOTA'])
+        self.root = Path(root)
+        self.quota = quota
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _after_fork(self):
+        # Forked children get their own directory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._path = None
+        self._pid = None
+        self._lock_file = None
+        self._artifacts = collections.OrderedDict()  # path -> weakref to its owner, or None if it can't be evicted
+
+    @property
+    def path(self) -> Path:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._create()
+        return self._path
+
+    def _create(self):
+        if self._lock_file is not None:
+            self._lock_file.close()  # inherited from the parent, whose lock stays held
+        self._reset()
+        path = self.root / f'{os.uname()[1]}_{os.getpid()}'
+        shutil.rmtree(path, ignore_errors=True)  # from a dead process with the same pid
+        path.mkdir(parents=True)
+        # Locked before it gets its final name, so that other processes never see it unlocked
+        lock_file = open(path / '.lock.tmp', 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        os.rename(path / '.lock.tmp', path / '.lock')
+        self._path, self._pid, self._lock_file = path, os.getpid(), lock_file
+        atexit.register(self._remove, os.getpid())
+        multiprocessing.util.Finalize(None, self._remove, args=(os.getpid(),), exitpriority=0)  # worker processes
+        self.remove_stale()
+
+    def _remove(self, pid):
+        if self._pid == pid == os.getpid():
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._lock_file.close()
+            self._reset()
+
+    def remove_stale(self) -> int:
+        # Removes the directories of dead processes of this host, returns how many
+        prefix = f'{os.uname()[1]}_'
+        removed = 0
         try:
-            shutil.rmtree(path)
-        except:
-            pass
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return 0
+        for entry in entries:
+            if not entry.name.startswith(prefix) or entry.path == str(self._path):
+                continue
+            try:
+                with open(os.path.join(entry.path, '.lock'), 'r') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # its owner is gone
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            except BlockingIOError:
+                continue
+            except FileNotFoundError:
+                with contextlib.suppress(OSError):
+                    if time.time() - entry.stat().st_mtime > 60:  # died before locking it
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def track(self, path):
+        # Registers a file that outlives the context that created it (e.g. an executable)
+        with self._lock:
+            self._artifacts[str(path)] = None
+
+    def adopt(self, path, owner) -> bool:
+        # path can be evicted once owner is garbage collected. Returns whether path belongs to this workspace.
+        with self._lock:
+            if str(path) not in self._artifacts:
+                return False
+            self._artifacts[str(path)] = weakref.ref(owner)
+            return True
+
+    def export(self, path):
+        # path is used by another process: it can't be evicted anymore
+        with self._lock:
+            if str(path) in self._artifacts:
+                self._artifacts[str(path)] = None
+
+    def release(self, path):
+        # Removes path if it belongs to this workspace
+        with self._lock:
+            if self._artifacts.pop(str(path), False) is False:
+                return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    def usage(self) -> int:
+        # Bytes used by the tracked files, forgetting those removed by other means
+        with self._lock:
+            paths = list(self._artifacts)
+        usage = 0
+        for path in paths:
+            try:
+                usage += os.stat(path).st_size
+            except FileNotFoundError:
+                with self._lock:
+                    self._artifacts.pop(path, None)
+        return usage
+
+    def reserve(self):
+        # Evicts what it can to get under the quota, before creating a new file
+        if self.quota is None or self.usage() <= self.quota:
+            return
+        self.remove_stale()
+        with self._lock:
+            evictable = [path for path, owner in self._artifacts.items() if owner is not None and owner() is None]
+        for path in evictable:
+            self.release(path)
+            if self.usage() <= self.quota:
+                return
+        raise WorkspaceFull(f'The live files of {self.path} exceed its quota of {self.quota} bytes')
+
+
+_workspace = Workspace()
+os.register_at_fork(after_in_child=lambda: _workspace._after_fork())
+
+
+def configure_workspace(root: Optional[str] = None, quota: Optional[int] = None) -> Workspace:
+    # Replaces the workspace of this process. root and quota are also exported through the environment, for
+    # worker processes.
+    global _workspace
+    if root is not None:
+        os.environ['EXEBENCH_WORKSPACE_DIR'] = str(root)
+    if quota is not None:
+        os.environ['EXEBENCH_WORKSPACE_QUOTA'] = str(quota)
+    _workspace._remove(os.getpid())
+    _workspace = Workspace(root, quota)
+    return _workspace
+
+
+def get_workspace() -> Workspace:
+    return _workspace
 
 
 @contextlib.contextmanager
 def _get_tmp_path(content: Optional[str] = None, suffix: Optional[str] = None, delete=True) -> str:
-    prefix = _get_host_process_id()
+    # Files created with delete=False are tracked by the workspace until released
+    workspace = _workspace
+    if not delete:
+        workspace.reserve()
+    try:
+        ntf = tempfile.NamedTemporaryFile(dir=workspace.path, suffix=suffix, delete=delete, mode='w+')
+    except OSError:  # e.g. a full tmpfs: make room and retry once
+        workspace.remove_stale()
+        ntf = tempfile.NamedTemporaryFile(dir=workspace.path, suffix=suffix, delete=delete, mode='w+')
+    with ntf:
+        if not delete:
+            workspace.track(ntf.name)
+        if content:
+            ntf.write(content)
+            ntf.flush()
+        yield ntf.name
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_id(compiler: str) -> str:
+    # Resolved binary + version banner, so that upgrading the toolchain invalidates cached executables
+    stdout, _ = _run_command(f'{compiler} --version')
+    return (shutil.which(compiler) or compiler) + '\n' + stdout.split('\n')[0]
+
+
+def _default_cache_root() -> str:
+    return os.environ.get('EXEBENCH_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'exebench'))
+
+
+class CompileCache:
+    # Content-addressed on-disk store of compiled executables, shared by all processes on the host.
+    # Entries are written atomically and evicted in LRU order (by mtime) once the total size exceeds max_size.
+    # The total is only scanned from disk now and then: in between, it's estimated from this process' own stores.
+    def __init__(self, root: Optional[str] = None, max_size: int = _DEFAULT_CACHE_MAX_SIZE):
+        if root is None:
+            root = _default_cache_root()
+        self.root = Path(root) / 'executables'
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._size = None  # estimated total size, None until the first scan
+        self._stores_since_scan = 0
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            encoded = part.encode('utf-8')
+            h.update(str(len(encoded)).encode('ascii') + b':' + encoded)
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / (key + '.x')
+
+    def fetch(self, key: str) -> Optional[Path]:
+        # Returns a private copy of the entry, so that a concurrent eviction can't remove a live executable
+        entry = self._entry_path(key)
+        if not entry.exists():
+            return None
+        with _get_tmp_path(content=None, suffix='.x', delete=False) as executable_path:
+            pass
+        os.remove(executable_path)
+        try:
+            os.link(entry, executable_path)
+        except FileNotFoundError:  # evicted in the meantime
+            return None
+        except OSError:  # e.g. cache and tmp on different filesystems
+            try:
+                shutil.copy2(entry, executable_path)
+            except FileNotFoundError:
+                return None
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(entry)  # bump for LRU
+        return Path(executable_path)
+
+    def store(self, key: str, executable_path: Path):
+        entry = self._entry_path(key)
+        entry.parent.mkdir(exist_ok=True)
+        tmp_entry = entry.with_name(f'{entry.name}.{_get_host_process_id()}.tmp')
+        shutil.copy2(executable_path, tmp_entry)
+        replaced_size = _file_size(entry)  # 0 if it's a new entry
+        os.replace(tmp_entry, entry)
+        self._stores_since_scan += 1
+        if self._size is not None:
+            self._size += _file_size(entry) - replaced_size
+        if self._size is None or self._size > self.max_size or self._stores_since_scan >= _CACHE_RESCAN_INTERVAL:
+            self._evict()
+
+    def _evict(self):
+        self._stores_since_scan = 0
+        with open(self.root / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for path in self.root.glob('*/*.x'):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            total_size = sum(size for _, size, _ in entries)
+            if total_size > self.max_size:
+                for _, size, path in sorted(entries):
+                    if total_size <= self.max_size * _CACHE_EVICT_TO:
+                        break
+                    with contextlib.suppress(FileNotFoundError):
+                        path.unlink()
+                    total_size -= size
+            self._size = total_size
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cache(root: str) -> CompileCache:
+    return CompileCache(root)
+
+
+def _get_default_cache() -> Optional[CompileCache]:
+    # Enabled for the default assembler by setting EXEBENCH_CACHE_DIR, read on every call (one CompileCache per
+    # directory, so that each keeps its size estimate)
+    root = os.environ.get('EXEBENCH_CACHE_DIR')
+    if root is None:
+        return None
+    return _get_cache(root)
+
+
+def _build_once(name: str, compiler: str, flags: str, sources: List[str], commands: List[str],
+                outputs: List[str]) -> Optional[Path]:
+    # Runs `commands` (formatted with the build dir) once per installation/compiler/flags/sources, shared by all
+    # processes. Returns the build dir, or None if some of the `outputs` weren't built (failures are remembered too).
+    key_parts = [_compiler_id(compiler), flags]
+    for path in sources:
+        with open(path) as f:
+            key_parts.append(f.read())
+    build_dir = Path(_default_cache_root()) / name / CompileCache.key(*key_parts)[:16]
+    try:
+        build_dir.mkdir(parents=True, exist_ok=True)
+        with open(build_dir / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # only one process builds it
+            if not (build_dir / '.complete').exists() and not (build_dir / '.failed').exists():
+                for path in sources:
+                    if path.startswith(_CLIB_PATH):
+                        shutil.copy(path, build_dir)
+                for output in outputs:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(build_dir / output)
+                for command in commands:
+                    _run_command(command.format(dir=build_dir), timeout=None)
+                if all((build_dir / output).exists() for output in outputs):
+                    (build_dir / '.complete').touch()
+                else:
+                    (build_dir / '.failed').touch()
+    except OSError:
+        return None
+    return build_dir if (build_dir / '.complete').exists() else None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_json_runtime(compiler: str, flags: str) -> Optional[Tuple[str, str]]:
+    # Precompiled nlohmann/json header + object file with its template instantiations (see clib/exebench_json.hpp).
+    # Returns (include dir, object path), or None if they can't be built, in which case we compile as usual.
+    build_dir = _build_once(
+        'json_runtime', compiler, flags,
+        sources=[os.path.join(_ROOT_PATH_FOR_JSON_HPP, 'nlohmann', 'json.hpp'),
+                 os.path.join(_CLIB_PATH, 'exebench_json.hpp'), os.path.join(_CLIB_PATH, 'exebench_json.cpp')],
+        commands=[f'{compiler} {flags} -x c++-header -o {{dir}}/exebench_json.hpp.gch {{dir}}/exebench_json.hpp '
+                  f'-I {_ROOT_PATH_FOR_JSON_HPP}',
+                  f'{compiler} {flags} -c -o {{dir}}/exebench_json.o {{dir}}/exebench_json.cpp '
+                  f'-I {_ROOT_PATH_FOR_JSON_HPP}'],
+        outputs=['exebench_json.hpp.gch', 'exebench_json.o'])
+    if build_dir is None:
+        return None
+    return str(build_dir), str(build_dir / 'exebench_json.o')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_driver_object(compiler: str, flags: str) -> Optional[str]:
+    # Harness entry point that wraps the wrapper's own main (see clib/exebench_driver.cpp)
+    build_dir = _build_once(
+        'driver', compiler, flags, sources=[os.path.join(_CLIB_PATH, 'exebench_driver.cpp'),
+                                            os.path.join(_ROOT_PATH_FOR_JSON_HPP, 'nlohmann', 'json.hpp')],
+        commands=[f'{compiler} {flags} -c -o {{dir}}/exebench_driver.o {{dir}}/exebench_driver.cpp '
+                  f'-I {_ROOT_PATH_FOR_JSON_HPP}'],
+        outputs=['exebench_driver.o'])
+    if build_dir is None:
+        return None
+    return str(build_dir / 'exebench_driver.o')
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path: Optional[str]) -> str:
+    # Content hash of a prebuilt object (they never change in place: a new build goes to a new directory)
+    if path is None:
+        return ''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _json_encode(value) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+@functools.lru_cache(maxsize=None)
+def _wire_codec(wire_format: str) -> Tuple[Callable, Callable]:
+    # (encode, decode) of the inputs and outputs exchanged with the harness. The binary formats need the optional
+    # cbor2 or msgpack packages.
+    if wire_format == 'json':
+        return _json_encode, json.loads
+    if wire_format == 'cbor':
+        import cbor2
+        return cbor2.dumps, cbor2.loads
+    if wire_format == 'msgpack':
+        import msgpack
+        return msgpack.packb, functools.partial(msgpack.unpackb, strict_map_key=False)
+    raise ValueError(f'Unknown wire format: {wire_format}')
+
+
+def _wire_decode(wire_format: str, data: bytes):
+    # Raises ValueError for empty or truncated outputs, whatever the format
     try:
-        with tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix, delete=delete, mode='w+') as ntf:
-            if content:
-                ntf.write(content)
-                ntf.flush()
-            yield ntf.name
+        return _wire_codec(wire_format)[1](data)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f'Invalid {wire_format} output: {e!r}') from e
+
+
+class _HarnessIO:
+    # Where the harness reads its input and writes its output: either in-memory files (memfd) inherited by the
+    # harness, which reopens them through /proc/self/fd, or named temp files where memfd isn't available
+    def __init__(self, input_path: str, output_path: str, pass_fds: Tuple[int, ...] = (),
+                 output_fd: Optional[int] = None, wire_format: str = 'json'):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.pass_fds = pass_fds
+        self._output_fd = output_fd
+        self._wire_format = wire_format
+
+    def sizes(self) -> Dict[str, int]:
+        # Bytes sent to and received from the harness
+        return {'bytes_in': _file_size(self.input_path), 'bytes_out': _file_size(self.output_path)}
+
+    def read_output(self, wire_format: Optional[str] = None):
+        if (wire_format or self._wire_format) != 'json':
+            if self._output_fd is None:
+                with open(self.output_path, 'rb') as f:
+                    return _wire_decode(self._wire_format, f.read())
+            os.lseek(self._output_fd, 0, os.SEEK_SET)
+            with open(self._output_fd, 'rb', closefd=False) as f:
+                return _wire_decode(self._wire_format, f.read())
+        if self._output_fd is None:
+            with open(self.output_path, 'r') as f:
+                return json.load(f)
+        os.lseek(self._output_fd, 0, os.SEEK_SET)
+        with open(self._output_fd, 'r', closefd=False) as f:
+            return json.load(f)
+
+
+def _file_size(path) -> int:
+    try:
+        return os.stat(path).st_size
     except OSError:
-        _cleanup(os.path.join(tempfile.gettempdir(), prefix, '*'))
-        with tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix, delete=delete, mode='w+') as ntf:
-            if content:
-                ntf.write(content)
-                ntf.flush()
-            yield ntf.name
+        return 0
+
+
+def _write_input(inp, path_or_fd, wire_format: str):
+    if wire_format == 'json':
+        with open(path_or_fd, 'w', closefd=not isinstance(path_or_fd, int)) as f:
+            json.dump(inp, f)
+    else:
+        with open(path_or_fd, 'wb', closefd=not isinstance(path_or_fd, int)) as f:
+            f.write(_wire_codec(wire_format)[0](inp))
+
+
+@contextlib.contextmanager
+def _harness_io(inp, wire_format: str = 'json') -> _HarnessIO:
+    if _USE_MEMFD:
+        input_fd = os.memfd_create('exebench_input')
+        try:
+            output_fd = os.memfd_create('exebench_output')
+            try:
+                _write_input(inp, input_fd, wire_format)
+                yield _HarnessIO(f'/proc/self/fd/{input_fd}', f'/proc/self/fd/{output_fd}', (input_fd, output_fd),
+                                 output_fd, wire_format)
+            finally:
+                os.close(output_fd)
+        finally:
+            os.close(input_fd)
+        return
+
+    # Fallback
+    with _get_tmp_path(content=None, suffix='.json') as input_tmp_json_path:
+        output_file = ''.join(input_tmp_json_path.split(".")[:1]) + '-out.json'
+
+        _write_input(inp, input_tmp_json_path, wire_format)
+
+        try:
+            yield _HarnessIO(input_tmp_json_path, output_file, wire_format=wire_format)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output_file)
 
 
 class _Assembler:
@@ -65,101 +668,1183 @@ class _Assembler:
         raise NotImplemented
 
 
+_DEFAULT_CACHE = object()  # default of the cache argument: a CompileCache if $EXEBENCH_CACHE_DIR is set
+
+
 class _DefaultAssembler(_Assembler):
+    compiler = 'g++'
+    flags = '-fpermissive -O0'
+
+    def __init__(self, cache: Optional[CompileCache] = _DEFAULT_CACHE, use_json_runtime: bool = True):
+        # cache=None disables caching, even with $EXEBENCH_CACHE_DIR set
+        self._default_cache = cache is _DEFAULT_CACHE  # resolved on use, the environment may change until then
+        self.cache = None if self._default_cache else cache
+        self.use_json_runtime = use_json_runtime
+
     def __call__(self, c_deps, func_c_signature, func_assembly, cpp_wrapper) -> Path:
-        with _get_tmp_path(content=None, suffix='.x', delete=False) as executable_path:
-            c_deps += f'\nextern {func_c_signature};\n'
-            with _get_tmp_path(content=c_deps, suffix='.c') as c_deps_path:
-                cpp_wrapper = re.sub(
-                    r'extern\s\"C\"\s\{\s.*\s\}', 'extern "C" \n{\n#include "' + c_deps_path + '"\n}\n',
-                    cpp_wrapper) # replace tmp path
-                with _get_tmp_path(content=cpp_wrapper, suffix='.cpp') as cpp_path, \
-                        _get_tmp_path(content=func_assembly, suffix='.s') as s_path:
+        start = time.perf_counter()
+        cache, key = self._cache_key(c_deps, func_c_signature, func_assembly, cpp_wrapper)
+        executable_path = cache.fetch(key) if cache is not None else None
+        cache_hit, stderr = executable_path is not None, ''
+        if executable_path is None:
+            executable_path, stderr = self._compile(c_deps, func_c_signature, func_assembly, cpp_wrapper)
+            self._cache_store(cache, key, executable_path)
+        self._record_compile(start, executable_path, cache_hit, stderr)
+        return executable_path
+
+    async def compile_async(self, c_deps, func_c_signature, func_assembly, cpp_wrapper) -> Path:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        # The first call may build the shared JSON runtime and driver, and the cache does file IO (and eviction): keep
+        # all of that off the event loop
+        await loop.run_in_executor(None, _get_driver_object, self.compiler, self.flags)
+        await loop.run_in_executor(None, self._json_runtime_args)
+        cache, key = await loop.run_in_executor(None, self._cache_key, c_deps, func_c_signature, func_assembly,
+                                                cpp_wrapper)
+        executable_path = await loop.run_in_executor(None, cache.fetch, key) if cache is not None else None
+        cache_hit, stderr = executable_path is not None, ''
+        if executable_path is None:
+            with self._compile_command(c_deps, func_c_signature, func_assembly, cpp_wrapper) as (cmd, executable_path):
+                stdout, stderr = await _run_command_async(cmd, stage='compiler')
+            await loop.run_in_executor(None, self._cache_store, cache, key, executable_path)
+        self._record_compile(start, executable_path, cache_hit, stderr)
+        return executable_path
+
+    @staticmethod
+    def _record_compile(start: float, executable_path: Path, cache_hit: bool, stderr: str):
+        if _instrumentation is not None:
+            failed = _file_size(executable_path) == 0  # g++ leaves the (empty) temp file behind on errors
+            _record('compile', time.perf_counter() - start, cache_hits=int(cache_hit), failures=int(failed),
+                    stderr=stderr)
 
-                    cmd = f'g++ -fpermissive -O0 -o {executable_path} {cpp_path} {s_path} -I {_ROOT_PATH_FOR_JSON_HPP} -I{_SYNTH_LIBS_PATH}'
+    def _cache_key(self, c_deps, func_c_signature, func_assembly, cpp_wrapper) -> Tuple[Optional[CompileCache], str]:
+        cache = _get_default_cache() if self._default_cache else self.cache
+        if cache is None:
+            return None, ''
+        # The prebuilt driver and JSON runtime objects linked into the executable, by content
+        _, json_runtime_object = self._json_runtime_args()
+        return cache, cache.key(c_deps, func_c_signature, func_assembly, cpp_wrapper, _compiler_id(self.compiler),
+                                self.flags, _file_digest(_get_driver_object(self.compiler, self.flags)),
+                                _file_digest(json_runtime_object or None))
 
-                    stdout, stderr = _run_command(cmd)
+    @staticmethod
+    def _cache_store(cache: Optional[CompileCache], key: str, executable_path: Path):
+        if cache is not None and executable_path.stat().st_size > 0:  # don't cache compilation failures
+            cache.store(key, executable_path)
+
+    def _json_runtime_args(self) -> Tuple[str, str]:
+        runtime = _get_json_runtime(self.compiler, self.flags) if self.use_json_runtime else None
+        if runtime is None:
+            return '', ''
+        include_dir, object_path = runtime
+        return f'-I {include_dir} -include exebench_json.hpp', object_path
+
+    def _driver_args(self, cpp_wrapper) -> Tuple[str, str]:
+        driver_object = _get_driver_object(self.compiler, self.flags)
+        if driver_object is None:
+            return cpp_wrapper, ''
+        cpp_wrapper, renamed = re.subn(r'\bint\s+main\s*\(', 'extern "C" int exebench_wrapper_main(', cpp_wrapper, count=1)
+        if not renamed:
+            return cpp_wrapper, ''
+        return self._measure_hook(self._wire_io(cpp_wrapper)), driver_object
+
+    @staticmethod
+    def _wire_io(cpp_wrapper) -> str:
+        # Has the wrapper read its input and write its output through the driver, which also understands CBOR and
+        # MessagePack. Wrappers that don't parse and print as usual are left as they are (JSON only).
+        rewritten, parsed = re.subn(r'\bjson::parse\((\w+)\)', r'exebench_read_input(\1)', cpp_wrapper, count=1)
+        rewritten, printed = re.subn(r'\b(\w+)\s*<<\s*std::setw\(4\)\s*<<\s*(\w+)\s*<<\s*std::endl\s*;',
+                                     r'exebench_write_output(\1, \2);', rewritten, count=1)
+        if not (parsed and printed):
+            return cpp_wrapper
+        return rewritten.replace('extern "C" int exebench_wrapper_main(',
+                                 _WIRE_DECLARATIONS + 'extern "C" int exebench_wrapper_main(', 1)
+
+    @staticmethod
+    def _measure_hook(cpp_wrapper) -> str:
+        # Passes the call of the function (the statement the wrapper times with clock()) to exebench_measure too,
+        # which repeats and times it in measurement mode (see Wrapper.measure) and does nothing otherwise
+        m = re.search(r'^([ \t]*)clock_t\s+\w+\s*=\s*clock\(\)\s*;\s*\n\s*([^;]+);\s*\n\s*clock_t\s+\w+\s*=\s*clock\(\)\s*;',
+                      cpp_wrapper, flags=re.MULTILINE)
+        if m is None:
+            return cpp_wrapper
+        indent, statement = m.group(1), m.group(2)
+        call = re.sub(r'^[^=(]*=\s*', '', statement)  # `int returnv = f(...)` -> `f(...)`
+        hook = f'{indent}auto exebench_call = [&]() {{ (void) ({call}); }};\n' \
+               f'{indent}exebench_measure([](void *call) {{ (*(decltype(exebench_call) *) call)(); }}, &exebench_call);\n'
+        rewritten = cpp_wrapper[:m.start()] + hook + cpp_wrapper[m.start():]
+        return rewritten.replace('extern "C" int exebench_wrapper_main(',
+                                 _MEASURE_DECLARATIONS + 'extern "C" int exebench_wrapper_main(', 1)
+
+    def _compile(self, c_deps, func_c_signature, func_assembly, cpp_wrapper) -> Tuple[Path, str]:
+        # Returns the executable and the compiler's stderr
+        with self._compile_command(c_deps, func_c_signature, func_assembly, cpp_wrapper) as (cmd, executable_path):
+            stdout, stderr = _run_command(cmd, stage='compiler')
+        return executable_path, stderr
+
+    @contextlib.contextmanager
+    def _harness_source(self, c_deps, func_c_signature, cpp_wrapper) -> Tuple[str, str]:
+        # Yields the path of the harness C++ source (which includes the dependencies) and the driver object to link
+        # it with, alive while in the context
+        cpp_wrapper, driver_object = self._driver_args(cpp_wrapper)
+        c_deps += f'\nextern {func_c_signature};\n'
+        with _get_tmp_path(content=c_deps, suffix='.c') as c_deps_path:
+            cpp_wrapper = re.sub(
+                r'extern\s\"C\"\s\{\s.*\s\}', 'extern "C" \n{\n#include "' + c_deps_path + '"\n}\n',
+                cpp_wrapper) # replace tmp path
+            with _get_tmp_path(content=cpp_wrapper, suffix='.cpp') as cpp_path:
+                yield cpp_path, driver_object
 
+    @contextlib.contextmanager
+    def _compile_command(self, c_deps, func_c_signature, func_assembly, cpp_wrapper) -> Tuple[str, Path]:
+        # Yields the compilation command and the path of the executable it will produce (kept after exiting), with
+        # the temporary sources it needs alive in the meantime
+        json_runtime_flags, json_runtime_object = self._json_runtime_args()
+        with _get_tmp_path(content=None, suffix='.x', delete=False) as executable_path, \
+                self._harness_source(c_deps, func_c_signature, cpp_wrapper) as (cpp_path, driver_object), \
+                _get_tmp_path(content=func_assembly, suffix='.s') as s_path:
+
+            cmd = f'{self.compiler} {self.flags} {json_runtime_flags} -o {executable_path} {cpp_path} {s_path} ' \
+                  f'{json_runtime_object} {driver_object} -I {_ROOT_PATH_FOR_JSON_HPP} -I{_SYNTH_LIBS_PATH}'
+
+            yield cmd, Path(executable_path)
+
+    def compile_harness(self, c_deps, func_c_signature, cpp_wrapper) -> Path:
+        # Compiles everything but the function itself (harness, dependencies, JSON runtime and driver) into a single
+        # relocatable object, so that link_candidate only has to assemble and link each candidate assembly.
+        # The object is empty if the compilation failed.
+        start = time.perf_counter()
+        json_runtime_flags, json_runtime_object = self._json_runtime_args()
+        with _get_tmp_path(content=None, suffix='.o', delete=False) as object_path, \
+                _get_tmp_path(content=None, suffix='.o') as harness_object_path, \
+                self._harness_source(c_deps, func_c_signature, cpp_wrapper) as (cpp_path, driver_object):
+            stdout, stderr = _run_command(
+                f'{self.compiler} {self.flags} {json_runtime_flags} -c -o {harness_object_path} {cpp_path} '
+                f'-I {_ROOT_PATH_FOR_JSON_HPP} -I{_SYNTH_LIBS_PATH}', stage='compiler')
+            if _file_size(harness_object_path) > 0:
+                _, link_stderr = _run_command(f'{self.compiler} -r -o {object_path} {harness_object_path} '
+                                              f'{json_runtime_object} {driver_object}', stage='compiler')
+                stderr += link_stderr
+        self._record_compile(start, Path(object_path), False, stderr)
+        return Path(object_path)
+
+    def link_candidate(self, harness_object, func_assembly) -> Path:
+        # Executable from an object of compile_harness and the assembly of the function (empty if it fails)
+        start = time.perf_counter()
+        with _get_tmp_path(content=None, suffix='.x', delete=False) as executable_path, \
+                _get_tmp_path(content=func_assembly, suffix='.s') as s_path:
+            stdout, stderr = _run_command(f'{self.compiler} {self.flags} -o {executable_path} {harness_object} '
+                                          f'{s_path}', stage='compiler')
+        self._record_compile(start, Path(executable_path), False, stderr)
         return Path(executable_path)
 
 
+def _contains_marker(executable_path, marker: bytes) -> bool:
+    with open(executable_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return m.find(marker) != -1
+
+
+def _supports_driver(executable_path) -> bool:
+    return _contains_marker(executable_path, _DRIVER_MARKER)
+
+
+def _supports_wire_formats(executable_path) -> bool:
+    # Whether the harness also reads and writes CBOR and MessagePack
+    return _contains_marker(executable_path, _DRIVER_MARKER) and _contains_marker(executable_path, _WIRE_MARKER)
+
+
+def _supports_measure(executable_path) -> bool:
+    return _contains_marker(executable_path, _DRIVER_MARKER) and _contains_marker(executable_path, _MEASURE_MARKER)
+
+
+def _read_text(path) -> str:
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
 def _compile_exe_path(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend):
     return assembler_backend(c_deps, func_c_signature, func_assembly, cpp_wrapper)
 
 # API
 
 
+class ExecutionError(Exception):
+    # Returned by Wrapper.run_many in place of the output of an input for which the harness didn't produce one
+    def __init__(self, message, returncode: Optional[int] = None, signum: Optional[int] = None, stdout: str = '',
+                 stderr: str = ''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.signum = signum
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class ExecutionTimeout(ExecutionError):
+    pass
+
+
+class ResourceLimitExceeded(ExecutionError):
+    def __init__(self, message, limit: str, **kwargs):
+        super().__init__(message, **kwargs)
+        self.limit = limit  # name of the ResourceLimits field
+
+
+@dataclass
+class ResourceLimits:
+    # Limits applied to the harness process and to the children it forks for each input. None means unlimited.
+    cpu_time: Optional[int] = None  # seconds of CPU time per process
+    address_space: Optional[int] = None  # bytes of virtual memory per process
+    output_size: Optional[int] = None  # bytes per file written, including the output JSON, stdout and stderr
+    processes: Optional[int] = None  # RLIMIT_NPROC: counts all the processes of the user, and root is exempt
+
+    def apply(self):
+        # Runs in the child process, between fork and exec
+        for limit, value in [(resource.RLIMIT_CPU, self.cpu_time), (resource.RLIMIT_AS, self.address_space),
+                             (resource.RLIMIT_FSIZE, self.output_size), (resource.RLIMIT_NPROC, self.processes)]:
+            if value is None:
+                continue
+            _, hard = resource.getrlimit(limit)
+            # For CPU time, SIGXCPU is sent at the soft limit and SIGKILL at the hard one
+            new_hard = value + 1 if limit == resource.RLIMIT_CPU else value
+            if hard != resource.RLIM_INFINITY:
+                value, new_hard = min(value, hard), min(new_hard, hard)
+            resource.setrlimit(limit, (value, new_hard))
+
+
+_LIMIT_SIGNALS = {signal.SIGXCPU: 'cpu_time', signal.SIGXFSZ: 'output_size'}
+
+
+def _timeout_ms(timeout: Optional[float]) -> int:
+    # For the driver, where 0 means no timeout
+    return max(1, math.ceil(timeout * 1000)) if timeout else 0
+
+
+def _kill_process_group(process: subprocess.Popen):
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def _run_limited(command: str, resource_limits: ResourceLimits, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                 pass_fds: Tuple[int, ...] = (), stage: str = 'command') -> Tuple[int, str, str]:
+    # Like _run_command, with the resource limits applied, in a new process group that is killed as a whole once
+    # the command exits or times out (so nothing it spawned outlives it). stdout and stderr go through files, so
+    # that output_size applies to them too. Returns the return code as well (negative: killed by that signal).
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command.split(), stdin=subprocess.DEVNULL, stdout=stdout_file, stderr=stderr_file,
+                                   pass_fds=pass_fds, start_new_session=True, preexec_fn=resource_limits.apply)
+        try:
+            returncode = process.wait(timeout)
+        except BaseException as e:
+            _kill_process_group(process)
+            process.wait()
+            if isinstance(e, subprocess.TimeoutExpired):
+                _record(stage, time.perf_counter() - start, timeouts=1)
+            raise
+        _kill_process_group(process)
+        _record(stage, time.perf_counter() - start, nonzero_exits=int(returncode != 0))
+        stdout_file.seek(0)
+        stderr_file.seek(0)
+        return returncode, stdout_file.read().decode('utf-8', errors='replace'), \
+            stderr_file.read().decode('utf-8', errors='replace')
+
+
+async def _run_limited_async(command: str, resource_limits: ResourceLimits,
+                             timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT, pass_fds: Tuple[int, ...] = (),
+                             stage: str = 'command') -> Tuple[int, str, str]:
+    # _run_limited without blocking the event loop. On timeout or cancellation the process group is killed before
+    # propagating, as in _run_command_async.
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+        process = await asyncio.create_subprocess_exec(*command.split(), stdin=subprocess.DEVNULL, stdout=stdout_file,
+                                                       stderr=stderr_file, pass_fds=pass_fds, start_new_session=True,
+                                                       preexec_fn=resource_limits.apply)
+        try:
+            returncode = await asyncio.wait_for(process.wait(), timeout)
+        except BaseException as e:
+            with contextlib.suppress(ProcessLookupError, PermissionError):
+                os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                _record(stage, time.perf_counter() - start, timeouts=1)
+                raise subprocess.TimeoutExpired(command, timeout) from e
+            raise
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.killpg(process.pid, signal.SIGKILL)
+        _record(stage, time.perf_counter() - start, nonzero_exits=int(returncode != 0))
+        stdout_file.seek(0)
+        stderr_file.seek(0)
+        return returncode, stdout_file.read().decode('utf-8', errors='replace'), \
+            stderr_file.read().decode('utf-8', errors='replace')
+
+
+class _HarnessServer:
+    # Resident harness process (`exe --exebench-serve`), see clib/exebench_driver.cpp for the protocol
+    _REQUEST = struct.Struct('=II')
+    _RESPONSE = struct.Struct('=iiIII')
+
+    def __init__(self, executable_path, resource_limits: Optional[ResourceLimits] = None):
+        request_r, request_w = os.pipe()
+        response_r, response_w = os.pipe()
+        # Unbuffered, the pipes are waited on with select
+        self._requests = open(request_w, 'wb', buffering=0)
+        self._responses = open(response_r, 'rb', buffering=0)
+        try:
+            # In its own process group, killed as a whole (with the child of the request) if it gets stuck
+            self._process = subprocess.Popen(
+                [str(executable_path), '--exebench-serve', str(request_r), str(response_w)],
+                pass_fds=(request_r, response_w), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True,
+                preexec_fn=resource_limits.apply if resource_limits is not None else None)
+        except OSError:
+            self._requests.close()
+            self._responses.close()
+            raise
+        finally:
+            os.close(request_r)
+            os.close(response_w)
+        self._lock = threading.Lock()  # one request in flight at a time
+
+    def run(self, inp: bytes, timeout: Optional[float]) -> Tuple[str, int, bytes, str, str]:
+        # The child of the request is timed out by the server itself. In case that doesn't happen (e.g. the function
+        # blocks SIGALRM, or the server itself is stuck), the whole exchange has a deadline too, past which the server
+        # is killed and ExecutionTimeout raised.
+        deadline = time.monotonic() + timeout + _SERVER_GRACE if timeout else None
+        with self._lock:
+            try:
+                self._write(self._REQUEST.pack(_timeout_ms(timeout), len(inp)) + inp, deadline, timeout)
+                header = self._read(self._RESPONSE.size, deadline, timeout)
+                if len(header) != self._RESPONSE.size:
+                    raise ExecutionError('The harness server exited')
+                kind, value, *sizes = self._RESPONSE.unpack(header)
+                output, stdout, stderr = (self._read(size, deadline, timeout) for size in sizes)
+            except (BrokenPipeError, ValueError) as e:
+                raise ExecutionError('The harness server exited') from e
+        return 'signal' if kind else 'exit', value, output, stdout.decode(errors='replace'), \
+            stderr.decode(errors='replace')
+
+    def _wait(self, f, writable: bool, deadline: Optional[float], timeout: Optional[float]):
+        if deadline is None:
+            return
+        remaining = deadline - time.monotonic()
+        ready = select.select([], [f], [], max(0, remaining)) if writable else \
+            select.select([f], [], [], max(0, remaining))
+        if not any(ready):
+            _kill_process_group(self._process)
+            raise ExecutionTimeout(f'The harness server did not respond within {timeout}s')
+
+    def _write(self, data: bytes, deadline: Optional[float], timeout: Optional[float]):
+        view = memoryview(data)
+        while view:
+            self._wait(self._requests, True, deadline, timeout)
+            view = view[self._requests.write(view[:select.PIPE_BUF]):]
+
+    def _read(self, size: int, deadline: Optional[float], timeout: Optional[float]) -> bytes:
+        # Exactly size bytes, or fewer if the server exited
+        chunks = []
+        while size:
+            self._wait(self._responses, False, deadline, timeout)
+            chunk = self._responses.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._requests.close()  # the server exits on EOF
+        self._responses.close()
+        try:
+            self._process.wait(timeout=_DEFAULT_CMD_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        _kill_process_group(self._process)
+
+
+class _ResidentHarness:
+    def __init__(self, wrapper: 'Wrapper'):
+        self._wrapper = wrapper
+
+    def __enter__(self) -> 'Wrapper':
+        return self._wrapper
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._wrapper.stop_server()
+
+
+_WRAPPER_TIMEOUT = object()  # default of the timeout arguments that fall back to the Wrapper's
+
+
+@dataclass
+class TimingStats:
+    min: float
+    median: float
+    stddev: float  # sample standard deviation, 0 with a single sample
+
+    @classmethod
+    def of(cls, samples: List[float]) -> 'TimingStats':
+        return cls(min(samples), statistics.median(samples), statistics.stdev(samples) if len(samples) > 1 else 0.0)
+
+
+@dataclass
+class Measurement:
+    # Timings of a function on one input, from Wrapper.measure. All per call of the function.
+    wall: TimingStats  # seconds
+    cycles: Optional[TimingStats]  # None where no cycle counter is available
+    cycles_source: Optional[str]  # 'cpu_cycles' (hardware counter, user space) or 'tsc' (x86 time stamp counter)
+    repeats: int  # samples the statistics are computed from
+    calls_per_sample: int  # consecutive calls timed together in each sample (more for very short functions)
+    setup_seconds: float  # spent in the harness before the first call: parsing the input, setting up arguments
+    process_seconds: float  # the whole harness invocation as seen from Python, including startup and IO
+
+
 class Wrapper:
-    def __init__(self, c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend=_DefaultAssembler()):
+    def __init__(self, c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend=_DefaultAssembler(),
+                 resource_limits: Optional[ResourceLimits] = None, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                 wire_format: str = 'json'):
+        # With resource_limits, inputs exceeding them fail with ResourceLimitExceeded. timeout (in seconds, e.g. from
+        # TimeoutCalibrator) is the default for every call. wire_format ('json', 'cbor' or 'msgpack') is how inputs
+        # and outputs are sent to and from the harness: the values are the same, the binary formats are cheaper to
+        # encode and parse for large arrays. Executables that don't support them fall back to JSON.
+        _wire_codec(wire_format)
+        self._server = None
+        self._resource_limits = resource_limits
+        self.timeout = timeout
         self._compiled_exe_path = self._compile_exe_path(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend)
+        _workspace.adopt(self._compiled_exe_path, self)
+        self.wire_format = self._effective_wire_format(wire_format)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_server'] = None  # the resident harness belongs to this process
+        _workspace.export(self._compiled_exe_path)  # the copy may still use the executable after this one is gone
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start_server(self) -> '_ResidentHarness':
+        # Keeps the harness resident: every following call forks a fresh child of it and exchanges the input and
+        # output over pipes, instead of spawning a new process and going through temp files. Used as a context
+        # manager, the harness stops at the end of the block.
+        if self._server is None:
+            if not _supports_driver(self._compiled_exe_path):
+                raise RuntimeError('The harness was not built with the exebench driver')
+            self._server = _HarnessServer(self._compiled_exe_path, self._resource_limits)
+        return _ResidentHarness(self)
+
+    def stop_server(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def close(self):
+        # Stops the resident harness and removes the executable, if it was compiled in this process' workspace
+        self.stop_server()
+        _workspace.release(self._compiled_exe_path)
+
+    @classmethod
+    def from_executable(cls, compiled_exe_path, resource_limits: Optional[ResourceLimits] = None,
+                        timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT, wire_format: str = 'json') -> 'Wrapper':
+        # Wraps an executable built beforehand (e.g. by Harness), without compiling anything
+        _wire_codec(wire_format)
+        wrapper = cls.__new__(cls)
+        wrapper._server = None
+        wrapper._resource_limits = resource_limits
+        wrapper.timeout = timeout
+        wrapper._compiled_exe_path = Path(compiled_exe_path)
+        wrapper.wire_format = wrapper._effective_wire_format(wire_format)
+        return wrapper
+
+    def _effective_wire_format(self, wire_format: str) -> str:
+        if wire_format == 'json' or not _supports_wire_formats(self._compiled_exe_path):
+            return 'json'
+        return wire_format
 
     @staticmethod
     def _compile_exe_path(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend):
         return _compile_exe_path(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend)
 
     def __call__(self, inp, return_stdout_and_stderr=False):
+        if self._server is not None:
+            return self._call_server(inp, return_stdout_and_stderr, self.timeout)
+        return self._call_file(inp, return_stdout_and_stderr, self.timeout)
+
+    def _call_file(self, inp, return_stdout_and_stderr, timeout):
+        start = time.perf_counter()
         executable = self._compiled_exe_path
 
-        with _get_tmp_path(content=None, suffix='.json') as input_tmp_json_path:
-            output_file = ''.join(input_tmp_json_path.split(".")[:1]) + '-out.json'
+        with _harness_io(inp, self.wire_format) as io:
+            try:
+                command = f'{executable} {io.input_path} {io.output_path}'
+                if self._resource_limits is None:
+                    stdout, stderr = _run_command(command, timeout=timeout, pass_fds=io.pass_fds, stage='exec')
+                else:
+                    returncode, stdout, stderr = _run_limited(command, self._resource_limits, timeout=timeout,
+                                                              pass_fds=io.pass_fds, stage='exec')
+                    error = self._execution_error('The input', 'signal' if returncode < 0 else 'exit',
+                                                  abs(returncode), timeout, stdout, stderr)
+                    if isinstance(error, ResourceLimitExceeded):
+                        raise error
+                output = io.read_output()
+            except Exception:
+                _record('call', time.perf_counter() - start, errors=1)
+                raise
+            if _instrumentation is not None:
+                _record('call', time.perf_counter() - start, **io.sizes())
+
+        if return_stdout_and_stderr:
+            return output, stdout, stderr
+
+        return output
+
+    def measure(self, inp, repeats: int = 10, warmup: int = 1, timeout: Optional[float] = _WRAPPER_TIMEOUT) -> Measurement:
+        # Runs the function on inp in the harness process warmup times, then repeats timed samples, without the
+        # harness startup and input parsing. Functions that modify their inputs in place see them as the previous
+        # call left them. The timeout (per call) defaults to the wrapper's.
+        if repeats < 1:
+            raise ValueError('repeats must be at least 1')
+        if timeout is _WRAPPER_TIMEOUT:
+            timeout = self.timeout
+        if not _supports_measure(self._compiled_exe_path):
+            raise RuntimeError('The harness was not built with measurement support')
+        total_timeout = timeout * (warmup + repeats + 1) + _DEFAULT_CMD_TIMEOUT if timeout else None
+        start = time.perf_counter()
+        with _harness_io(inp, self.wire_format) as io:
+            command = f'{self._compiled_exe_path} --exebench-measure {warmup} {repeats} {io.input_path} ' \
+                      f'{io.output_path}'
+            try:
+                if self._resource_limits is None:
+                    stdout, stderr = _run_command(command, timeout=total_timeout, pass_fds=io.pass_fds,
+                                                  stage='measure')
+                    returncode = None
+                else:
+                    returncode, stdout, stderr = _run_limited(command, self._resource_limits, timeout=total_timeout,
+                                                              pass_fds=io.pass_fds, stage='measure')
+                stats = io.read_output(wire_format='json')
+            except subprocess.TimeoutExpired as e:
+                raise ExecutionTimeout(f'Measuring timed out after {total_timeout}s') from e
+            except ValueError:
+                if returncode is not None:
+                    raise self._execution_error('The measured input', 'signal' if returncode < 0 else 'exit',
+                                                abs(returncode), timeout, stdout, stderr)
+                raise ExecutionError('The measured input produced no timings', stdout=stdout, stderr=stderr)
+        process_seconds = time.perf_counter() - start
+        return Measurement(wall=TimingStats.of([ns / 1e9 for ns in stats['wall_ns']]),
+                           cycles=TimingStats.of(stats['cycles']) if stats['cycles'] is not None else None,
+                           cycles_source=stats['cycles_source'], repeats=repeats,
+                           calls_per_sample=stats['calls_per_sample'], setup_seconds=stats['setup_ns'] / 1e9,
+                           process_seconds=process_seconds)
+
+    def run_many(self, inputs, return_stdout_and_stderr=False, timeout: Optional[float] = _WRAPPER_TIMEOUT):
+        # Runs all the inputs with a single harness invocation, each of them in a fresh forked child.
+        # A failing input yields an ExecutionError in its position, without affecting the rest.
+        # The timeout (per input) defaults to the wrapper's.
+        if timeout is _WRAPPER_TIMEOUT:
+            timeout = self.timeout
+        start = time.perf_counter()
+        inputs = list(inputs)
+        results = self._run_many(inputs, return_stdout_and_stderr, timeout)
+        _record('run_many', time.perf_counter() - start, inputs=len(inputs),
+                errors=sum(isinstance(result, ExecutionError) for result in results),
+                timeouts=sum(isinstance(result, ExecutionTimeout) for result in results))
+        return results
+
+    def _run_many(self, inputs, return_stdout_and_stderr, timeout):
+        # Resident harness, or executables without the driver (e.g. from custom assembler backends)
+        if self._server is not None or not _supports_driver(self._compiled_exe_path):
+            return [self._run_isolated(inp, return_stdout_and_stderr, timeout) for inp in inputs]
+
+        with tempfile.TemporaryDirectory(dir=_workspace.path) as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, 'manifest')
+            status_path = os.path.join(tmp_dir, 'status')
+            with open(manifest_path, 'w') as manifest:
+                for idx, inp in enumerate(inputs):
+                    base = os.path.join(tmp_dir, str(idx))
+                    _write_input(inp, base + '.json', self.wire_format)
+                    manifest.write('\t'.join(base + ext for ext in ['.json', '-out.json', '.stdout', '.stderr']) + '\n')
+
+            total_timeout = timeout * len(inputs) + _DEFAULT_CMD_TIMEOUT if timeout else None
+            command = f'{self._compiled_exe_path} --exebench-batch {manifest_path} {status_path} {_timeout_ms(timeout)}'
+            if self._resource_limits is None:
+                _run_command(command, timeout=total_timeout, stage='exec')
+            else:
+                _run_limited(command, self._resource_limits, timeout=total_timeout, stage='exec')
+
+            statuses = _read_text(status_path).splitlines()
+            results = []
+            for idx in range(len(inputs)):
+                base = os.path.join(tmp_dir, str(idx))
+                stdout, stderr = _read_text(base + '.stdout'), _read_text(base + '.stderr')
+                try:
+                    if self.wire_format == 'json':
+                        with open(base + '-out.json', 'r') as f:
+                            output = json.load(f)
+                    else:
+                        with open(base + '-out.json', 'rb') as f:
+                            output = _wire_decode(self.wire_format, f.read())
+                except (OSError, ValueError):
+                    if idx < len(statuses):
+                        kind, value = statuses[idx].split()
+                        results.append(self._execution_error(f'Input {idx}', kind, int(value), timeout, stdout, stderr))
+                    else:
+                        results.append(ExecutionError(f'Input {idx} was not run', stdout=stdout, stderr=stderr))
+                    continue
+                results.append((output, stdout, stderr) if return_stdout_and_stderr else output)
+
+        return results
+
+    def _call_server(self, inp, return_stdout_and_stderr, timeout):
+        start = time.perf_counter()
+        payload = _wire_codec(self.wire_format)[0](inp)
+        exec_start = time.perf_counter()
+        try:
+            kind, value, output, stdout, stderr = self._server.run(payload, timeout)
+        except ExecutionTimeout:
+            # The server was killed: the following inputs go to a fresh one
+            _record('exec', time.perf_counter() - exec_start, timeouts=1)
+            self._server.close()
+            self._server = _HarnessServer(self._compiled_exe_path, self._resource_limits)
+            raise
+        _record('exec', time.perf_counter() - exec_start, timeouts=int(kind == 'signal' and value == signal.SIGALRM))
+        output_size = len(output)
+        try:
+            output = _wire_decode(self.wire_format, output)
+        except ValueError:
+            _record('call', time.perf_counter() - start, errors=1)
+            raise self._execution_error('The input', kind, value, timeout, stdout, stderr)
+        _record('call', time.perf_counter() - start, bytes_in=len(payload), bytes_out=output_size)
+
+        if return_stdout_and_stderr:
+            return output, stdout, stderr
+
+        return output
+
+    @staticmethod
+    def _execution_error(what, kind, value, timeout, stdout, stderr) -> ExecutionError:
+        if kind == 'signal' and value == signal.SIGALRM:
+            return ExecutionTimeout(f'{what} timed out after {timeout}s', signum=value, stdout=stdout, stderr=stderr)
+        if kind == 'signal' and value in _LIMIT_SIGNALS:
+            return ResourceLimitExceeded(f'{what} exceeded its {_LIMIT_SIGNALS[value]} limit', _LIMIT_SIGNALS[value],
+                                         signum=value, stdout=stdout, stderr=stderr)
+        if 'std::bad_alloc' in stderr:  # the harness couldn't allocate (C code failing to, usually crashes instead)
+            return ResourceLimitExceeded(f'{what} ran out of memory', 'address_space', signum=value if
+                                         kind == 'signal' else None, stdout=stdout, stderr=stderr)
+        if kind == 'signal':
+            return ExecutionError(f'{what} was killed by signal {value}', signum=value, stdout=stdout, stderr=stderr)
+        return ExecutionError(f'{what} produced no output (exit code {value})', returncode=value, stdout=stdout,
+                              stderr=stderr)
+
+    def _run_isolated(self, inp, return_stdout_and_stderr, timeout):
+        try:
+            if self._server is not None:
+                return self._call_server(inp, return_stdout_and_stderr, timeout)
+            return self._call_file(inp, return_stdout_and_stderr, timeout)
+        except ExecutionError as e:
+            return e
+        except subprocess.TimeoutExpired as e:
+            return ExecutionTimeout(str(e))
+        except (OSError, ValueError) as e:
+            return ExecutionError(str(e))
+
+
+@dataclass
+class CandidateResult:
+    index: int  # position of the candidate in the list passed to Harness.evaluate
+    compiled: bool
+    passed: List[bool]  # per IO pair, in order; with early exit, only up to the first failure
+    error: Optional[str] = None
+    error_class: str = 'none'  # see exebench.journal.ERROR_CLASSES
+
+    @property
+    def ok(self) -> bool:
+        return self.compiled and len(self.passed) > 0 and all(self.passed)
+
 
-            with open(input_tmp_json_path, 'w') as f:
-                json.dump(inp, f)
+def _error_class(outputs, passed) -> str:
+    # Of the outputs of the IO pairs of a candidate that compiled, see exebench.journal.ERROR_CLASSES
+    for output in outputs:
+        if isinstance(output, ExecutionTimeout):
+            return 'timeout'
+        if isinstance(output, ResourceLimitExceeded):
+            return 'resource_limit'
+        if isinstance(output, ExecutionError):
+            return 'crash'
+    return 'none' if all(passed) else 'wrong_output'
 
-            stdout, stderr = _run_command(f'{executable} {input_tmp_json_path} {output_file}')
 
-            with open(output_file, 'r') as f:
-                output = json.load(f)
-            os.remove(output_file)
+class Harness:
+    # Everything of a row but the function itself, compiled once, to evaluate many candidate assemblies of the
+    # function: each candidate then only costs an assembler + linker invocation, plus running the IO pairs.
+    #     with Harness(c_deps, func_c_signature, cpp_wrapper) as harness:
+    #         results = harness.evaluate(candidate_assemblies, io_pairs)
+    # Assembler backends without compile_harness/link_candidate compile each candidate from scratch instead.
+    def __init__(self, c_deps, func_c_signature, cpp_wrapper, assembler_backend=_DefaultAssembler(),
+                 resource_limits: Optional[ResourceLimits] = None, wire_format: str = 'json'):
+        self._sources = (c_deps, func_c_signature, cpp_wrapper)
+        self._assembler = assembler_backend
+        self._resource_limits = resource_limits
+        self._wire_format = wire_format
+        self._object_path = None
+        if hasattr(assembler_backend, 'compile_harness'):
+            self._object_path = assembler_backend.compile_harness(c_deps, func_c_signature, cpp_wrapper)
+            _workspace.adopt(self._object_path, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._object_path is not None:
+            _workspace.release(self._object_path)
+            self._object_path = None
+
+    @property
+    def compiled(self) -> bool:
+        return self._object_path is None or _file_size(self._object_path) > 0
+
+    def wrapper(self, func_assembly) -> Wrapper:
+        # The caller owns the executable of the returned Wrapper
+        if self._object_path is None:
+            c_deps, func_c_signature, cpp_wrapper = self._sources
+            return Wrapper(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend=self._assembler,
+                           resource_limits=self._resource_limits, wire_format=self._wire_format)
+        wrapper = Wrapper.from_executable(self._assembler.link_candidate(self._object_path, func_assembly),
+                                          self._resource_limits, wire_format=self._wire_format)
+        _workspace.adopt(wrapper._compiled_exe_path, wrapper)
+        return wrapper
+
+    def evaluate(self, candidates, io_pairs, early_exit: bool = False,
+                 timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT) -> List[CandidateResult]:
+        # Runs every (input, expected output) pair on every candidate assembly. With early_exit, a candidate stops at
+        # its first failing pair (pairs are then run one by one on a resident harness instead of in one batch).
+        io_pairs = list(io_pairs)
+        return [self._evaluate_candidate(index, func_assembly, io_pairs, early_exit, timeout)
+                for index, func_assembly in enumerate(candidates)]
+
+    def _evaluate_candidate(self, index, func_assembly, io_pairs, early_exit, timeout) -> CandidateResult:
+        if not self.compiled:
+            return CandidateResult(index, compiled=False, passed=[], error='Harness compilation failed',
+                                   error_class='compile_error')
+        wrapper = self.wrapper(func_assembly)
+        try:
+            if _file_size(wrapper._compiled_exe_path) == 0:
+                return CandidateResult(index, compiled=False, passed=[], error='Compilation failed',
+                                       error_class='compile_error')
+            if not early_exit:
+                outputs = wrapper.run_many([inp for inp, _ in io_pairs], timeout=timeout)
+                passed = diff_io_batch(outputs, [expected for _, expected in io_pairs])
+                errors = [str(output) for output in outputs if isinstance(output, ExecutionError)]
+                return CandidateResult(index, compiled=True, passed=passed, error=errors[0] if errors else None,
+                                       error_class=_error_class(outputs, passed))
+            if _supports_driver(wrapper._compiled_exe_path):
+                wrapper.start_server()
+            passed = []
+            for inp, expected in io_pairs:
+                output = wrapper._run_isolated(inp, False, timeout)
+                passed.append(not isinstance(output, ExecutionError) and diff_io(output, expected))
+                if not passed[-1]:
+                    return CandidateResult(index, compiled=True, passed=passed,
+                                           error=str(output) if isinstance(output, ExecutionError) else None,
+                                           error_class=_error_class([output], passed))
+            return CandidateResult(index, compiled=True, passed=passed)
+        finally:
+            wrapper.close()
+
+
+@dataclass(frozen=True)
+class TimeoutPolicy:
+    multiple: float = 10.0  # of the time of the slowest input on the reference assembly
+    floor: float = 0.1  # seconds
+    ceiling: Optional[float] = _DEFAULT_CMD_TIMEOUT  # also used when there's no measurement
+
+    def timeout(self, reference_seconds: Optional[float]) -> Optional[float]:
+        if reference_seconds is None:
+            return self.ceiling
+        timeout = max(self.floor, self.multiple * reference_seconds)
+        return min(timeout, self.ceiling) if self.ceiling is not None else timeout
+
+
+class TimeoutCalibrator:
+    # Per-function timeouts, from running the reference assembly of the function (e.g. row['asm']['code'][0]) on its
+    # inputs. Measurements are cached in memory and on disk (under $EXEBENCH_CACHE_DIR/timeouts), keyed by the
+    # sources and inputs, so each row is measured once per machine:
+    #     timeout = calibrator.timeout(c_deps, func_c_signature, reference_assembly, cpp_wrapper, inputs)
+    #     wrapper = Wrapper(c_deps, func_c_signature, candidate_assembly, cpp_wrapper, timeout=timeout)
+    def __init__(self, policy: TimeoutPolicy = TimeoutPolicy(), cache_dir: Optional[str] = None, repeats: int = 3,
+                 assembler_backend=_DefaultAssembler()):
+        self.policy = policy
+        self.cache_dir = Path(cache_dir or os.path.join(_default_cache_root(), 'timeouts'))
+        self.repeats = repeats  # runs per input, of which the fastest counts
+        self._assembler = assembler_backend
+        self._measurements = {}
+
+    def timeout(self, c_deps, func_c_signature, func_assembly, cpp_wrapper, inputs) -> Optional[float]:
+        return self.policy.timeout(self.reference_time(c_deps, func_c_signature, func_assembly, cpp_wrapper, inputs))
+
+    def reference_time(self, c_deps, func_c_signature, func_assembly, cpp_wrapper, inputs) -> Optional[float]:
+        # Seconds taken by the slowest input (None if the reference fails on all of them, or doesn't compile)
+        inputs = list(inputs)
+        compiler = _compiler_id(self._assembler.compiler) if hasattr(self._assembler, 'compiler') else ''
+        key = CompileCache.key(c_deps, func_c_signature, func_assembly, cpp_wrapper, compiler, json.dumps(inputs))
+        if key in self._measurements:
+            return self._measurements[key]
+        path = self.cache_dir / key[:2] / f'{key}.json'
+        try:
+            with open(path) as f:
+                seconds = json.load(f)['reference_seconds']
+        except (OSError, ValueError, KeyError):
+            seconds = self._measure(c_deps, func_c_signature, func_assembly, cpp_wrapper, inputs)
+            with contextlib.suppress(OSError):
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+                with open(tmp_path, 'w') as f:
+                    json.dump({'reference_seconds': seconds}, f)
+                os.replace(tmp_path, path)
+        self._measurements[key] = seconds
+        return seconds
+
+    def _measure(self, c_deps, func_c_signature, func_assembly, cpp_wrapper, inputs) -> Optional[float]:
+        wrapper = Wrapper(c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend=self._assembler,
+                          timeout=self.policy.ceiling)
+        try:
+            if not inputs or _file_size(wrapper._compiled_exe_path) == 0:
+                return None
+            if _supports_driver(wrapper._compiled_exe_path):
+                wrapper.start_server()  # so that process startup and IO through files don't count
+            wrapper._run_isolated(inputs[0], False, self.policy.ceiling)  # warm-up
+            slowest = None
+            for inp in inputs:
+                fastest = None
+                for _ in range(self.repeats):
+                    start = time.perf_counter()
+                    output = wrapper._run_isolated(inp, False, self.policy.ceiling)
+                    elapsed = time.perf_counter() - start
+                    if isinstance(output, ExecutionError):
+                        break
+                    fastest = elapsed if fastest is None else min(fastest, elapsed)
+                if fastest is not None:
+                    slowest = fastest if slowest is None else max(slowest, fastest)
+            return slowest
+        finally:
+            wrapper.close()
+
+
+class AsyncLimits:
+    # Bounds on the number of concurrent compilations and executions, shared by the AsyncWrappers using it
+    def __init__(self, max_compilations: Optional[int] = None, max_executions: Optional[int] = None):
+        self.compilations = asyncio.Semaphore(max_compilations or os.cpu_count())
+        self.executions = asyncio.Semaphore(max_executions or os.cpu_count())
+
+
+_default_async_limits = weakref.WeakKeyDictionary()  # event loop -> AsyncLimits
+
+
+def _get_default_async_limits() -> AsyncLimits:
+    loop = asyncio.get_running_loop()
+    if loop not in _default_async_limits:
+        _default_async_limits[loop] = AsyncLimits()
+    return _default_async_limits[loop]
+
+
+class AsyncWrapper:
+    # asyncio counterpart of Wrapper, which never blocks the event loop on the compiler or the harness:
+    #     wrapper = await AsyncWrapper.create(c_deps, func_c_signature, func_assembly, cpp_wrapper)
+    #     output = await wrapper(inp)
+    # Cancelling a call kills the child process. resource_limits, timeout and wire_format are as in Wrapper.
+    def __init__(self, compiled_exe_path, limits: Optional[AsyncLimits] = None,
+                 resource_limits: Optional[ResourceLimits] = None, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                 wire_format: str = 'json'):
+        _wire_codec(wire_format)
+        self._compiled_exe_path = Path(compiled_exe_path)
+        self._limits = limits
+        self._resource_limits = resource_limits
+        self.timeout = timeout
+        self.wire_format = wire_format if wire_format == 'json' or _supports_wire_formats(self._compiled_exe_path) \
+            else 'json'
+
+    @classmethod
+    async def create(cls, c_deps, func_c_signature, func_assembly, cpp_wrapper, assembler_backend=_DefaultAssembler(),
+                     limits: Optional[AsyncLimits] = None, resource_limits: Optional[ResourceLimits] = None,
+                     timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT, wire_format: str = 'json') -> 'AsyncWrapper':
+        _wire_codec(wire_format)
+        limits = limits or _get_default_async_limits()
+        loop = asyncio.get_running_loop()
+        async with limits.compilations:
+            if hasattr(assembler_backend, 'compile_async'):
+                executable_path = await assembler_backend.compile_async(c_deps, func_c_signature, func_assembly,
+                                                                        cpp_wrapper)
+            else:  # custom assembler backends
+                executable_path = await loop.run_in_executor(
+                    None, assembler_backend, c_deps, func_c_signature, func_assembly, cpp_wrapper)
+        # Checking which wire formats the executable supports reads it
+        wrapper = await loop.run_in_executor(None, functools.partial(
+            cls, executable_path, limits, resource_limits=resource_limits, timeout=timeout, wire_format=wire_format))
+        _workspace.adopt(executable_path, wrapper)
+        return wrapper
+
+    def close(self):
+        # Removes the executable, if it was compiled in this process' workspace
+        _workspace.release(self._compiled_exe_path)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __call__(self, inp, return_stdout_and_stderr=False, timeout: Optional[float] = _WRAPPER_TIMEOUT):
+        # The timeout defaults to the wrapper's
+        executable = self._compiled_exe_path
+        limits = self._limits or _get_default_async_limits()
+        if timeout is _WRAPPER_TIMEOUT:
+            timeout = self.timeout
+
+        async with limits.executions:
+            start = time.perf_counter()
+            with _harness_io(inp, self.wire_format) as io:
+                try:
+                    command = f'{executable} {io.input_path} {io.output_path}'
+                    if self._resource_limits is None:
+                        stdout, stderr = await _run_command_async(command, timeout=timeout, pass_fds=io.pass_fds,
+                                                                  stage='exec')
+                    else:
+                        returncode, stdout, stderr = await _run_limited_async(command, self._resource_limits,
+                                                                              timeout=timeout, pass_fds=io.pass_fds,
+                                                                              stage='exec')
+                        error = Wrapper._execution_error('The input', 'signal' if returncode < 0 else 'exit',
+                                                         abs(returncode), timeout, stdout, stderr)
+                        if isinstance(error, ResourceLimitExceeded):
+                            raise error
+                    output = io.read_output()
+                except Exception:
+                    _record('call', time.perf_counter() - start, errors=1)
+                    raise
+                if _instrumentation is not None:
+                    _record('call', time.perf_counter() - start, **io.sizes())
 
         if return_stdout_and_stderr:
             return output, stdout, stderr
 
         return output
 
+    async def run_many(self, inputs, return_stdout_and_stderr=False, timeout: Optional[float] = _WRAPPER_TIMEOUT):
+        # Runs the inputs concurrently (within the execution limit). A failing input yields an ExecutionError in its
+        # position, without affecting the rest.
+        return await asyncio.gather(*(self._run_isolated(inp, return_stdout_and_stderr, timeout) for inp in inputs))
+
+    async def _run_isolated(self, inp, return_stdout_and_stderr, timeout):
+        try:
+            return await self(inp, return_stdout_and_stderr=return_stdout_and_stderr, timeout=timeout)
+        except ExecutionError as e:
+            return e
+        except subprocess.TimeoutExpired as e:
+            return ExecutionTimeout(str(e))
+        except (OSError, ValueError) as e:
+            return ExecutionError(str(e))
+
+
+# Comparison of observed and expected outputs. Structure (types, lengths, keys) and exact values are checked while
+# walking the outputs, returning as soon as something differs; floats are collected on the way and compared with
+# math.isclose semantics in a single pass at the end, vectorized with NumPy if it's installed.
+# As in the original implementation, dict keys are only checked one way: every observed key must be expected.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_VECTORIZE_MIN_SIZE = 32  # below this, converting to arrays costs more than it saves
+_SCALAR_TYPES = (int, float, str, bool, type(None))
+
 
-def diff_io(observed_output, expected_output) -> bool:
-    if type(observed_output) is not type(expected_output):
+def _homogeneous_type(values: list):
+    types = set(map(type, values))
+    if len(types) == 1:
+        t = types.pop()
+        if t in _SCALAR_TYPES:
+            return t
+    return None
+
+
+def _collect(observed, expected, observed_floats: list, expected_floats: list) -> bool:
+    if type(observed) is not type(expected):
         return False
-    if isinstance(observed_output, list):
-        if len(observed_output) != len(expected_output):
+    if isinstance(observed, list):
+        if len(observed) != len(expected):
             return False
-        for e1, e2 in zip(observed_output, expected_output):
-            ok = diff_io(e1, e2)
-            if not ok:
+        t = _homogeneous_type(observed)
+        if t is not None and _homogeneous_type(expected) is t:
+            if t is float:
+                observed_floats.extend(observed)
+                expected_floats.extend(expected)
+                return True
+            return observed == expected
+        for e1, e2 in zip(observed, expected):
+            if not _collect(e1, e2, observed_floats, expected_floats):
                 return False
-    elif isinstance(observed_output, dict):
-        for key in observed_output:
-            if key not in expected_output:
+    elif isinstance(observed, dict):
+        for key in observed:
+            if key not in expected:
                 return False
-            ok = diff_io(observed_output[key], expected_output[key])
-            if not ok:
+            if not _collect(observed[key], expected[key], observed_floats, expected_floats):
                 return False
-    elif isinstance(observed_output, float):
-        ok = math.isclose(observed_output, expected_output)
-        if not ok:
-            return False
+    elif isinstance(observed, float):
+        observed_floats.append(observed)
+        expected_floats.append(expected)
     else:
-        ok = observed_output == expected_output
-        if not ok:
-            return False
+        return observed == expected
     return True
 
 
-def _fix_nested_dict(inp):  # hack
+def _isclose_array(observed, expected, rel_tol: float, abs_tol: float):
+    # Element-wise math.isclose: infinities are only close to themselves, NaNs to nothing
+    with np.errstate(invalid='ignore', over='ignore'):  # inf - inf
+        difference = np.abs(observed - expected)
+        tolerance = np.maximum(rel_tol * np.maximum(np.abs(observed), np.abs(expected)), abs_tol)
+        return (observed == expected) | (np.isfinite(difference) & (difference <= tolerance))
 
-    if isinstance(inp, dict):
-        for k in inp:
-            inp[k] = _fix_nested_dict(inp[k])
-    elif isinstance(inp, list):
-        for idx, e in enumerate(inp):
-            inp[idx] = _fix_nested_dict(e)
-    else:
-        return literal_eval(inp)
-    return inp
+
+def _floats_close(observed: list, expected: list, rel_tol: float, abs_tol: float) -> bool:
+    if np is not None and len(observed) >= _VECTORIZE_MIN_SIZE:
+        return bool(_isclose_array(np.array(observed, dtype=np.float64), np.array(expected, dtype=np.float64),
+                                   rel_tol, abs_tol).all())
+    return all(map(functools.partial(math.isclose, rel_tol=rel_tol, abs_tol=abs_tol), observed, expected))
+
+
+def diff_io(observed_output, expected_output, rel_tol: float = 1e-09, abs_tol: float = 0.0) -> bool:
+    # True if they match (note the name: it doesn't return the differences, see diff_io_report for that)
+    observed_floats, expected_floats = [], []
+    return (_collect(observed_output, expected_output, observed_floats, expected_floats) and
+            _floats_close(observed_floats, expected_floats, rel_tol, abs_tol))
+
+
+def diff_io_batch(observed_outputs, expected_outputs, rel_tol: float = 1e-09, abs_tol: float = 0.0) -> List[bool]:
+    # diff_io over pairs of outputs, with the floats of the whole batch compared at once. Observed outputs may be
+    # ExecutionErrors (as returned by Wrapper.run_many), which never match.
+    if len(observed_outputs) != len(expected_outputs):
+        raise ValueError(f'{len(observed_outputs)} observed outputs for {len(expected_outputs)} expected ones')
+    results = []
+    spans = []
+    observed_floats, expected_floats = [], []
+    for observed, expected in zip(observed_outputs, expected_outputs):
+        start = len(observed_floats)
+        ok = not isinstance(observed, ExecutionError) and _collect(observed, expected, observed_floats,
+                                                                   expected_floats)
+        if not ok:
+            del observed_floats[start:], expected_floats[start:]
+        results.append(ok)
+        spans.append((start, len(observed_floats)))
+    if np is not None and len(observed_floats) >= _VECTORIZE_MIN_SIZE:
+        close = _isclose_array(np.array(observed_floats, dtype=np.float64),
+                               np.array(expected_floats, dtype=np.float64), rel_tol, abs_tol)
+        return [ok and bool(close[start:end].all()) for ok, (start, end) in zip(results, spans)]
+    return [ok and _floats_close(observed_floats[start:end], expected_floats[start:end], rel_tol, abs_tol)
+            for ok, (start, end) in zip(results, spans)]
+
+
+@dataclass
+class Mismatch:
+    path: tuple  # keys and list indices leading to the value, e.g. ('arr', 3)
+    expected: object
+    observed: object
+    reason: str  # 'type', 'length', 'unexpected key' or 'value'
+
+
+def _report(observed, expected, path: tuple, rel_tol: float, abs_tol: float, mismatches: List[Mismatch],
+            max_mismatches: Optional[int]):
+    if max_mismatches is not None and len(mismatches) >= max_mismatches:
+        return
+    if type(observed) is not type(expected):
+        mismatches.append(Mismatch(path, expected, observed, 'type'))
+    elif isinstance(observed, list):
+        if len(observed) != len(expected):
+            mismatches.append(Mismatch(path, expected, observed, 'length'))
+            return
+        for i, (e1, e2) in enumerate(zip(observed, expected)):
+            _report(e1, e2, path + (i,), rel_tol, abs_tol, mismatches, max_mismatches)
+    elif isinstance(observed, dict):
+        for key in observed:
+            if key not in expected:
+                mismatches.append(Mismatch(path + (key,), None, observed[key], 'unexpected key'))
+            else:
+                _report(observed[key], expected[key], path + (key,), rel_tol, abs_tol, mismatches, max_mismatches)
+    elif isinstance(observed, float):
+        if not math.isclose(observed, expected, rel_tol=rel_tol, abs_tol=abs_tol):
+            mismatches.append(Mismatch(path, expected, observed, 'value'))
+    elif observed != expected:
+        mismatches.append(Mismatch(path, expected, observed, 'value'))
+
+
+def diff_io_report(observed_output, expected_output, rel_tol: float = 1e-09, abs_tol: float = 0.0,
+                   max_mismatches: Optional[int] = None) -> List[Mismatch]:
+    # Where the outputs differ, by the same rules as diff_io (an empty list means they match)
+    if max_mismatches is not None and max_mismatches < 1:
+        raise ValueError('max_mismatches must be at least 1')
+    mismatches = []
+    if diff_io(observed_output, expected_output, rel_tol=rel_tol, abs_tol=abs_tol):
+        return mismatches
+    _report(observed_output, expected_output, (), rel_tol, abs_tol, mismatches, max_mismatches)
+    return mismatches[:max_mismatches]
+
+
+# Values in the dataset are Python literals (ints, floats, chars, strings and nested lists of them) encoded as strings.
+# They are decoded with the same results as literal_eval, but numbers and lists of numbers, which are the bulk of the
+# data, go through the C JSON scanner instead of the Python parser.
+_NUMERIC_LITERAL = re.compile(r'[-+0-9.eE\[\],\s]*\Z')
+_PLAIN_STRING_LITERAL = re.compile(r'''(?:'[^'\\\n]*'|"[^"\\\n]*")\Z''')
+_SCALAR_CACHE_SIZE = 1 << 14
+
+
+def _decode_literal(value: str):
+    if _NUMERIC_LITERAL.match(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass  # e.g. '+1' or '1.', which are valid Python but not JSON
+    return literal_eval(value)
+
+
+@functools.lru_cache(maxsize=_SCALAR_CACHE_SIZE)
+def _decode_scalar(value: str):
+    # Only for immutable results, since they are shared between calls
+    if _PLAIN_STRING_LITERAL.match(value):
+        return value[1:-1]
+    return _decode_literal(value)
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return {k: _decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_value(e) for e in value]
+    if value.lstrip()[:1] in ('[', '{', '('):  # mutable (or containing mutable) values are decoded every time
+        return _decode_literal(value)
+    return _decode_scalar(value)
 
 
 def exebench_dict_to_dict(exebench_dict):
+    # The input isn't modified
     keys = exebench_dict['var']
     values = exebench_dict['value']
-    return _fix_nested_dict({k: v for k, v in zip(keys, values)})
+    return {k: _decode_value(v) for k, v in zip(keys, values)}
+
+
+def exebench_io_pairs_to_dicts(io_pairs) -> List[Tuple[dict, dict]]:
+    # Decodes a whole io_pairs entry of a row (e.g. row['synth_io_pairs']) into (input, output) pairs
+    if not io_pairs:
+        return []
+    return [(exebench_dict_to_dict(inp), exebench_dict_to_dict(out))
+            for inp, out in zip(io_pairs['input'], io_pairs['output'])]
@@ -0,0 +1,418 @@
+// Entry point linked into every wrapper executable built by the default assembler. The wrapper's own main is
+// renamed to exebench_wrapper_main, so that running `exe input.json output.json` behaves exactly as before, while
+//  - `exe --exebench-batch manifest status timeout_ms` runs many inputs in a single invocation, and
+//  - `exe --exebench-serve request_fd response_fd` stays resident and serves inputs sent over pipes.
+// In both modes every input is run in a freshly forked child, so a crash (or global state) in one input can't
+// affect the others.
+//  - `exe --exebench-measure warmup repeats input stats` runs the wrapper on the input, timing repeated calls of the
+//    function in-process (see exebench_measure), and writes the timings to stats instead of the output.
+// The wrapper's json::parse of the input and printing of the output are also replaced by exebench_read_input and
+// exebench_write_output, which accept JSON, CBOR or MessagePack inputs and write the output in the same format.
+#include <cmath>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <iomanip>
+#include <fstream>
+#include <iostream>
+#include <vector>
+#include <nlohmann/json.hpp>
+#include <errno.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <sys/time.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+#ifdef __linux__
+#include <linux/perf_event.h>
+#endif
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#endif
+
+extern "C" int exebench_wrapper_main(int argc, char **argv);
+
+// Looked up by the Python side to know whether an executable supports the driver protocol
+extern "C" const char exebench_driver_version[] = "EXEBENCH_DRIVER_5";
+
+enum WireFormat { WIRE_JSON, WIRE_CBOR, WIRE_MSGPACK };
+
+static WireFormat wire_format = WIRE_JSON;
+
+// The format is told apart by the first byte of the input, which is always an object: '{' (or whitespace) in JSON,
+// a map header in CBOR (major type 5) or MessagePack (fixmap, map16, map32)
+nlohmann::json exebench_read_input(std::istream &in) {
+    int first = in.peek();
+    if (first >= 0xa0 && first <= 0xbf) {
+        wire_format = WIRE_CBOR;
+        return nlohmann::json::from_cbor(in);
+    }
+    if ((first >= 0x80 && first <= 0x8f) || first == 0xde || first == 0xdf) {
+        wire_format = WIRE_MSGPACK;
+        return nlohmann::json::from_msgpack(in);
+    }
+    wire_format = WIRE_JSON;
+    return nlohmann::json::parse(in);
+}
+
+// JSON has no NaN or infinities (nlohmann prints them as null): the binary formats do the same, so that the output
+// values are the same whatever the format
+static void non_finite_to_null(nlohmann::json &j) {
+    if (j.is_number_float()) {
+        if (!std::isfinite(j.get<double>())) {
+            j = nullptr;
+        }
+    } else if (j.is_structured()) {
+        for (auto &element : j) {
+            non_finite_to_null(element);
+        }
+    }
+}
+
+void exebench_write_output(std::ostream &out, const nlohmann::json &output) {
+    if (wire_format == WIRE_JSON) {
+        out << std::setw(4) << output << std::endl;
+        return;
+    }
+    nlohmann::json finite_output = output;
+    non_finite_to_null(finite_output);
+    std::vector<std::uint8_t> bytes = wire_format == WIRE_CBOR ? nlohmann::json::to_cbor(finite_output)
+                                                               : nlohmann::json::to_msgpack(finite_output);
+    out.write(reinterpret_cast<const char *>(bytes.data()), bytes.size());
+    out.flush();
+}
+
+// Measurement mode: the wrapper calls exebench_measure right before its own (single) call of the function, with a
+// callback making that same call. Outside of measurement mode it returns immediately.
+static unsigned measure_warmup = 0, measure_repeats = 0;  // repeats is 0 outside of measurement mode
+static uint64_t measure_start_ns = 0;
+static nlohmann::json measurement;  // null until exebench_measure ran
+
+// A sample times enough consecutive calls to last at least this long, so that very short functions aren't
+// dominated by the cost of reading the clock
+static const uint64_t MIN_SAMPLE_NS = 10000;
+static const uint64_t MAX_CALLS_PER_SAMPLE = 1 << 20;
+
+static uint64_t now_ns() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+// Cycles spent by this process in user space from the hardware counter, or else the time stamp counter on x86
+// (which ticks at a constant rate, whatever the clock of the core)
+struct CycleCounter {
+    int fd = -1;
+    const char *source = nullptr;
+
+    CycleCounter() {
+#ifdef __linux__
+        struct perf_event_attr attr;
+        memset(&attr, 0, sizeof(attr));
+        attr.type = PERF_TYPE_HARDWARE;
+        attr.size = sizeof(attr);
+        attr.config = PERF_COUNT_HW_CPU_CYCLES;
+        attr.exclude_kernel = 1;
+        attr.exclude_hv = 1;
+        fd = (int) syscall(SYS_perf_event_open, &attr, 0, -1, -1, 0);
+        if (fd >= 0) {
+            source = "cpu_cycles";
+            return;
+        }
+#endif
+#if defined(__x86_64__) || defined(__i386__)
+        source = "tsc";
+#endif
+    }
+
+    ~CycleCounter() {
+        if (fd >= 0) {
+            close(fd);
+        }
+    }
+
+    uint64_t read() const {
+        uint64_t cycles = 0;
+        if (fd >= 0) {
+            if (::read(fd, &cycles, sizeof(cycles)) != sizeof(cycles)) {
+                return 0;
+            }
+            return cycles;
+        }
+#if defined(__x86_64__) || defined(__i386__)
+        cycles = __rdtsc();
+#endif
+        return cycles;
+    }
+};
+
+void exebench_measure(void (*call)(void *), void *context) {
+    if (measure_repeats == 0) {
+        return;
+    }
+    uint64_t setup_ns = now_ns() - measure_start_ns;
+    for (unsigned i = 0; i < measure_warmup; i++) {
+        call(context);
+    }
+    uint64_t calls_per_sample = 1;
+    while (calls_per_sample < MAX_CALLS_PER_SAMPLE) {
+        uint64_t start = now_ns();
+        for (uint64_t i = 0; i < calls_per_sample; i++) {
+            call(context);
+        }
+        if (now_ns() - start >= MIN_SAMPLE_NS) {
+            break;
+        }
+        calls_per_sample *= 2;
+    }
+    CycleCounter counter;
+    std::vector<double> wall_ns, cycles;
+    for (unsigned r = 0; r < measure_repeats; r++) {
+        uint64_t start_cycles = counter.read();
+        uint64_t start = now_ns();
+        for (uint64_t i = 0; i < calls_per_sample; i++) {
+            call(context);
+        }
+        uint64_t end = now_ns();
+        uint64_t end_cycles = counter.read();
+        wall_ns.push_back((double) (end - start) / calls_per_sample);
+        cycles.push_back((double) (end_cycles - start_cycles) / calls_per_sample);
+    }
+    measurement = {{"setup_ns", setup_ns}, {"warmup", measure_warmup}, {"calls_per_sample", calls_per_sample},
+                   {"wall_ns", wall_ns}, {"cycles", nullptr}, {"cycles_source", nullptr}};
+    if (counter.source != nullptr) {
+        measurement["cycles"] = cycles;
+        measurement["cycles_source"] = counter.source;
+    }
+}
+
+static int measure(char *program, unsigned warmup, unsigned repeats, char *input_path, const char *stats_path) {
+    measure_start_ns = now_ns();
+    measure_warmup = warmup;
+    measure_repeats = repeats;
+    char output_path[] = "/dev/null";
+    char *argv[] = {program, input_path, output_path, NULL};
+    int status = exebench_wrapper_main(3, argv);
+    if (measurement.is_null()) {
+        fprintf(stderr, "exebench driver: the function was not called\n");
+        return status != 0 ? status : 3;
+    }
+    std::ofstream stats(stats_path);
+    stats << measurement << std::endl;
+    return stats.good() ? status : 2;
+}
+
+// Runs the wrapper's main on (input_path, output_path) in a forked child and returns its wait status.
+// The child gets SIGALRM after timeout_ms milliseconds of wall time (0: no timeout).
+static int run_child(char *program, char *input_path, char *output_path, int stdout_fd, int stderr_fd,
+                     unsigned timeout_ms, const int *fds_to_close, int n_fds_to_close) {
+    fflush(stdout);
+    fflush(stderr);
+    pid_t pid = fork();
+    if (pid == 0) {
+        for (int i = 0; i < n_fds_to_close; i++) {
+            close(fds_to_close[i]);
+        }
+        if (stdout_fd < 0 || stderr_fd < 0 || dup2(stdout_fd, STDOUT_FILENO) < 0 || dup2(stderr_fd, STDERR_FILENO) < 0) {
+            _exit(2);
+        }
+        signal(SIGPIPE, SIG_DFL);
+        struct itimerval timer = {};
+        timer.it_value.tv_sec = timeout_ms / 1000;
+        timer.it_value.tv_usec = (timeout_ms % 1000) * 1000;
+        setitimer(ITIMER_REAL, &timer, NULL);
+        char *argv[] = {program, input_path, output_path, NULL};
+        exit(exebench_wrapper_main(3, argv));
+    }
+    int wstatus = 0;
+    if (pid < 0) {
+        return 2 << 8;
+    }
+    while (waitpid(pid, &wstatus, 0) < 0) {
+        if (errno != EINTR) {
+            return 2 << 8;
+        }
+    }
+    return wstatus;
+}
+
+// Manifest lines: input_path \t output_path \t stdout_path \t stderr_path
+// Status lines (one per manifest line, in order): "exit <code>" or "signal <signum>"
+static int run_batch(char *program, const char *manifest_path, const char *status_path, unsigned timeout_ms) {
+    FILE *manifest = fopen(manifest_path, "r");
+    FILE *status = fopen(status_path, "w");
+    if (manifest == NULL || status == NULL) {
+        perror("exebench driver");
+        return 2;
+    }
+    char *line = NULL;
+    size_t capacity = 0;
+    while (getline(&line, &capacity, manifest) != -1) {
+        line[strcspn(line, "\n")] = '\0';
+        char *paths[4];
+        char *rest = line;
+        for (int i = 0; i < 4; i++) {
+            paths[i] = strsep(&rest, "\t");
+        }
+        if (paths[3] == NULL) {
+            fprintf(status, "exit 2\n");
+            continue;
+        }
+        int stdout_fd = open(paths[2], O_WRONLY | O_CREAT | O_TRUNC, 0644);
+        int stderr_fd = open(paths[3], O_WRONLY | O_CREAT | O_TRUNC, 0644);
+        int fds_to_close[] = {fileno(manifest), fileno(status)};
+        int wstatus = run_child(program, paths[0], paths[1], stdout_fd, stderr_fd, timeout_ms, fds_to_close, 2);
+        close(stdout_fd);
+        close(stderr_fd);
+        if (WIFSIGNALED(wstatus)) {
+            fprintf(status, "signal %d\n", WTERMSIG(wstatus));
+        } else {
+            fprintf(status, "exit %d\n", WEXITSTATUS(wstatus));
+        }
+        fflush(status);
+    }
+    free(line);
+    fclose(manifest);
+    fclose(status);
+    return 0;
+}
+
+static int make_anonymous_file() {
+    int fd = -1;
+#ifdef SYS_memfd_create
+    fd = (int) syscall(SYS_memfd_create, "exebench", 0);
+    if (fd >= 0) {
+        return fd;
+    }
+#endif
+    char path[] = "/tmp/exebench_serve_XXXXXX";
+    fd = mkstemp(path);
+    if (fd >= 0) {
+        unlink(path);
+    }
+    return fd;
+}
+
+static bool read_exact(int fd, void *buffer, size_t size) {
+    char *p = (char *) buffer;
+    while (size > 0) {
+        ssize_t n = read(fd, p, size);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            return false;
+        }
+        p += n;
+        size -= n;
+    }
+    return true;
+}
+
+static bool write_exact(int fd, const void *buffer, size_t size) {
+    const char *p = (const char *) buffer;
+    while (size > 0) {
+        ssize_t n = write(fd, p, size);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            return false;
+        }
+        p += n;
+        size -= n;
+    }
+    return true;
+}
+
+static uint32_t file_size(int fd) {
+    struct stat st;
+    return fstat(fd, &st) == 0 ? (uint32_t) st.st_size : 0;
+}
+
+static bool send_file(int out_fd, int fd, uint32_t size, char *buffer, size_t buffer_size) {
+    off_t offset = 0;
+    while (size > 0) {
+        ssize_t n = pread(fd, buffer, size < buffer_size ? size : buffer_size, offset);
+        if (n <= 0 || !write_exact(out_fd, buffer, n)) {
+            return false;
+        }
+        offset += n;
+        size -= n;
+    }
+    return true;
+}
+
+static void reset_file(int fd) {
+    ftruncate(fd, 0);
+    lseek(fd, 0, SEEK_SET);
+}
+
+// Request:  uint32 timeout in milliseconds, uint32 input_size, input bytes
+// Response: int32 kind (0: exited, 1: killed by signal), int32 exit code or signal number,
+//           uint32 output_size, uint32 stdout_size, uint32 stderr_size, followed by the three payloads
+// All integers are in native byte order. The input and output files are in-memory files reopened through
+// /proc/self/fd by the wrapper's main, so nothing touches the filesystem.
+static int serve(char *program, int request_fd, int response_fd) {
+    int input_fd = make_anonymous_file();
+    int output_fd = make_anonymous_file();
+    int stdout_fd = make_anonymous_file();
+    int stderr_fd = make_anonymous_file();
+    if (input_fd < 0 || output_fd < 0 || stdout_fd < 0 || stderr_fd < 0) {
+        perror("exebench driver");
+        return 2;
+    }
+    char input_path[64], output_path[64];
+    snprintf(input_path, sizeof(input_path), "/proc/self/fd/%d", input_fd);
+    snprintf(output_path, sizeof(output_path), "/proc/self/fd/%d", output_fd);
+    size_t buffer_size = 1 << 16;
+    char *buffer = (char *) malloc(buffer_size);
+    uint32_t header[2];
+    while (read_exact(request_fd, header, sizeof(header))) {
+        uint32_t timeout_ms = header[0], input_size = header[1];
+        reset_file(input_fd);
+        reset_file(output_fd);
+        reset_file(stdout_fd);
+        reset_file(stderr_fd);
+        while (input_size > 0) {
+            size_t chunk = input_size < buffer_size ? input_size : buffer_size;
+            if (!read_exact(request_fd, buffer, chunk) || !write_exact(input_fd, buffer, chunk)) {
+                return 2;
+            }
+            input_size -= chunk;
+        }
+        int fds_to_close[] = {request_fd, response_fd};
+        int wstatus = run_child(program, input_path, output_path, stdout_fd, stderr_fd, timeout_ms, fds_to_close, 2);
+        int32_t status[2];
+        status[0] = WIFSIGNALED(wstatus) ? 1 : 0;
+        status[1] = WIFSIGNALED(wstatus) ? WTERMSIG(wstatus) : WEXITSTATUS(wstatus);
+        uint32_t sizes[3] = {file_size(output_fd), file_size(stdout_fd), file_size(stderr_fd)};
+        if (!write_exact(response_fd, status, sizeof(status)) || !write_exact(response_fd, sizes, sizeof(sizes)) ||
+            !send_file(response_fd, output_fd, sizes[0], buffer, buffer_size) ||
+            !send_file(response_fd, stdout_fd, sizes[1], buffer, buffer_size) ||
+            !send_file(response_fd, stderr_fd, sizes[2], buffer, buffer_size)) {
+            return 2;
+        }
+    }
+    free(buffer);
+    return 0;
+}
+
+int main(int argc, char **argv) {
+    if (argc == 5 && strcmp(argv[1], "--exebench-batch") == 0) {
+        return run_batch(argv[0], argv[2], argv[3], (unsigned) atoi(argv[4]));
+    }
+    if (argc == 4 && strcmp(argv[1], "--exebench-serve") == 0) {
+        signal(SIGPIPE, SIG_IGN);
+        return serve(argv[0], atoi(argv[2]), atoi(argv[3]));
+    }
+    if (argc == 6 && strcmp(argv[1], "--exebench-measure") == 0) {
+        return measure(argv[0], (unsigned) atoi(argv[2]), (unsigned) atoi(argv[3]), argv[4], argv[5]);
+    }
+    return exebench_wrapper_main(argc, argv);
+}
@@ -0,0 +1,3 @@
+#include "exebench_json.hpp"
+
+EXEBENCH_JSON_TEMPLATES()
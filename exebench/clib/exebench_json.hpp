@@ -0,0 +1,22 @@
+// Header precompiled once per installation/compiler and force-included in every wrapper, so that per-row
+// compilations neither re-parse nlohmann/json.hpp nor re-instantiate its templates. The explicit instantiations
+// live in exebench_json.cpp, which is compiled once and linked into every executable.
+#ifndef EXEBENCH_JSON_HPP
+#define EXEBENCH_JSON_HPP
+
+#include <nlohmann/json.hpp>
+
+#define EXEBENCH_JSON_TEMPLATES(EXTERN) \
+    EXTERN template class nlohmann::basic_json<>; \
+    EXTERN template class nlohmann::detail::iter_impl<const nlohmann::json>; \
+    EXTERN template class nlohmann::detail::serializer<nlohmann::json>; \
+    EXTERN template class nlohmann::detail::lexer<nlohmann::json, nlohmann::detail::input_stream_adapter>; \
+    EXTERN template class nlohmann::detail::parser<nlohmann::json, nlohmann::detail::input_stream_adapter>; \
+    EXTERN template class nlohmann::detail::json_sax_dom_parser<nlohmann::json>; \
+    EXTERN template class nlohmann::detail::json_sax_dom_callback_parser<nlohmann::json>; \
+    EXTERN template class std::vector<nlohmann::json>; \
+    EXTERN template class std::map<std::string, nlohmann::json, std::less<>>;
+
+EXEBENCH_JSON_TEMPLATES(extern)
+
+#endif
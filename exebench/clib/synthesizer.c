@@ -1,29 +1,105 @@
+// For posix_memalign
+#define _POSIX_C_SOURCE 200112L
 #include <stddef.h>
 #include <stdint.h> // TODO -- this may not be enough on some platforms for uintptr?  Can we just use long long safetly?
 #include <stdlib.h>
 #include "synthesizer.h"
 
-// We need to keep track of the differences that are 
-// added to each pointer to align them so we can 
-// free them properly.
-
-// Fortunately, this is easier to write than
-// it might otherwise be because if an accelerator
-// has N malloc-able arguments, then the most we
-// are going to be malloc-ing is N + 1 (for the
-// return value.  FFTs tend to have two (in and out)
-// but four is not implausible (in real, out real,
-// in imag, out imag).  Anyway, so we'll just
-// support like 8 for now, and segfault if there
-// are more.
+// Aligned allocations.  Power-of-two alignments (the
+// usual case) come straight from posix_memalign, so
+// they can be released with plain free and need no
+// bookkeeping.  Other alignments are served by
+// over-allocating with malloc, and the original pointer
+// is kept in a hash table keyed by the returned one so
+// that facc_free can find it in O(1).  The table grows
+// as needed, so there's no limit on the number of live
+// allocations (FFT harnesses can have many buffers).
 
+// Number of allocations currently in the table.
 int facc_malloc_count = 0;
 typedef struct {
-	uintptr_t returned;
+	uintptr_t returned; // 0 if the slot is empty
 	uintptr_t original;
 } pointer_map_pair;
 
-pointer_map_pair pointer_map[8];
+static pointer_map_pair *pointer_map = NULL;
+static size_t pointer_map_capacity = 0; // Always a power of two
+
+static size_t pointer_map_slot(uintptr_t returned) {
+	// Fibonacci hashing, the low bits of pointers are
+	// mostly zero.
+	return (size_t) (((uint64_t) returned * 11400714819323198485ull) >> 32) & (pointer_map_capacity - 1);
+}
+
+static void pointer_map_insert(uintptr_t returned, uintptr_t original) {
+	size_t i = pointer_map_slot(returned);
+	while (pointer_map[i].returned != 0) {
+		i = (i + 1) & (pointer_map_capacity - 1);
+	}
+	pointer_map[i].returned = returned;
+	pointer_map[i].original = original;
+}
+
+// Keeps the load factor under 1/2.  Returns 0 if out of
+// memory.
+static int pointer_map_reserve(void) {
+	if (2 * (size_t) (facc_malloc_count + 1) <= pointer_map_capacity) {
+		return 1;
+	}
+	pointer_map_pair *old_map = pointer_map;
+	size_t old_capacity = pointer_map_capacity;
+	size_t capacity = old_capacity ? 2 * old_capacity : 64;
+	pointer_map_pair *map = (pointer_map_pair *) calloc(capacity, sizeof(pointer_map_pair));
+	if (map == NULL) {
+		return 0;
+	}
+	pointer_map = map;
+	pointer_map_capacity = capacity;
+	for (size_t i = 0; i < old_capacity; i ++) {
+		if (old_map[i].returned != 0) {
+			pointer_map_insert(old_map[i].returned, old_map[i].original);
+		}
+	}
+	free(old_map);
+	return 1;
+}
+
+// Removes returned from the table, and gives back its
+// original pointer (0 if it isn't there).
+static uintptr_t pointer_map_remove(uintptr_t returned) {
+	if (facc_malloc_count == 0) {
+		return 0;
+	}
+	size_t i = pointer_map_slot(returned);
+	while (pointer_map[i].returned != returned) {
+		if (pointer_map[i].returned == 0) {
+			return 0;
+		}
+		i = (i + 1) & (pointer_map_capacity - 1);
+	}
+	uintptr_t original = pointer_map[i].original;
+
+	// Shift back the entries of the probe chain that
+	// follows, so lookups never need tombstones.
+	size_t hole = i;
+	size_t j = i;
+	while (1) {
+		j = (j + 1) & (pointer_map_capacity - 1);
+		if (pointer_map[j].returned == 0) {
+			break;
+		}
+		size_t home = pointer_map_slot(pointer_map[j].returned);
+		// Move j into the hole unless its home slot is
+		// cyclically in (hole, j].
+		if (((j - home) & (pointer_map_capacity - 1)) >= ((j - hole) & (pointer_map_capacity - 1))) {
+			pointer_map[hole] = pointer_map[j];
+			hole = j;
+		}
+	}
+	pointer_map[hole].returned = 0;
+	facc_malloc_count --;
+	return original;
+}
 
 // An aligned malloc and free function.
 // Note that if an aligned malloc escapes the
@@ -31,42 +107,39 @@ pointer_map_pair pointer_map[8];
 // reachable by that pointer must be replaced with
 // facc_free.
 void *facc_malloc(size_t alignment, size_t size) {
-	char* ptr = (char*) malloc(size + alignment);
+	if (alignment <= 1) {
+		return malloc(size);
+	}
 
-	uintptr_t original_pointer = (uintptr_t) ptr;
-	uintptr_t offset_pointer = original_pointer;
-	if (alignment != 0) {
-		offset_pointer += (original_pointer % alignment);
-		// If the offset is zero, we don't have to use
-		// the facc malloc.  Really, we should do
-		// this statically in FACC (i.e. turn into a normal
-		// malloc)
-		pointer_map[facc_malloc_count].original = original_pointer;
-		pointer_map[facc_malloc_count].returned = offset_pointer;
-		facc_malloc_count += 1;
+	if (POWER_OF_TWO(alignment)) {
+		void *ptr = NULL;
+		if (alignment < sizeof(void *)) {
+			alignment = sizeof(void *);
+		}
+		if (posix_memalign(&ptr, alignment, size == 0 ? 1 : size) != 0) {
+			return NULL;
+		}
+		return ptr;
+	}
+
+	if (!pointer_map_reserve()) {
+		return NULL;
+	}
+	char* ptr = (char*) malloc(size + alignment);
+	if (ptr == NULL) {
+		return NULL;
 	}
+	uintptr_t original_pointer = (uintptr_t) ptr;
+	uintptr_t offset_pointer = original_pointer + (alignment - original_pointer % alignment) % alignment;
+	pointer_map_insert(offset_pointer, original_pointer);
+	facc_malloc_count += 1;
 
 	return (void*) offset_pointer;
 }
 
-// This could really be much more efficient IMO.
 void facc_free(void* pointer) {
-	uintptr_t pointer_value = (uintptr_t) pointer;
-	for (int i = 0; i < facc_malloc_count; i ++) {
-		if (pointer_map[i].returned == pointer_value) {
-			free((void *) pointer_map[i].original);
-
-			// Shuffle everyting back down
-			for (int j = i; j < facc_malloc_count - 1; j ++) {
-				pointer_map[j] = pointer_map[j + 1];
-			}
-
-			facc_malloc_count --;
-			return;
-		}
-	}
-
-	free(pointer);
+	uintptr_t original = pointer_map_remove((uintptr_t) pointer);
+	free(original != 0 ? (void *) original : pointer);
 }
 
 void facc_strcopy(char *str_in, char *str_out) {
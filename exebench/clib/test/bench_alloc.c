@@ -0,0 +1,77 @@
+#include <assert.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+#include "../synthesizer.h"
+
+// Stress test and benchmark of facc_malloc/facc_free: many
+// cycles of allocating and freeing buffers (in random order)
+// with a mix of power-of-two and other alignments, and up to
+// MAX_LIVE live at once.  Each buffer is filled and checked
+// before being freed, to catch overlapping allocations.
+
+// Defined in synthesizer.c: allocations it is tracking.
+extern int facc_malloc_count;
+
+#define MAX_LIVE 4096
+#define CYCLES 2000000
+
+static const size_t alignments[] = {0, 1, 8, 16, 32, 64, 4096, 12, 24, 48};
+
+typedef struct {
+	unsigned char *ptr;
+	size_t size;
+	unsigned char fill;
+} live_buffer;
+
+static live_buffer live[MAX_LIVE];
+
+static uint64_t rng_state = 88172645463325252ull;
+
+static uint64_t next_random() {
+	rng_state ^= rng_state << 13;
+	rng_state ^= rng_state >> 7;
+	rng_state ^= rng_state << 17;
+	return rng_state;
+}
+
+static void check_and_free(live_buffer *buffer) {
+	for (size_t i = 0; i < buffer->size; i ++) {
+		assert(buffer->ptr[i] == buffer->fill);
+	}
+	facc_free(buffer->ptr);
+	buffer->ptr = NULL;
+}
+
+int main() {
+	struct timespec start, end;
+	clock_gettime(CLOCK_MONOTONIC, &start);
+
+	for (long cycle = 0; cycle < CYCLES; cycle ++) {
+		live_buffer *buffer = &live[next_random() % MAX_LIVE];
+		if (buffer->ptr != NULL) {
+			check_and_free(buffer);
+			continue;
+		}
+		size_t alignment = alignments[next_random() % (sizeof(alignments) / sizeof(alignments[0]))];
+		buffer->size = next_random() % 256;
+		buffer->fill = (unsigned char) cycle;
+		buffer->ptr = (unsigned char *) facc_malloc(alignment, buffer->size);
+		assert(buffer->ptr != NULL);
+		if (alignment != 0) {
+			assert((uintptr_t) buffer->ptr % alignment == 0);
+		}
+		memset(buffer->ptr, buffer->fill, buffer->size);
+	}
+	for (int i = 0; i < MAX_LIVE; i ++) {
+		if (live[i].ptr != NULL) {
+			check_and_free(&live[i]);
+		}
+	}
+	assert(facc_malloc_count == 0);
+
+	clock_gettime(CLOCK_MONOTONIC, &end);
+	double seconds = (end.tv_sec - start.tv_sec) + (end.tv_nsec - start.tv_nsec) / 1e9;
+	printf("%d alloc/free cycles in %.3fs (%.1f ns per operation)\n", CYCLES, seconds, seconds * 1e9 / CYCLES);
+}
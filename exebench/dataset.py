@@ -0,0 +1,137 @@
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import tarfile
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+# Streaming reader for the raw dataset files (see "Option 3" in the README): TAR archives of zstandard-compressed
+# JSON lines. Rows are decompressed and parsed on the fly, so memory stays bounded whatever the size of the split.
+
+_BATCH_SIZE = 256  # rows per message between shard readers and the consumer
+_QUEUE_SIZE_PER_WORKER = 4  # batches
+_READER_POLL_INTERVAL = 1.0  # seconds between checks that the readers are still alive while waiting for rows
+
+
+def _iter_jsonl_zst(fileobj, fields: Optional[Sequence[str]]) -> Iterator[Dict]:
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('Reading the raw dataset files needs the zstandard package (pip install zstandard)') from e
+    reader = zstandard.ZstdDecompressor().stream_reader(fileobj)
+    for line in io.TextIOWrapper(reader, encoding='utf-8'):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        yield row if fields is None else {field: row[field] for field in fields}
+
+
+def iter_shard(path: str, fields: Optional[Sequence[str]] = None) -> Iterator[Dict]:
+    # A shard is either a TAR of .zst JSON lines files or a single .zst JSON lines file
+    if path.endswith('.zst'):
+        with open(path, 'rb') as f:
+            yield from _iter_jsonl_zst(f, fields)
+        return
+    with tarfile.open(path, 'r|*') as tar:  # stream mode: members are read sequentially, without seeking
+        for member in tar:
+            if member.isfile() and member.name.endswith('.zst'):
+                yield from _iter_jsonl_zst(tar.extractfile(member), fields)
+
+
+def list_shards(paths: Iterable[str]) -> List[str]:
+    shards = []
+    for path in paths:
+        if not os.path.isdir(path):
+            shards.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            shards.extend(os.path.join(root, name) for name in files if name.endswith(('.tar', '.zst')))
+    return sorted(shards)
+
+
+def _read_shards(shards: List[str], fields: Optional[Sequence[str]], queue):
+    try:
+        batch = []
+        for shard in shards:
+            for row in iter_shard(shard, fields):
+                batch.append(row)
+                if len(batch) == _BATCH_SIZE:
+                    queue.put(batch)
+                    batch = []
+        if batch:
+            queue.put(batch)
+    except Exception as e:
+        queue.put(e)
+    finally:
+        queue.put(None)  # done
+
+
+def iter_rows(paths: Iterable[str], fields: Optional[Sequence[str]] = None, workers: int = 1) -> Iterator[Dict]:
+    # Yields the rows of the given shards (or directories of shards). With fields, only those keys are kept.
+    # With workers > 1, shards are read in parallel by that many processes and rows arrive interleaved.
+    shards = list_shards(paths)
+    if workers <= 1 or len(shards) <= 1:
+        for shard in shards:
+            yield from iter_shard(shard, fields)
+        return
+
+    workers = min(workers, len(shards))
+    queue = multiprocessing.Queue(maxsize=workers * _QUEUE_SIZE_PER_WORKER)
+    processes = [multiprocessing.Process(target=_read_shards, args=(shards[i::workers], fields, queue), daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        running = workers
+        while running:
+            try:
+                batch = queue.get(timeout=_READER_POLL_INTERVAL)
+            except queue_module.Empty:
+                # A reader that died (e.g. killed when out of memory) never sends its sentinel
+                for process in processes:
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError(f'Shard reader {process.pid} exited with code {process.exitcode}')
+                if not any(process.is_alive() for process in processes) and queue.empty():
+                    raise RuntimeError('Shard readers exited before sending all their rows')
+                continue
+            if batch is None:
+                running -= 1
+            elif isinstance(batch, Exception):
+                raise batch
+            else:
+                yield from batch
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def add_source_arguments(parser: argparse.ArgumentParser):
+    # Command line options to pick where rows come from, see load_rows
+    parser.add_argument('--split', default='test_synth', help='Split to load from the Hugging Face hub')
+    parser.add_argument('--jsonl', help='Read rows from a local JSON lines file instead of the Hugging Face hub')
+    parser.add_argument('--shards', nargs='+', help='Read rows from raw dataset files (TARs of .jsonl.zst files, '
+                                                    'or directories of them) instead of the Hugging Face hub')
+    parser.add_argument('--reader-workers', type=int, default=1, help='Processes reading --shards in parallel')
+    parser.add_argument('--limit', type=int, help='Only read the first LIMIT rows')
+
+
+def load_rows(args: argparse.Namespace) -> Iterator[Dict]:
+    if args.shards:
+        rows = iter_rows(args.shards, workers=args.reader_workers)
+    elif args.jsonl:
+        rows = _iter_jsonl(args.jsonl)
+    else:
+        from datasets import load_dataset
+        rows = iter(load_dataset('jordiae/exebench', split=args.split))
+    return itertools.islice(rows, args.limit)
+
+
+def _iter_jsonl(path: str) -> Iterator[Dict]:
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,406 @@
+import argparse
+import array
+import bisect
+import collections
+import hashlib
+import heapq
+import json
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from exebench.journal import row_id
+
+# Index of the func_def of a split, to find the rows of another split (e.g. a train shard) that duplicate some of
+# its rows, at two levels:
+#  - exact: same func_def once comments are removed and whitespace is ignored (compared by a 64-bit hash)
+#  - near: MinHash over shingles of consecutive tokens, with LSH banding to find candidates, which are kept if the
+#    estimated Jaccard similarity of their shingles is at least the threshold
+# The signature is computed with one permutation hashing (each shingle is hashed once, into one of num_perm bins),
+# with empty bins filled from their neighbours (densification), so it costs one hash per shingle.
+#
+# Layout of an index directory:
+#  - meta.json: parameters and number of rows
+#  - rows.bin: per row, in order: row id (see exebench.journal.row_id), exact hash, then the signature
+#    (num_perm uint32)
+#  - names.jsonl: [path, fname] of each row
+#  - exact.keys / exact.rows, bands.keys / bands.rows: sorted uint64 keys (exact hash, hash of an LSH band) and
+#    the row each one comes from, searched by bisection on the memory mapped keys
+# Integers are in native byte order (the index records which one). Building sorts the keys in runs of bounded size
+# merged at the end, so memory stays bounded whatever the number of rows.
+
+_FORMAT_VERSION = 1
+_ROW_HEADER = struct.Struct('=QQ')
+_RUN_SIZE = 1 << 20  # keys sorted in memory at a time
+_BATCH_SIZE = 256  # rows per task of the worker processes
+_MASK64 = (1 << 64) - 1
+
+_TOKEN = re.compile(r'''
+    "(?:\\.|[^"\\\n])*"          # string literal
+  | '(?:\\.|[^'\\\n])*'          # char literal
+  | //[^\n]*                     # line comment
+  | /\*.*?(?:\*/|\Z)             # block comment
+  | [A-Za-z_]\w*                 # identifier or keyword
+  | \.?\d(?:[eEpP][+-]|[\w.])*   # number
+  | \S                           # anything else, one character at a time
+''', re.VERBOSE | re.DOTALL)
+
+
+def tokenize(func_def: str) -> List[str]:
+    # Tokens of C code, without comments
+    return [token for token in _TOKEN.findall(func_def) if not token.startswith(('//', '/*'))]
+
+
+def normalize(func_def: str) -> str:
+    # Same for any two func_defs that only differ in comments and whitespace (outside of literals)
+    return ' '.join(tokenize(func_def))
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def exact_hash(func_def: str) -> int:
+    return _hash64(normalize(func_def).encode('utf-8'))
+
+
+def _mix64(x: int) -> int:
+    # splitmix64 finalizer
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK64
+    return x ^ (x >> 31)
+
+
+def minhash(tokens: List[str], num_perm: int = 128, shingle: int = 3) -> Optional[List[int]]:
+    # MinHash signature (num_perm uint32) of the shingles of tokens, None without tokens. num_perm must be a power
+    # of two.
+    if not tokens:
+        return None
+    token_hashes = [zlib.crc32(token.encode('utf-8')) for token in tokens]
+    hashes = token_hashes
+    for k in range(1, min(shingle, len(tokens))):  # hashes of the shingles of k + 1 tokens
+        hashes = [h * 0x100000001B3 + token_hash for h, token_hash in zip(hashes, token_hashes[k:])]
+    bits = num_perm.bit_length() - 1
+    bins = [None] * num_perm
+    for h in hashes:
+        h = _mix64(h & _MASK64)
+        slot, value = h & (num_perm - 1), h >> bits
+        if bins[slot] is None or value < bins[slot]:
+            bins[slot] = value
+    # Densification: an empty bin takes the value of the next non-empty one (circularly), mixed with the distance
+    signature = [0] * num_perm
+    nxt = next(slot for slot in range(num_perm) if bins[slot] is not None) + num_perm
+    for slot in range(num_perm - 1, -1, -1):
+        if bins[slot] is not None:
+            nxt = slot
+            signature[slot] = bins[slot] & 0xFFFFFFFF
+        else:
+            distance = (nxt - slot) % num_perm
+            signature[slot] = _mix64(bins[nxt % num_perm] + distance) & 0xFFFFFFFF
+    return signature
+
+
+def band_keys(signature: List[int], bands: int) -> List[int]:
+    # One key per LSH band: rows sharing any of them are candidate near duplicates. Bands take every bands-th value
+    # rather than consecutive ones, which densification makes correlated (a band of copies of the same few values
+    # would match far too often).
+    rows = len(signature) // bands
+    return [_hash64(struct.pack(f'=H{rows}I', band, *signature[band::bands])) for band in range(bands)]
+
+
+def similarity(signature_a, signature_b) -> float:
+    # Estimated Jaccard similarity of the shingles
+    return sum(map(operator.eq, signature_a, signature_b)) / len(signature_a)
+
+
+@dataclass
+class _Sketch:
+    row_id: int
+    exact: int
+    signature: Optional[List[int]]
+    bands: List[int]
+    path: str
+    fname: str
+
+
+def _sketch(row: Dict, num_perm: int, bands: int, shingle: int) -> _Sketch:
+    tokens = tokenize(row['func_def'])
+    signature = minhash(tokens, num_perm, shingle)
+    return _Sketch(row_id(row) if 'path' in row and 'fname' in row else 0, _hash64(' '.join(tokens).encode('utf-8')),
+                   signature, band_keys(signature, bands) if signature is not None else [], row.get('path', ''),
+                   row.get('fname', ''))
+
+
+def _sketch_batch(batch: List[Dict], num_perm: int, bands: int, shingle: int) -> List[_Sketch]:
+    return [_sketch(row, num_perm, bands, shingle) for row in batch]
+
+
+def _batches(rows: Iterable[Dict], fields=('path', 'fname', 'func_def')) -> Iterator[List[Dict]]:
+    batch = []
+    for row in rows:
+        batch.append({field: row[field] for field in fields if field in row})
+        if len(batch) == _BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _map_batches(fn, batches: Iterator, workers: int, *args) -> Iterator:
+    # fn(batch, *args) for each batch, in order, with at most 2 * workers batches in flight
+    if workers <= 1:
+        for batch in batches:
+            yield fn(batch, *args)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.submit(fn, batch, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _SortedRuns:
+    # (key, row) pairs sorted with bounded memory: sorted runs spilled to temporary files, merged at the end
+    def __init__(self, tmp_dir: str, name: str):
+        self._tmp_dir = tmp_dir
+        self._name = name
+        self._entries = []
+        self._runs = []
+
+    def add(self, key: int, row: int):
+        self._entries.append(key << 64 | row)  # a single int sorts faster than a tuple
+        if len(self._entries) >= _RUN_SIZE:
+            self._spill()
+
+    def _spill(self):
+        self._entries.sort()
+        path = os.path.join(self._tmp_dir, f'{self._name}.{len(self._runs)}')
+        with open(path, 'wb') as f:
+            array.array('Q', (x for entry in self._entries for x in (entry >> 64, entry & _MASK64))).tofile(f)
+        self._runs.append(path)
+        self._entries = []
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[int]:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = array.array('Q')
+                chunk.frombytes(f.read(1 << 20))
+                if not chunk:
+                    return
+                for i in range(0, len(chunk), 2):
+                    yield chunk[i] << 64 | chunk[i + 1]
+
+    def write(self, keys_path: str, rows_path: str):
+        if self._entries or not self._runs:
+            self._spill()
+        with open(keys_path, 'wb') as keys_file, open(rows_path, 'wb') as rows_file:
+            keys, rows = array.array('Q'), array.array('Q')
+            for entry in heapq.merge(*(self._read_run(path) for path in self._runs)):
+                keys.append(entry >> 64)
+                rows.append(entry & _MASK64)
+                if len(keys) >= _RUN_SIZE:
+                    keys.tofile(keys_file)
+                    rows.tofile(rows_file)
+                    keys, rows = array.array('Q'), array.array('Q')
+            keys.tofile(keys_file)
+            rows.tofile(rows_file)
+        for path in self._runs:
+            os.remove(path)
+
+
+def build(rows: Iterable[Dict], path: str, num_perm: int = 128, bands: int = 16, shingle: int = 3,
+          workers: int = 1) -> int:
+    # Indexes the func_def of the rows into a new index at path and returns the number of rows. With workers > 1,
+    # the rows are tokenized and hashed by that many processes.
+    if num_perm & (num_perm - 1) or num_perm % bands:
+        raise ValueError('num_perm must be a power of two and a multiple of bands')
+    os.makedirs(path, exist_ok=True)
+    n_rows = 0
+    with tempfile.TemporaryDirectory(dir=path) as tmp_dir, \
+            open(os.path.join(path, 'rows.bin'), 'wb') as rows_file, \
+            open(os.path.join(path, 'names.jsonl'), 'w') as names_file:
+        exact_runs, band_runs = _SortedRuns(tmp_dir, 'exact'), _SortedRuns(tmp_dir, 'bands')
+        for sketches in _map_batches(_sketch_batch, _batches(rows), workers, num_perm, bands, shingle):
+            for sketch in sketches:
+                rows_file.write(_ROW_HEADER.pack(sketch.row_id, sketch.exact))
+                array.array('I', sketch.signature or [0] * num_perm).tofile(rows_file)
+                names_file.write(json.dumps([sketch.path, sketch.fname]) + '\n')
+                exact_runs.add(sketch.exact, n_rows)
+                for key in sketch.bands:
+                    band_runs.add(key, n_rows)
+                n_rows += 1
+        exact_runs.write(os.path.join(path, 'exact.keys'), os.path.join(path, 'exact.rows'))
+        band_runs.write(os.path.join(path, 'bands.keys'), os.path.join(path, 'bands.rows'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(dict(version=_FORMAT_VERSION, n_rows=n_rows, num_perm=num_perm, bands=bands, shingle=shingle,
+                       byteorder=sys.byteorder), f)
+    return n_rows
+
+
+def _map(path: str) -> Optional[mmap.mmap]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None  # can't map empty files
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@dataclass
+class Match:
+    row: int  # position in the index
+    similarity: float  # estimated Jaccard similarity of the shingles (1.0 for exact matches)
+    exact: bool
+
+
+class DuplicateIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != _FORMAT_VERSION or meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'Unsupported index at {path}')
+        self.n_rows, self.num_perm, self.bands, self.shingle = \
+            meta['n_rows'], meta['num_perm'], meta['bands'], meta['shingle']
+        self._record_size = _ROW_HEADER.size + 4 * self.num_perm
+        self._maps = {name: _map(os.path.join(path, name))
+                      for name in ['rows.bin', 'exact.keys', 'exact.rows', 'bands.keys', 'bands.rows']}
+        self._names = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def _view(self, name: str, typecode: str = 'Q'):
+        mapped = self._maps[name]
+        return memoryview(mapped).cast(typecode) if mapped is not None else memoryview(b'').cast(typecode)
+
+    def _lookup(self, name: str, key: int) -> List[int]:
+        keys, rows = self._view(f'{name}.keys'), self._view(f'{name}.rows')
+        try:
+            i = bisect.bisect_left(keys, key)
+            matches = []
+            while i < len(keys) and keys[i] == key:
+                matches.append(rows[i])
+                i += 1
+            return matches
+        finally:
+            keys.release()
+            rows.release()
+
+    def signature(self, row: int) -> Tuple[int, ...]:
+        start = row * self._record_size + _ROW_HEADER.size
+        return struct.unpack_from(f'={self.num_perm}I', self._maps['rows.bin'], start)
+
+    def row_id(self, row: int) -> int:
+        return _ROW_HEADER.unpack_from(self._maps['rows.bin'], row * self._record_size)[0]
+
+    def name(self, row: int) -> Tuple[str, str]:
+        # (path, fname) of a row
+        if self._names is None:
+            with open(os.path.join(self.path, 'names.jsonl')) as f:
+                self._names = [tuple(json.loads(line)) for line in f]
+        return self._names[row]
+
+    def _matches(self, sketch: _Sketch, threshold: float) -> List[Match]:
+        exact = set(self._lookup('exact', sketch.exact))
+        matches = {row: Match(row, 1.0, True) for row in exact}
+        if sketch.signature is not None and threshold <= 1.0:
+            candidates = {row for key in sketch.bands for row in self._lookup('bands', key)} - exact
+            for row in candidates:
+                estimate = similarity(sketch.signature, self.signature(row))
+                if estimate >= threshold:
+                    matches[row] = Match(row, estimate, False)
+        return sorted(matches.values(), key=lambda match: (-match.similarity, match.row))
+
+    def find(self, func_def: str, threshold: float = 0.8) -> List[Match]:
+        # Rows of the index duplicating func_def: exactly, or with an estimated similarity of at least threshold
+        # (above 1, only exact duplicates)
+        return self._matches(_sketch({'func_def': func_def}, self.num_perm, self.bands, self.shingle), threshold)
+
+    def overlap(self, rows: Iterable[Dict], threshold: float = 0.8, workers: int = 1) -> Iterator[Tuple[Dict, List[Match]]]:
+        # (path and fname of the row, matches) for each of the rows (e.g. a train shard) duplicating rows of the
+        # index, in order. With workers > 1, the rows are processed by that many processes.
+        for results in _map_batches(_overlap_batch, _batches(rows), workers, self.path, threshold):
+            yield from results
+
+    def close(self):
+        for mapped in self._maps.values():
+            if mapped is not None:
+                mapped.close()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_open_indexes = {}  # per process, for the workers of DuplicateIndex.overlap
+
+
+def _overlap_batch(batch: List[Dict], path: str, threshold: float) -> List[Tuple[Dict, List[Match]]]:
+    if path not in _open_indexes:
+        _open_indexes[path] = DuplicateIndex(path)
+    index = _open_indexes[path]
+    results = []
+    for row in batch:
+        matches = index._matches(_sketch(row, index.num_perm, index.bands, index.shingle), threshold)
+        if matches:
+            results.append(({'path': row.get('path', ''), 'fname': row.get('fname', '')}, matches))
+    return results
+
+
+def main():
+    from exebench.dataset import add_source_arguments, load_rows
+
+    parser = argparse.ArgumentParser(description='Find exact and near duplicate functions across ExeBench splits')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Index the functions of a split (e.g. test_synth)')
+    add_source_arguments(build_parser)
+    build_parser.add_argument('output', help='Directory of the new index')
+    build_parser.add_argument('--num-perm', type=int, default=128, help='MinHash signature size (a power of two)')
+    build_parser.add_argument('--bands', type=int, default=16, help='LSH bands (more: more candidates)')
+    build_parser.add_argument('--shingle', type=int, default=3, help='Tokens per shingle')
+    build_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    query_parser = subparsers.add_parser('query', help='Print the rows of a split (e.g. a train shard) that '
+                                                       'duplicate rows of the index, as JSON lines')
+    add_source_arguments(query_parser)
+    query_parser.add_argument('index', help='Directory of the index')
+    query_parser.add_argument('--threshold', type=float, default=0.8,
+                              help='Minimum estimated Jaccard similarity of near duplicates (above 1: exact only)')
+    query_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        n_rows = build(load_rows(args), args.output, num_perm=args.num_perm, bands=args.bands, shingle=args.shingle,
+                       workers=args.workers)
+        print(f'{n_rows} rows indexed in {args.output} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+        return
+
+    overlapping = exact = 0
+    with DuplicateIndex(args.index) as index:
+        for row, matches in index.overlap(load_rows(args), threshold=args.threshold, workers=args.workers):
+            overlapping += 1
+            exact += any(match.exact for match in matches)
+            print(json.dumps(dict(row, matches=[dict(zip(['path', 'fname'], index.name(match.row)),
+                                                     row=match.row, similarity=match.similarity, exact=match.exact)
+                                                for match in matches])))
+    print(f'{overlapping} overlapping rows ({exact} exact duplicates) in {time.perf_counter() - start:.1f}s',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
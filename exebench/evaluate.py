@@ -0,0 +1,252 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, asdict, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from exebench import Wrapper, diff_io_batch, exebench_io_pairs_to_dicts, ExecutionError, ExecutionTimeout, \
+    ResourceLimits, TimeoutCalibrator, TimeoutPolicy, configure_workspace, _DEFAULT_CMD_TIMEOUT, _error_class
+from exebench.journal import Journal, candidate_id, parse_shard, row_id, shard_of
+
+# Parallel evaluation of a split: rows are compiled and run across a pool of worker processes. Compilation and
+# execution are separate tasks, so that the pool overlaps the compilation of some rows with the execution of others.
+# A split can be sharded across nodes (by hash of each row), and with a journal (see exebench.journal), rows already
+# evaluated are skipped, so that a run can be resumed after a failure.
+
+
+@dataclass
+class RowResult:
+    index: int
+    fname: str
+    compiled: bool
+    passed: List[bool] = field(default_factory=list)
+    error: Optional[str] = None
+    compile_time: float = 0.0
+    run_time: float = 0.0
+    error_class: str = 'none'  # see exebench.journal.ERROR_CLASSES
+    row_id: int = 0
+    candidate_id: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.compiled and len(self.passed) > 0 and all(self.passed)
+
+    def dict(self):
+        return dict(asdict(self), ok=self.ok)
+
+
+def reference_assembly(row) -> str:
+    return row['asm']['code'][0]  # angha_gcc_x86_O0
+
+
+def row_wrapper_kwargs(row, func_assembly, io_kind='synth') -> Dict:
+    return dict(c_deps=row[f'{io_kind}_deps'] + '\n' + row[f'{io_kind}_io_pairs']['dummy_funcs'][0] + '\n',
+                func_c_signature=row['func_head_types'].replace('extern', ''), func_assembly=func_assembly,
+                cpp_wrapper=row[f'{io_kind}_exe_wrapper'])
+
+
+def row_io_pairs(row, io_kind='synth'):
+    return exebench_io_pairs_to_dicts(row[f'{io_kind}_io_pairs'])
+
+
+def calibrated_timeout(row, calibrator: TimeoutCalibrator, io_kind='synth') -> Optional[float]:
+    # Timeout for candidates of this row, from its reference assembly
+    return calibrator.timeout(**row_wrapper_kwargs(row, reference_assembly(row), io_kind),
+                              inputs=[inp for inp, _ in row_io_pairs(row, io_kind)])
+
+
+@dataclass
+class _Task:
+    index: int
+    fname: str
+    wrapper_kwargs: Dict
+    io_pairs: List
+    wrapper: Optional[Wrapper] = None
+    compile_time: float = 0.0
+    timeout_policy: Optional[TimeoutPolicy] = None
+    reference_kwargs: Optional[Dict] = None
+    row_id: int = 0
+    candidate_id: int = 0
+
+
+_calibrators = {}  # TimeoutPolicy -> TimeoutCalibrator, per worker process
+
+
+def _calibrator(policy: TimeoutPolicy) -> TimeoutCalibrator:
+    if policy not in _calibrators:
+        _calibrators[policy] = TimeoutCalibrator(policy)
+    return _calibrators[policy]
+
+
+def _compile_stage(task: _Task):
+    start = time.perf_counter()
+    try:
+        if task.timeout_policy is not None:
+            task.wrapper_kwargs['timeout'] = _calibrator(task.timeout_policy).timeout(
+                **task.reference_kwargs, inputs=[inp for inp, _ in task.io_pairs])
+        task.wrapper = Wrapper(**task.wrapper_kwargs)
+    except Exception as e:
+        return RowResult(index=task.index, fname=task.fname, compiled=False, error=repr(e),
+                         compile_time=time.perf_counter() - start, error_class='exception', row_id=task.row_id,
+                         candidate_id=task.candidate_id)
+    task.compile_time = time.perf_counter() - start
+    if os.path.getsize(task.wrapper._compiled_exe_path) == 0:
+        task.wrapper.close()
+        return RowResult(index=task.index, fname=task.fname, compiled=False, error='Compilation failed',
+                         compile_time=task.compile_time, error_class='compile_error', row_id=task.row_id,
+                         candidate_id=task.candidate_id)
+    task.wrapper_kwargs = task.reference_kwargs = None  # no need to send them back and forth
+    return task
+
+
+def _run_stage(task: _Task, timeout):
+    start = time.perf_counter()
+    try:
+        outputs = task.wrapper.run_many([inp for inp, _ in task.io_pairs],
+                                        timeout=timeout if task.timeout_policy is None else task.wrapper.timeout)
+    except (subprocess.TimeoutExpired, OSError, ExecutionError) as e:
+        # e.g. the resident harness timing out or dying: a result for this row, the others go on
+        error_class = 'timeout' if isinstance(e, (subprocess.TimeoutExpired, ExecutionTimeout)) else 'exception'
+        return RowResult(index=task.index, fname=task.fname, compiled=True, error=repr(e),
+                         compile_time=task.compile_time, run_time=time.perf_counter() - start,
+                         error_class=error_class, row_id=task.row_id, candidate_id=task.candidate_id)
+    finally:
+        # Compiled by another worker: not in this process' workspace, so close() wouldn't remove it
+        os.remove(task.wrapper._compiled_exe_path)
+    passed = diff_io_batch(outputs, [expected for _, expected in task.io_pairs])
+    errors = [str(observed) for observed in outputs if isinstance(observed, ExecutionError)]
+    return RowResult(index=task.index, fname=task.fname, compiled=True, passed=passed,
+                     error=errors[0] if errors else None, compile_time=task.compile_time,
+                     run_time=time.perf_counter() - start, error_class=_error_class(outputs, passed),
+                     row_id=task.row_id, candidate_id=task.candidate_id)
+
+
+def evaluate_split(rows: Iterable[Dict], candidate_fn: Callable[[Dict], str] = reference_assembly,
+                   workers: Optional[int] = None, io_kind: str = 'synth',
+                   timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+                   resource_limits: Optional[ResourceLimits] = None,
+                   timeout_policy: Optional[TimeoutPolicy] = None, shard: Optional[Tuple[int, int]] = None,
+                   journal: Optional[Journal] = None, wire_format: str = 'json') -> Iterator[RowResult]:
+    # Yields a RowResult per row as soon as it's done (i.e. not necessarily in order).
+    # candidate_fn maps a row to the assembly to evaluate, and is called in this process.
+    # With timeout_policy, the timeout of each row is calibrated from its reference assembly (see TimeoutCalibrator)
+    # instead of `timeout`.
+    # With shard=(i, K), only the rows of the i-th of K shards are evaluated. With a journal, (row, candidate) pairs
+    # already in it are skipped, and every result is appended to it.
+    workers = workers or os.cpu_count()
+    rows = enumerate(rows)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+
+        def submit_next_row():
+            for index, row in rows:
+                if not row[f'{io_kind}_io_pairs'] or not row[f'{io_kind}_io_pairs']['input']:
+                    continue
+                rid = row_id(row) if shard is not None or journal is not None else 0
+                if shard is not None and shard_of(rid, shard[1]) != shard[0]:
+                    continue
+                func_assembly = candidate_fn(row)
+                cid = candidate_id(func_assembly) if journal is not None else 0
+                if journal is not None and journal.done(rid, cid):
+                    continue
+                task = _Task(index=index, fname=row['fname'],
+                             wrapper_kwargs=dict(row_wrapper_kwargs(row, func_assembly, io_kind),
+                                                 resource_limits=resource_limits, wire_format=wire_format),
+                             io_pairs=row_io_pairs(row, io_kind), timeout_policy=timeout_policy, row_id=rid,
+                             candidate_id=cid)
+                if timeout_policy is not None:
+                    task.reference_kwargs = row_wrapper_kwargs(row, reference_assembly(row), io_kind)
+                pending.add(pool.submit(_compile_stage, task))
+                return
+
+        # Keep enough rows in flight for every worker to have a compilation or an execution at hand
+        for _ in range(2 * workers):
+            submit_next_row()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                result = future.result()
+                if isinstance(result, _Task):
+                    pending.add(pool.submit(_run_stage, result, timeout))
+                    continue
+                if journal is not None:
+                    journal.append(result)
+                yield result
+                submit_next_row()
+
+
+def _import_candidate_fn(spec: str) -> Callable[[Dict], str]:
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def main():
+    from exebench.dataset import add_source_arguments, load_rows
+
+    parser = argparse.ArgumentParser(description='Evaluate candidate assembly on an ExeBench split in parallel')
+    add_source_arguments(parser)
+    parser.add_argument('--candidates', help='module:function mapping a row to the assembly to evaluate '
+                                             '(default: the reference angha_gcc_x86_O0 assembly)')
+    parser.add_argument('--io', choices=['synth', 'real'], default='synth')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--timeout', type=float, default=_DEFAULT_CMD_TIMEOUT,
+                        help='Seconds per input (with --calibrate-timeouts, the maximum)')
+    parser.add_argument('--calibrate-timeouts', action='store_true',
+                        help='Time out each row after a multiple of the time of its reference assembly')
+    parser.add_argument('--timeout-multiple', type=float, default=TimeoutPolicy.multiple)
+    parser.add_argument('--timeout-floor', type=float, default=TimeoutPolicy.floor, help='Minimum timeout, in seconds')
+    parser.add_argument('--cpu-time', type=int, help='CPU seconds per input')
+    parser.add_argument('--max-memory', type=int, help='Address space per process, in MiB')
+    parser.add_argument('--max-output', type=int, help='Output (JSON, stdout, stderr) per input, in MiB')
+    parser.add_argument('--workspace', help='Directory for the temporary build files (e.g. on a tmpfs)')
+    parser.add_argument('--workspace-quota', type=int, help='Temporary build files per worker, in MiB')
+    parser.add_argument('--shard', type=parse_shard, help='Only evaluate the i-th of K shards of the split, as i/K')
+    parser.add_argument('--journal', help='Append results to this journal, skipping the rows already in it')
+    parser.add_argument('--retry-errors', action='store_true',
+                        help='With --journal, evaluate again the rows whose record is an exception (e.g. an OSError)')
+    parser.add_argument('--wire-format', choices=['json', 'cbor', 'msgpack'], default='json',
+                        help='Encoding of the inputs and outputs sent to and from the harness')
+    args = parser.parse_args()
+
+    if args.workspace or args.workspace_quota:
+        configure_workspace(args.workspace, args.workspace_quota and args.workspace_quota * 1024 ** 2)
+
+    rows = load_rows(args)
+    candidate_fn = _import_candidate_fn(args.candidates) if args.candidates else reference_assembly
+
+    start = time.perf_counter()
+    n_rows = n_ok = 0
+    resource_limits = None
+    if args.cpu_time or args.max_memory or args.max_output:
+        resource_limits = ResourceLimits(cpu_time=args.cpu_time,
+                                         address_space=args.max_memory and args.max_memory * 1024 ** 2,
+                                         output_size=args.max_output and args.max_output * 1024 ** 2)
+    timeout_policy = None
+    if args.calibrate_timeouts:
+        timeout_policy = TimeoutPolicy(multiple=args.timeout_multiple, floor=args.timeout_floor, ceiling=args.timeout)
+    journal = Journal(args.journal, retry_errors=args.retry_errors) if args.journal else None
+    if journal is not None and len(journal):
+        print(f'Resuming: {len(journal)} rows already in {args.journal}', file=sys.stderr)
+    try:
+        for result in evaluate_split(rows, candidate_fn, workers=args.workers, io_kind=args.io, timeout=args.timeout,
+                                     resource_limits=resource_limits, timeout_policy=timeout_policy, shard=args.shard,
+                                     journal=journal, wire_format=args.wire_format):
+            print(json.dumps(result.dict()), flush=True)
+            n_rows += 1
+            n_ok += result.ok
+    finally:
+        if journal is not None:
+            journal.close()
+    elapsed = time.perf_counter() - start
+    print(f'{n_rows} rows in {elapsed:.1f}s ({n_rows / elapsed:.2f} rows/s), {n_ok} passed all IO pairs',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
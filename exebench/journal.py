@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import zlib
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# Append-only journal of evaluation results (see exebench.evaluate --journal), one compact binary record per
+# (row, candidate) evaluated, so that an interrupted run can resume where it stopped and runs sharded across nodes
+# can be aggregated afterwards.
+#
+# Layout: _MAGIC, then one record after another:
+#  - _HEADER: row id, candidate id, index of the row in the split, compile time, run time (seconds), error class
+#    (index in ERROR_CLASSES), compiled (0/1), number of IO pairs
+#  - ceil(n_pairs / 8) bytes: whether each IO pair passed, as a little endian bitmap
+#  - uint32 crc32 of the above
+# Each record is written with a single write, so a crash can only leave a torn record at the end, which readers
+# ignore and Journal truncates before appending.
+
+_MAGIC = b'EXEBENCH_JOURNAL_1\n'
+_HEADER = struct.Struct('<QQQffBBH')
+_CRC = struct.Struct('<I')
+ERROR_CLASSES = ['none', 'wrong_output', 'compile_error', 'exception', 'timeout', 'resource_limit', 'crash']
+RETRYABLE_ERROR_CLASSES = {'exception'}  # possibly transient (e.g. an OSError): evaluated again with retry_errors
+
+
+def _hash64(*parts: str) -> int:
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        encoded = part.encode('utf-8')
+        h.update(str(len(encoded)).encode('ascii') + b':' + encoded)
+    return int.from_bytes(h.digest(), 'little')
+
+
+def row_id(row: Dict) -> int:
+    # Stable across runs and orderings of the split
+    return _hash64(row['path'], row['fname'], row['func_def'])
+
+
+def candidate_id(func_assembly: str) -> int:
+    return _hash64(func_assembly)
+
+
+def shard_of(row_id: int, num_shards: int) -> int:
+    return row_id % num_shards
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    # 'i/K' -> (i, K), for the i-th of K shards (0-based)
+    shard, _, num_shards = spec.partition('/')
+    shard, num_shards = int(shard), int(num_shards)
+    if not 0 <= shard < num_shards:
+        raise ValueError(f'Invalid shard {spec!r}: expected i/K with 0 <= i < K')
+    return shard, num_shards
+
+
+@dataclass
+class JournalRecord:
+    row_id: int
+    candidate_id: int
+    index: int
+    compiled: bool
+    passed: List[bool]
+    error_class: str
+    compile_time: float
+    run_time: float
+
+    @property
+    def ok(self) -> bool:
+        return self.compiled and len(self.passed) > 0 and all(self.passed)
+
+    def dict(self):
+        return dict(asdict(self), ok=self.ok)
+
+
+def _key(row_id: int, candidate_id: int) -> int:
+    return row_id << 64 | candidate_id
+
+
+def _encode(result) -> bytes:
+    # result: JournalRecord, or anything with the same attributes (e.g. exebench.evaluate.RowResult)
+    bitmap = sum(1 << i for i, passed in enumerate(result.passed) if passed)
+    data = _HEADER.pack(result.row_id, result.candidate_id, result.index, result.compile_time, result.run_time,
+                        ERROR_CLASSES.index(result.error_class), int(result.compiled), len(result.passed))
+    data += bitmap.to_bytes((len(result.passed) + 7) // 8, 'little')
+    return data + _CRC.pack(zlib.crc32(data))
+
+
+def _scan(f) -> Iterator[Tuple[int, JournalRecord]]:
+    # Yields (offset after the record, record) for the valid records of an open journal, after its magic
+    offset = len(_MAGIC)
+    while True:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        rid, cid, index, compile_time, run_time, error_class, compiled, n_pairs = _HEADER.unpack(header)
+        bitmap = f.read((n_pairs + 7) // 8)
+        crc = f.read(_CRC.size)
+        if len(bitmap) < (n_pairs + 7) // 8 or len(crc) < _CRC.size or \
+                _CRC.unpack(crc)[0] != zlib.crc32(header + bitmap) or error_class >= len(ERROR_CLASSES):
+            return  # torn or corrupt tail
+        offset += len(header) + len(bitmap) + len(crc)
+        passed = int.from_bytes(bitmap, 'little')
+        yield offset, JournalRecord(rid, cid, index, bool(compiled), [bool(passed >> i & 1) for i in range(n_pairs)],
+                                    ERROR_CLASSES[error_class], compile_time, run_time)
+
+
+def _open(path: str):
+    f = open(path, 'rb')
+    if f.read(len(_MAGIC)) != _MAGIC:
+        f.close()
+        raise ValueError(f'{path} is not an ExeBench journal')
+    return f
+
+
+def iter_records(paths: Iterable[str]) -> Iterator[JournalRecord]:
+    # Streams the records of one or more journals
+    for path in paths:
+        with _open(path) as f:
+            for _, record in _scan(f):
+                yield record
+
+
+class Journal:
+    # Opened for appending: existing records are read once to know what's done, and a torn record at the end is
+    # dropped. Only one process should append to a journal at a time.
+    # With retry_errors, records of RETRYABLE_ERROR_CLASSES don't count as done, so their rows are evaluated again and
+    # get a second record (merge keeps the one that isn't an error).
+    def __init__(self, path: str, retry_errors: bool = False):
+        self.path = path
+        self._done = set()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(_MAGIC)
+        with _open(path) as f:
+            end = len(_MAGIC)
+            for end, record in _scan(f):
+                if not retry_errors or record.error_class not in RETRYABLE_ERROR_CLASSES:
+                    self._done.add(_key(record.row_id, record.candidate_id))
+        self._file = open(path, 'r+b')
+        self._file.truncate(end)
+        self._file.seek(end)
+
+    def __len__(self):
+        return len(self._done)
+
+    def done(self, row_id: int, candidate_id: int) -> bool:
+        return _key(row_id, candidate_id) in self._done
+
+    def append(self, result):
+        self._file.write(_encode(result))
+        self._file.flush()
+        self._done.add(_key(result.row_id, result.candidate_id))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def summarize(records: Iterable[JournalRecord]) -> Dict:
+    # Aggregates in constant memory
+    summary = dict(records=0, compiled=0, ok=0, io_pairs=0, io_pairs_passed=0, compile_time=0.0, run_time=0.0,
+                   error_classes={error_class: 0 for error_class in ERROR_CLASSES})
+    for record in records:
+        summary['records'] += 1
+        summary['compiled'] += record.compiled
+        summary['ok'] += record.ok
+        summary['io_pairs'] += len(record.passed)
+        summary['io_pairs_passed'] += sum(record.passed)
+        summary['compile_time'] += record.compile_time
+        summary['run_time'] += record.run_time
+        summary['error_classes'][record.error_class] += 1
+    if summary['records']:
+        summary['ok_rate'] = summary['ok'] / summary['records']
+    return summary
+
+
+def merge(paths: Iterable[str], output: str) -> Tuple[int, int]:
+    # Writes the records of all the journals to a new one, keeping the first record of each (row, candidate), or the
+    # first that isn't a retryable error if it was retried. Returns (records written, duplicates dropped). Only the
+    # keys are kept in memory.
+    paths = list(paths)
+    retried = {_key(record.row_id, record.candidate_id) for record in iter_records(paths)
+               if record.error_class not in RETRYABLE_ERROR_CLASSES}
+    seen = set()
+    written = duplicates = 0
+    with open(output, 'wb') as f:
+        f.write(_MAGIC)
+        for record in iter_records(paths):
+            key = _key(record.row_id, record.candidate_id)
+            if key in seen or (record.error_class in RETRYABLE_ERROR_CLASSES and key in retried):
+                duplicates += 1
+                continue
+            seen.add(key)
+            f.write(_encode(record))
+            written += 1
+    return written, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize, merge or dump ExeBench evaluation journals')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary_parser = subparsers.add_parser('summary', help='Print aggregate statistics as JSON')
+    summary_parser.add_argument('journals', nargs='+')
+    merge_parser = subparsers.add_parser('merge', help='Merge journals (e.g. of all the shards) into one')
+    merge_parser.add_argument('journals', nargs='+')
+    merge_parser.add_argument('-o', '--output', required=True)
+    dump_parser = subparsers.add_parser('dump', help='Print the records as JSON lines')
+    dump_parser.add_argument('journals', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        print(json.dumps(summarize(iter_records(args.journals)), indent=2))
+    elif args.command == 'merge':
+        written, duplicates = merge(args.journals, args.output)
+        print(f'{written} records written to {args.output}, {duplicates} duplicates dropped', file=sys.stderr)
+    else:
+        for record in iter_records(args.journals):
+            print(json.dumps(record.dict()))
+
+
+if __name__ == '__main__':
+    main()
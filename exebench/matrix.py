@@ -0,0 +1,185 @@
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from exebench import CandidateResult, Harness, ResourceLimits, TimeoutPolicy, configure_workspace, \
+    _DEFAULT_CMD_TIMEOUT
+from exebench.evaluate import calibrated_timeout, row_io_pairs, row_wrapper_kwargs, _calibrator
+
+# Cross-target execution matrix: for each row, the assembly of every x86-64 target (e.g. angha_gcc_x86_O0 to O3) run
+# against the synthetic and real IO pairs of the row. The harness of each IO kind is compiled once per row (see
+# Harness) and shared by all the targets, which then only need to be assembled and linked. Rows are spread across
+# a pool of worker processes.
+#
+# Each cell is a single character (see STATUS_CODES), so that a row of the matrix is a short string per IO kind,
+# e.g. synth 'PPPP', real 'PPFT'.
+
+IO_KINDS = ['synth', 'real']
+STATUS_CODES = {'pass': 'P', 'fail': 'F', 'timeout': 'T', 'crash': 'X', 'compile_error': 'C', 'exception': 'E',
+                'no_io': '-'}
+_ROW_FIELDS = ['path', 'fname', 'asm', 'func_head_types'] + \
+              [f'{io_kind}_{field}' for io_kind in IO_KINDS for field in ['deps', 'io_pairs', 'exe_wrapper']]
+
+
+def x86_targets(row) -> List[Tuple[str, str]]:
+    # (target, assembly) of the x86-64 targets of a row, in order
+    return [(target, code) for target, code in zip(row['asm']['target'], row['asm']['code']) if '_x86_' in target]
+
+
+def _status(result: CandidateResult) -> str:
+    if not result.compiled:
+        return 'compile_error'
+    if result.error_class == 'timeout':
+        return 'timeout'
+    if result.error_class in ['crash', 'resource_limit']:
+        return 'crash'
+    return 'pass' if result.ok else 'fail'
+
+
+@dataclass
+class MatrixRow:
+    index: int
+    path: str
+    fname: str
+    targets: List[str]
+    synth: str  # a status code per target
+    real: str
+    error: Optional[str] = None
+    run_time: float = 0.0
+
+    @property
+    def unstable(self) -> bool:
+        # Whether targets that compiled and ran disagree on the IO pairs of either kind
+        return any(len(set(codes) - {STATUS_CODES['compile_error'], STATUS_CODES['exception'],
+                                     STATUS_CODES['no_io']}) > 1 for codes in [self.synth, self.real])
+
+    def dict(self):
+        return dict(asdict(self), unstable=self.unstable)
+
+
+def _has_io(row, io_kind) -> bool:
+    io_pairs = row.get(f'{io_kind}_io_pairs')
+    return bool(io_pairs and io_pairs['input'])
+
+
+def row_matrix(row: Dict, index: int = 0, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+               timeout_policy: Optional[TimeoutPolicy] = None, resource_limits: Optional[ResourceLimits] = None,
+               wire_format: str = 'json') -> MatrixRow:
+    # With timeout_policy, the timeout of each IO kind is calibrated from the reference assembly instead of `timeout`
+    start = time.perf_counter()
+    targets = x86_targets(row)
+    statuses = {}
+    errors = []
+    for io_kind in IO_KINDS:
+        if not targets or not _has_io(row, io_kind):
+            statuses[io_kind] = STATUS_CODES['no_io'] * len(targets)
+            continue
+        try:
+            io_pairs = row_io_pairs(row, io_kind)
+            kind_timeout = timeout
+            if timeout_policy is not None:
+                kind_timeout = calibrated_timeout(row, _calibrator(timeout_policy), io_kind)
+            kwargs = row_wrapper_kwargs(row, None, io_kind)
+            with Harness(kwargs['c_deps'], kwargs['func_c_signature'], kwargs['cpp_wrapper'],
+                         resource_limits=resource_limits, wire_format=wire_format) as harness:
+                results = harness.evaluate([code for _, code in targets], io_pairs, timeout=kind_timeout)
+            statuses[io_kind] = ''.join(STATUS_CODES[_status(result)] for result in results)
+        except Exception as e:
+            statuses[io_kind] = STATUS_CODES['exception'] * len(targets)
+            errors.append(f'{io_kind}: {e!r}')
+    return MatrixRow(index=index, path=row['path'], fname=row['fname'], targets=[target for target, _ in targets],
+                     synth=statuses['synth'], real=statuses['real'], error='; '.join(errors) or None,
+                     run_time=time.perf_counter() - start)
+
+
+def run_matrix(rows: Iterable[Dict], workers: Optional[int] = None, timeout: Optional[float] = _DEFAULT_CMD_TIMEOUT,
+               timeout_policy: Optional[TimeoutPolicy] = None, resource_limits: Optional[ResourceLimits] = None,
+               wire_format: str = 'json') -> Iterator[MatrixRow]:
+    # Yields a MatrixRow per row as soon as it's done (i.e. not necessarily in order)
+    workers = workers or os.cpu_count()
+    rows = enumerate(rows)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+
+        def submit_next_row():
+            for index, row in rows:
+                row = {field: row[field] for field in _ROW_FIELDS if field in row}
+                pending.add(pool.submit(row_matrix, row, index, timeout, timeout_policy, resource_limits,
+                                        wire_format))
+                return
+
+        for _ in range(2 * workers):
+            submit_next_row()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                yield future.result()
+                submit_next_row()
+
+
+def main():
+    from exebench.dataset import add_source_arguments, load_rows
+
+    parser = argparse.ArgumentParser(description='Run the assembly of every x86-64 target of each row against its '
+                                                 'synthetic and real IO pairs, as JSON lines of status codes ' +
+                                                 ', '.join(f'{code}: {status}' for status, code in
+                                                           STATUS_CODES.items()))
+    add_source_arguments(parser)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--timeout', type=float, default=_DEFAULT_CMD_TIMEOUT,
+                        help='Seconds per input (with --calibrate-timeouts, the maximum)')
+    parser.add_argument('--calibrate-timeouts', action='store_true',
+                        help='Time out each row after a multiple of the time of its reference assembly')
+    parser.add_argument('--timeout-multiple', type=float, default=TimeoutPolicy.multiple)
+    parser.add_argument('--timeout-floor', type=float, default=TimeoutPolicy.floor, help='Minimum timeout, in seconds')
+    parser.add_argument('--cpu-time', type=int, help='CPU seconds per input')
+    parser.add_argument('--max-memory', type=int, help='Address space per process, in MiB')
+    parser.add_argument('--max-output', type=int, help='Output (JSON, stdout, stderr) per input, in MiB')
+    parser.add_argument('--workspace', help='Directory for the temporary build files (e.g. on a tmpfs)')
+    parser.add_argument('--unstable-only', action='store_true',
+                        help='Only print the rows whose targets disagree on their IO pairs')
+    parser.add_argument('--wire-format', choices=['json', 'cbor', 'msgpack'], default='json',
+                        help='Encoding of the inputs and outputs sent to and from the harness')
+    args = parser.parse_args()
+
+    if args.workspace:
+        configure_workspace(args.workspace)
+    resource_limits = None
+    if args.cpu_time or args.max_memory or args.max_output:
+        resource_limits = ResourceLimits(cpu_time=args.cpu_time,
+                                         address_space=args.max_memory and args.max_memory * 1024 ** 2,
+                                         output_size=args.max_output and args.max_output * 1024 ** 2)
+    timeout_policy = None
+    if args.calibrate_timeouts:
+        timeout_policy = TimeoutPolicy(multiple=args.timeout_multiple, floor=args.timeout_floor, ceiling=args.timeout)
+
+    start = time.perf_counter()
+    n_rows = n_unstable = 0
+    counts = collections.defaultdict(collections.Counter)  # target -> status code -> cells
+    for result in run_matrix(load_rows(args), workers=args.workers, timeout=args.timeout,
+                             timeout_policy=timeout_policy, resource_limits=resource_limits,
+                             wire_format=args.wire_format):
+        n_rows += 1
+        n_unstable += result.unstable
+        for codes in [result.synth, result.real]:
+            for target, code in zip(result.targets, codes):
+                counts[target][code] += 1
+        if result.unstable or not args.unstable_only:
+            print(json.dumps(result.dict()), flush=True)
+    elapsed = time.perf_counter() - start
+    for target in sorted(counts):
+        print(f'{target}: ' + ' '.join(f'{code}={counts[target][code]}' for code in STATUS_CODES.values()
+                                       if counts[target][code]), file=sys.stderr)
+    print(f'{n_rows} rows in {elapsed:.1f}s ({n_rows / elapsed:.2f} rows/s), {n_unstable} unstable across targets',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# Local store for ExeBench splits with random access: converted once from any row source (see exebench.dataset),
+# then opened without loading anything into memory.
+#
+# Layout of a store directory:
+#  - meta.json: number of rows and fields
+#  - <field>.data: the values of a column, each one JSON encoded and zlib compressed on its own
+#  - <field>.offsets: n_rows + 1 little endian uint64 offsets into <field>.data
+#  - <key>.index: for each of fname, path and func_def_sha256, sorted (uint64 key hash, uint64 row) pairs
+# Columns and indexes are memory mapped, so reading a row only touches (and decompresses) the fields that are used.
+
+_FORMAT_VERSION = 1
+_OFFSET = struct.Struct('<Q')
+_INDEX_ENTRY = struct.Struct('<QQ')
+_INDEX_KEYS = {'fname': 'fname', 'path': 'path', 'func_def_sha256': 'func_def'}  # key -> field it's computed from
+_INDEX_RUN_SIZE = 1 << 18  # index entries sorted in memory at a time, per key
+
+
+def func_def_sha256(func_def: str) -> str:
+    return hashlib.sha256(func_def.encode('utf-8')).hexdigest()
+
+
+def _index_key(key: str, value: str) -> str:
+    return func_def_sha256(value) if key == 'func_def_sha256' else value
+
+
+def _key_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _safe_field_name(field: str) -> str:
+    if not field or os.sep in field or field.startswith('.'):
+        raise ValueError(f'Unsupported field name: {field!r}')
+    return field
+
+
+class _IndexWriter:
+    # Index entries sorted with bounded memory: sorted runs (already in the index format) spilled to temporary files,
+    # merged into the index at the end
+    def __init__(self, tmp_dir: str, key: str):
+        self._tmp_dir = tmp_dir
+        self._key = key
+        self._entries = []
+        self._runs = []
+
+    def add(self, key_hash: int, row_id: int):
+        self._entries.append(key_hash << 64 | row_id)  # a single int sorts faster than a tuple
+        if len(self._entries) >= _INDEX_RUN_SIZE:
+            self._spill()
+
+    def _spill(self):
+        self._entries.sort()
+        path = os.path.join(self._tmp_dir, f'{self._key}.{len(self._runs)}')
+        with open(path, 'wb') as f:
+            f.write(b''.join(_INDEX_ENTRY.pack(entry >> 64, entry & 0xFFFFFFFFFFFFFFFF) for entry in self._entries))
+        self._runs.append(path)
+        self._entries = []
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[tuple]:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(_INDEX_ENTRY.size << 16)
+                if not chunk:
+                    return
+                yield from _INDEX_ENTRY.iter_unpack(chunk)
+
+    def write(self, index_path: str):
+        if self._entries or not self._runs:
+            self._spill()
+        with open(index_path, 'wb') as f:
+            chunk = []
+            for entry in heapq.merge(*(self._read_run(path) for path in self._runs)):
+                chunk.append(_INDEX_ENTRY.pack(*entry))
+                if len(chunk) >= 1 << 16:
+                    f.write(b''.join(chunk))
+                    chunk = []
+            f.write(b''.join(chunk))
+        for path in self._runs:
+            os.remove(path)
+
+
+def convert(rows: Iterable[Dict], path: str, compression_level: int = 6) -> int:
+    # Writes the rows to a new store at path and returns the number of rows. Every row must have the same fields.
+    os.makedirs(path, exist_ok=True)
+    fields = None
+    data_files = {}
+    offset_files = {}
+    offsets = {}
+    n_rows = 0
+    with tempfile.TemporaryDirectory(dir=path) as tmp_dir:
+        index_writers = {key: _IndexWriter(tmp_dir, key) for key in _INDEX_KEYS}
+        try:
+            for row in rows:
+                if fields is None:
+                    fields = [_safe_field_name(field) for field in row]
+                    for field in fields:
+                        data_files[field] = open(os.path.join(path, f'{field}.data'), 'wb')
+                        offset_files[field] = open(os.path.join(path, f'{field}.offsets'), 'wb')
+                        offset_files[field].write(_OFFSET.pack(0))
+                        offsets[field] = 0
+                elif list(row) != fields:
+                    raise ValueError(f'Row {n_rows} has fields {list(row)}, expected {fields}')
+                for field in fields:
+                    value = zlib.compress(json.dumps(row[field], separators=(',', ':')).encode('utf-8'),
+                                          compression_level)
+                    data_files[field].write(value)
+                    offsets[field] += len(value)
+                    offset_files[field].write(_OFFSET.pack(offsets[field]))
+                for key, index_writer in index_writers.items():
+                    if _INDEX_KEYS[key] in row:
+                        index_writer.add(_key_hash(_index_key(key, row[_INDEX_KEYS[key]])), n_rows)
+                n_rows += 1
+        finally:
+            for f in list(data_files.values()) + list(offset_files.values()):
+                f.close()
+
+        for key, index_writer in index_writers.items():
+            index_writer.write(os.path.join(path, f'{key}.index'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(dict(version=_FORMAT_VERSION, n_rows=n_rows, fields=fields or []), f)
+    return n_rows
+
+
+def _map(path: str) -> Optional[mmap.mmap]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None  # can't map empty files
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Column(Sequence):
+    # Lazy view of a field across all rows
+    def __init__(self, store: 'ExeBenchStore', field: str):
+        self._store = store
+        self.field = field
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._store._read_value(self.field, index)
+
+
+class LazyRow(Mapping):
+    # A row whose fields are decoded on first access
+    def __init__(self, store: 'ExeBenchStore', row_id: int):
+        self._store = store
+        self.row_id = row_id
+        self._values = {}
+
+    def __getitem__(self, field):
+        if field not in self._values:
+            if field not in self._store.fields:
+                raise KeyError(field)
+            self._values[field] = self._store._read_value(field, self.row_id)
+        return self._values[field]
+
+    def __iter__(self):
+        return iter(self._store.fields)
+
+    def __len__(self):
+        return len(self._store.fields)
+
+    def __repr__(self):
+        return f'LazyRow({self.row_id})'
+
+
+class ExeBenchStore(Sequence):
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != _FORMAT_VERSION:
+            raise ValueError(f'Unsupported store version {meta["version"]} in {path}')
+        self._n_rows = meta['n_rows']
+        self.fields = meta['fields']
+        self._data = {}
+        self._offsets = {}
+        self._indexes = {}
+
+    def __len__(self):
+        return self._n_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += self._n_rows
+        if not 0 <= index < self._n_rows:
+            raise IndexError(index)
+        return LazyRow(self, index)
+
+    def __iter__(self) -> Iterator[LazyRow]:
+        return (LazyRow(self, i) for i in range(self._n_rows))
+
+    def column(self, field: str) -> Column:
+        if field not in self.fields:
+            raise KeyError(field)
+        return Column(self, field)
+
+    def _read_value(self, field: str, index: int):
+        if index < 0:
+            index += self._n_rows
+        if not 0 <= index < self._n_rows:
+            raise IndexError(index)
+        if field not in self._data:
+            self._offsets[field] = _map(os.path.join(self.path, f'{field}.offsets'))
+            self._data[field] = _map(os.path.join(self.path, f'{field}.data'))
+        start, = _OFFSET.unpack_from(self._offsets[field], index * _OFFSET.size)
+        end, = _OFFSET.unpack_from(self._offsets[field], (index + 1) * _OFFSET.size)
+        return json.loads(zlib.decompress(self._data[field][start:end]))
+
+    def _lookup(self, key: str, value: str) -> List[int]:
+        if key not in self._indexes:
+            self._indexes[key] = _map(os.path.join(self.path, f'{key}.index'))
+        index = self._indexes[key]
+        if index is None:
+            return []
+        # Binary search for the first entry with this hash, then scan the (usually very few) entries sharing it
+        target = _key_hash(value)
+        lo, hi = 0, len(index) // _INDEX_ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _INDEX_ENTRY.unpack_from(index, mid * _INDEX_ENTRY.size)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        row_ids = []
+        for i in range(lo, len(index) // _INDEX_ENTRY.size):
+            key_hash, row_id = _INDEX_ENTRY.unpack_from(index, i * _INDEX_ENTRY.size)
+            if key_hash != target:
+                break
+            row_ids.append(row_id)
+        # Hashes may collide: check against the actual values
+        field = _INDEX_KEYS[key]
+        return [row_id for row_id in row_ids if _index_key(key, self._read_value(field, row_id)) == value]
+
+    def find(self, fname: Optional[str] = None, path: Optional[str] = None, func_def: Optional[str] = None,
+             func_def_hash: Optional[str] = None) -> List[int]:
+        # Returns the ids of the rows matching all the given criteria, in order
+        criteria = [('fname', fname), ('path', path), ('func_def_sha256', func_def_hash),
+                    ('func_def_sha256', func_def_sha256(func_def) if func_def is not None else None)]
+        criteria = [(key, value) for key, value in criteria if value is not None]
+        if not criteria:
+            raise ValueError('At least one criterion is needed')
+        row_ids = None
+        for key, value in criteria:
+            matches = set(self._lookup(key, value))
+            row_ids = matches if row_ids is None else row_ids & matches
+        return sorted(row_ids)
+
+    def close(self):
+        for mapped in list(self._data.values()) + list(self._offsets.values()) + list(self._indexes.values()):
+            if mapped is not None:
+                mapped.close()
+        self._data.clear()
+        self._offsets.clear()
+        self._indexes.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main():
+    from exebench.dataset import add_source_arguments, load_rows
+
+    parser = argparse.ArgumentParser(description='Convert an ExeBench split into a local store with random access')
+    add_source_arguments(parser)
+    parser.add_argument('output', help='Directory of the new store')
+    parser.add_argument('--compression-level', type=int, default=6)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_rows = convert(load_rows(args), args.output, compression_level=args.compression_level)
+    print(f'{n_rows} rows written to {args.output} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
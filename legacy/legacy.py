@@ -9,6 +9,11 @@ from koda import Ok, Err, Result
 import re
 import json
 import math
+import functools
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 
 # For the moment, don't support MASM
@@ -42,7 +47,124 @@ class FuncAsm:
         return asdict(self)
 
 
+_GAS_LABEL = re.compile(r'^([A-Za-z0-9_.$]+):')
+_GAS_SECTION = re.compile(r'^\s*(\.section\s+([^\s,]+)|\.(text|data|bss)\b)')
+_GAS_FUNC_TYPE = re.compile(r'^\s*\.type\s+([^\s,]+),\s*[@%]function')
+_GAS_CONSTANT_SYMBOLS = [re.compile(r'\.LC[0-9]*'), re.compile(r'a\.[0-9]*')]
+_LLVM_DEFINE = re.compile(r'^define\b[^@]*@("[^"]+"|[^\s(]+)\(')
+_LLVM_GLOBAL = re.compile(r'^@("[^"]+"|[^\s=]+)\s*=')
+
+
+class AsmIndex:
+    # Index of the output of one compilation (GAS or LLVM IR), built in a single pass over its lines: labels (or
+    # LLVM globals) -> line, section of each label, and function name -> (first line, last line).
+    # Any number of functions can then be extracted from it.
+    def __init__(self, all_asm: str, lang='gas', comment_sym='#'):
+        self.lang = lang
+        self.comment_sym = comment_sym
+        self.lines = all_asm.splitlines()
+        self.labels = {}
+        self.sections = {}
+        self.functions = {}
+        if lang == 'llvm':
+            self._index_llvm()
+        else:
+            self._index_gas()
+
+    def _index_gas(self):
+        section = '.text'
+        func_types = set()
+        open_funcs = []
+        for i, l in enumerate(self.lines):
+            m = _GAS_LABEL.match(l)
+            if m:
+                label = m.group(1)
+                if label not in self.labels:
+                    self.labels[label] = i
+                    self.sections[label] = section
+                if label in func_types and label not in self.functions:
+                    open_funcs.append(label)
+                continue
+            m = _GAS_SECTION.match(l)
+            if m:
+                section = m.group(2) or f'.{m.group(3)}'
+                continue
+            m = _GAS_FUNC_TYPE.match(l)
+            if m:
+                func_types.add(m.group(1))
+            elif '.cfi_endproc' in l and open_funcs:
+                for fname in open_funcs:
+                    self.functions[fname] = (self.labels[fname], i)
+                open_funcs = []
+        for fname in open_funcs:  # e.g. without unwind tables: up to the end
+            self.functions[fname] = (self.labels[fname], len(self.lines) - 1)
+
+    def _index_llvm(self):
+        fname = None
+        for i, l in enumerate(self.lines):
+            if fname is None:
+                m = _LLVM_DEFINE.match(l)
+                if m:
+                    fname = m.group(1).strip('"')
+                    start = i
+                    continue
+                m = _LLVM_GLOBAL.match(l)
+                if m:
+                    self.labels.setdefault(m.group(1).strip('"'), i)
+            elif l.startswith('}'):
+                self.functions.setdefault(fname, (start, i))
+                fname = None
+
+    def section(self, label) -> Optional[str]:
+        return self.sections.get(label)
+
+    def data_symbols(self, func_asm: str) -> List[str]:
+        # '<symbol>: <first line of its data>' for the constants used in func_asm, in order of first use
+        res = []
+        seen = set()
+        for pattern in _GAS_CONSTANT_SYMBOLS:
+            for symbol in pattern.findall(func_asm):
+                if symbol in seen or symbol not in self.labels:
+                    continue
+                seen.add(symbol)
+                for l in itertools.islice(self.lines, self.labels[symbol] + 1, None):
+                    if l:
+                        res.append(symbol + ': ' + l)
+                        break
+        return res
+
+    def _strip_comments(self, lines):  # only support simple commands, asm
+        res = []
+        for l in lines:
+            without_comments = l.split(self.comment_sym)[0]
+            if len(without_comments.split()) > 0:
+                res.append(without_comments)
+        return res
+
+    def split(self, fname):
+        # (pre_asm, func_asm, post_asm) of fname, without the data symbols
+        if fname not in self.functions:
+            raise RuntimeError(f"Couldn't find function {fname} in the assembly")
+        start, end = self.functions[fname]
+        if self.lang == 'llvm':
+            post = list(itertools.dropwhile(lambda l: not l.strip(), self.lines[end + 1:]))
+            return ('\n'.join(self.lines[:start]) + '\n', '\n'.join(self.lines[start:end + 1]) + '\n',
+                    '\n'.join(post) + '\n')
+        globl = f'.globl {fname}'
+        pre = [l for l in self.lines[:start] if l.strip() != globl]
+        func = [globl, f'.type {fname}, @function'] + self.lines[start:end + 1]
+        return ('\n'.join(pre) + '\n', '\n'.join(self._strip_comments(func)),
+                '\n'.join(self.lines[end + 1:]) + '\n')
+
+    def extract(self, fname):
+        # (pre_asm, func_asm, post_asm) of fname, with the constants it uses appended to func_asm
+        pre_asm, func_asm, post_asm = self.split(fname)
+        return pre_asm, func_asm + '\n' + '\n'.join(self.data_symbols(func_asm)) + '\n', post_asm
+
+
 class Compiler:
+    impl = None
+
     def __init__(self, arch, o, lang, bits=64):
         self.arch = arch
         self.o = o
@@ -52,7 +174,37 @@ class Compiler:
     def get_func_asm(self, all_required_c_code, fname, output_path=None) -> Result[FuncAsm, BaseException]:
         return self._get_func_asm(all_required_c_code, fname, output_path, arch=self.arch, o=self.o, bits=self.bits)
 
+    def get_funcs_asm(self, all_required_c_code, fnames) -> Dict[str, Result[FuncAsm, BaseException]]:
+        # Compiles all_required_c_code once and extracts each of fnames from the output
+        return self._get_funcs_asm(all_required_c_code, fnames, arch=self.arch, o=self.o, bits=self.bits)
+
     def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
+        return self._get_funcs_asm(all_required_c_code, [fname], arch=arch, o=o, bits=bits)[fname]
+
+    def _get_funcs_asm(self, all_required_c_code, fnames, arch, o, bits) -> Dict[str, Result[FuncAsm, BaseException]]:
+        try:
+            out = self._compile(self._backend(arch, bits), all_required_c_code, o)
+        except BaseException as e:
+            return {fname: Err(e) for fname in fnames}
+        index = AsmIndex(out, lang=self.lang, comment_sym=self.get_comment_sym())
+        res = {}
+        for fname in fnames:
+            try:
+                pre_asm, func_asm, post_asm = index.extract(fname)
+            except RuntimeError as e:
+                res[fname] = Err(e)
+                continue
+            res[fname] = Ok(FuncAsm(pre_asm=pre_asm, func_asm=func_asm, post_asm=post_asm,
+                                    target=AsmTarget(impl=self.impl, bits=bits, lang=self.lang, o=o)))
+        return res
+
+    def _backend(self, arch, bits):
+        raise NotImplementedError
+
+    def _compile(self, backend, all_required_c_code, o) -> str:
+        raise NotImplementedError
+
+    def get_comment_sym(self):
         raise NotImplementedError
 
     def _asm_replace_constants_with_literals(self, all_asm, func_asm):
@@ -80,85 +232,38 @@ class GASCompiler(ABC, Compiler):
             raise ValueError(f'lang = {self.lang}')
 
     def _asm_replace_constants_with_literals(self, all_asm, func_asm):
-        all_asm = all_asm.decode("utf-8")
-        asm_to_add = []
-        for symbol in re.compile('\.LC[0-9]*').findall(func_asm):  # TODO: move, compile once
-            for e in re.findall(f'\.{symbol.replace(".", "")}:[\r\n]+([^\r\n]+)', all_asm):
-                asm_to_add.append(symbol + ': ' + e)
-                break
-        for symbol in re.compile('a\.[0-9]*').findall(func_asm):  # TODO: move, compile once
-            for e in re.findall(f'{symbol}:[\r\n]+([^\r\n]+)', all_asm):
-                asm_to_add.append(symbol + ': ' + e)
-                break
-        return func_asm + '\n' + '\n'.join(asm_to_add) + '\n'
+        if isinstance(all_asm, bytes):
+            all_asm = all_asm.decode("utf-8")
+        index = AsmIndex(all_asm, lang=self.lang, comment_sym=self.get_comment_sym())
+        return func_asm + '\n' + '\n'.join(index.data_symbols(func_asm)) + '\n'
 
     def _gas_get_func_asm_from_all_asm(self, fname, all_asm):
-
-        def strip_comments(code, comment_sym):  # only support simple commands, asm
-            res = []
-            for l in code.splitlines():
-                without_comments = l.split(comment_sym)[0]
-                if len(without_comments.split()) > 0:
-                    res.append(without_comments)
-            return '\n'.join(res)
-
-        func = [f'.globl {fname}', f'.type {fname}, @function']
-        inside_func = False
-        after_func = False
-        pre_asm = []
-        post_asm = []
-        for l in all_asm.splitlines():
-            if l.startswith(f'{fname}:'):
-                inside_func = True
-            if inside_func:
-                func.append(l)
-            elif after_func:
-                post_asm.append(l)
-            else:
-                if f'.globl {fname}' not in l:
-                    pre_asm.append(l)
-            if inside_func and '.cfi_endproc' in l:
-                inside_func = False
-                after_func = True
-
-        pre_asm = '\n'.join(pre_asm) + '\n'
-        func_asm = '\n'.join(func) + '\n'
-        comment_sym = self.get_comment_sym()
-        func_asm = strip_comments(func_asm, comment_sym=comment_sym)
-        post_asm = '\n'.join(post_asm) + '\n'
-
-        return pre_asm, func_asm, post_asm
+        return AsmIndex(str(all_asm), lang='gas', comment_sym=self.get_comment_sym()).split(fname)
 
 
 class GCC(GASCompiler):
+    impl = 'gcc'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, lang='gas', **kwargs)
-        self.arm_64 = sh.aarch64_linux_gnu_gcc  # sudo apt install aarch64-linux-gnu-gcc
-        self.x86_64 = sh.gcc
+        # Only the compiler of this arch, so that x86 works without the cross compiler installed
+        self.arm_64 = sh.aarch64_linux_gnu_gcc if self.arch == 'arm' else None  # sudo apt install aarch64-linux-gnu-gcc
+        self.x86_64 = sh.gcc if self.arch == 'x86' else None
 
-    def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
-        lang = 'gas'  # we don't support masm
-        if arch == 'arm' and bits == 64:
-            backend = self.arm_64
-        elif arch == 'x86' and bits == 64:
-            backend = self.x86_64
-        else:
-            raise NotImplementedError(f'arch = {arch}, bits = {bits}')
-        try:
-            out = backend('-S', f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-', _in=all_required_c_code)
-        except BaseException as e:
-            return Err(e)
+    def _backend(self, arch, bits):
+        if arch == 'arm' and bits == 64 and self.arm_64 is not None:
+            return self.arm_64
+        elif arch == 'x86' and bits == 64 and self.x86_64 is not None:
+            return self.x86_64
+        raise NotImplementedError(f'arch = {arch}, bits = {bits}')
 
-        pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname)
-        func_asm = self._asm_replace_constants_with_literals(all_asm=out.stdout, func_asm=func_asm)
-        func_asm = FuncAsm(pre_asm=pre_asm, func_asm=func_asm, post_asm=post_asm, target=AsmTarget(impl='gcc',
-                                                                                                   bits=bits,
-                                                                                                   lang=lang,
-                                                                                                   o=o))
-        return Ok(func_asm)
+    def _compile(self, backend, all_required_c_code, o) -> str:
+        return str(backend('-S', f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-', _in=all_required_c_code))
 
 
 class Clang(GASCompiler):
+    impl = 'clang'
+
     def __init__(self, *args, emit_llvm=False, **kwargs):
         lang = 'llvm' if emit_llvm else 'gas'
         super().__init__(*args, lang=lang, **kwargs)
@@ -166,63 +271,144 @@ class Clang(GASCompiler):
         self.emit_llvm = emit_llvm
         self.emit_llvm_flag = '-emit-llvm' if emit_llvm else ''
 
-    def _get_func_asm(self, all_required_c_code, fname, output_path, arch, o, bits) -> Result[FuncAsm, BaseException]:
+    def _backend(self, arch, bits):
         if arch == 'x86' and bits == 64:
-            backend = self.clang
-        else:
-            raise NotImplementedError(f'arch = {arch}, bits = {bits}')
-        try:
-            out = backend('-S', self.emit_llvm_flag, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
-                          _in=all_required_c_code)
-        except BaseException as e:
-            return Err(e)
-        try:
-            if self.emit_llvm:
-                pre_asm, func_asm, post_asm = self._llvm_get_func_asm_from_all_asm(all_asm=out, fname=fname)
-            else:
-                pre_asm, func_asm, post_asm = self._gas_get_func_asm_from_all_asm(all_asm=out, fname=fname)
-        except RuntimeError as e:
-            return Err(e)
-        func_asm = self._asm_replace_constants_with_literals(all_asm=out.stdout, func_asm=func_asm)
-        func_asm = FuncAsm(pre_asm=pre_asm, func_asm=func_asm, post_asm=post_asm, target=AsmTarget(impl='clang',
-                                                                                                   bits=bits,
-                                                                                                   lang='llvm' if self.emit_llvm else 'gas',
-                                                                                                   o=o))
-        return Ok(func_asm)
+            return self.clang
+        raise NotImplementedError(f'arch = {arch}, bits = {bits}')
+
+    def _compile(self, backend, all_required_c_code, o) -> str:
+        return str(backend('-S', self.emit_llvm_flag, f'-O{o}', '-x', 'c', '-o', '/dev/stdout', '-',
+                           _in=all_required_c_code))
 
     @staticmethod
     def _llvm_get_func_asm_from_all_asm(fname, all_asm):
         # @var = common dso_local global i32 0, align 4
         # ; Function Attrs: noinline nounwind optnone uwtable
         # define dso_local i32 @f(i32 %0) #0 {
-        func = []
-        inside_func = False
-        after_func = False
-        pre_asm = []
-        post_asm = []
-        for l in all_asm.splitlines():
-            if l.startswith('define') and f'@{fname}(' in l:
-                inside_func = True
-            if inside_func:
-                func.append(l)
-            elif after_func:
-                post_asm.append(l)
+        return AsmIndex(str(all_asm), lang='llvm').split(fname)
+
+
+@dataclass(frozen=True)
+class CompileTarget:
+    impl: str
+    arch: str
+    o: str
+    bits: int = 64
+    emit_llvm: bool = False
+
+    @property
+    def name(self):  # e.g. gcc_x86_O0, as in the asm targets of the dataset
+        return f'{self.impl}_{self.arch}{"_llvm" if self.emit_llvm else ""}_O{self.o}'
+
+    def compiler(self):
+        kwargs = dict(emit_llvm=True) if self.emit_llvm else {}
+        return Compiler.factory(self.impl, self.arch, self.o, bits=self.bits, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_version(target: CompileTarget) -> Optional[str]:
+    # First line of `<compiler> --version`, or None if the compiler isn't installed
+    try:
+        return str(target.compiler()._backend(target.arch, target.bits)('--version')).split('\n')[0]
+    except Exception:
+        return None
+
+
+DEFAULT_TARGET_MATRIX = [CompileTarget(impl, arch, o) for impl, arch in [('gcc', 'x86'), ('gcc', 'arm'), ('clang', 'x86')]
+                         for o in ['0', '1', '2', '3']]
+
+
+class AsmCache:
+    # FuncAsm results on disk, keyed by hash of the source + function name + target + compiler version (so that
+    # upgrading the toolchain invalidates them)
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def key(all_required_c_code, fname, target: CompileTarget, compiler_version: str):
+        h = hashlib.sha256()
+        for part in [all_required_c_code, fname, target.name, str(target.bits), compiler_version]:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.json')
+
+    def get(self, key) -> Optional[FuncAsm]:
+        try:
+            with open(self._path(key), 'r') as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return FuncAsm(pre_asm=d['pre_asm'], func_asm=d['func_asm'], post_asm=d['post_asm'],
+                       target=AsmTarget(**d['target']))
+
+    def put(self, key, func_asm: FuncAsm):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(func_asm.dict(), f)
+        os.replace(tmp_path, path)  # concurrent readers never see a partial file
+
+
+_worker_compilers = {}  # per worker process, so that the sh commands are looked up once per target
+
+
+def _compile_target(job):
+    # One compilation of all_required_c_code for target, from which every fname is extracted
+    all_required_c_code, fnames, target = job
+    if target not in _worker_compilers:
+        try:
+            _worker_compilers[target] = target.compiler()
+        except Exception as e:  # e.g. sh.CommandNotFound: an error for this target only, not the whole batch
+            return {fname: (None, f'{type(e).__name__}: {e}') for fname in fnames}
+    res = {}
+    for fname, func_res in _worker_compilers[target].get_funcs_asm(all_required_c_code, fnames).items():
+        if isinstance(func_res, Err):
+            # sh exceptions don't always pickle: send the message back
+            res[fname] = None, f'{type(func_res.val).__name__}: {func_res.val}'
+        else:
+            res[fname] = func_res.val.dict(), None
+    return res
+
+
+def generate_asm_batch(functions, targets=DEFAULT_TARGET_MATRIX, workers=None,
+                       cache_dir=None) -> List[Dict[str, Result[FuncAsm, BaseException]]]:
+    # functions: list of (all_required_c_code, fname). Returns, for each function, target name -> FuncAsm (or error).
+    # Each (code, target) pair is compiled once in a process pool, even if several functions share the same code;
+    # with cache_dir, results are reused across calls (not for targets whose compiler version can't be determined).
+    cache = AsmCache(cache_dir) if cache_dir is not None else None
+    versions = {target: _compiler_version(target) for target in targets} if cache is not None else {}
+    results = [{} for _ in functions]
+    jobs = {}  # (code, target) -> [(i, fname, key)]
+    for i, (all_required_c_code, fname) in enumerate(functions):
+        for target in targets:
+            key = None
+            if versions.get(target) is not None:
+                key = AsmCache.key(all_required_c_code, fname, target, versions[target])
+            cached = cache.get(key) if key is not None else None
+            if cached is not None:
+                results[i][target.name] = Ok(cached)
             else:
-                pre_asm.append(l)
-            # if inside_func and 'ret' in l.split():  # Todo: not always ret
-            if inside_func and l.startswith('}'):
-                inside_func = False
-                after_func = True
-        func.append('}')
-        if len(post_asm) == 0:
-            raise RuntimeError("Couldn't process assembly")
-        del post_asm[0]
-
-        pre_asm = '\n'.join(pre_asm) + '\n'
-        func_asm = '\n'.join(func) + '\n'
-        post_asm = '\n'.join(post_asm) + '\n'
-
-        return pre_asm, func_asm, post_asm
+                jobs.setdefault((all_required_c_code, target), []).append((i, fname, key))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+        job_args = [(code, sorted({fname for _, fname, _ in funcs}), target) for (code, target), funcs in jobs.items()]
+        for ((_, target), funcs), res in zip(jobs.items(), pool.map(_compile_target, job_args, chunksize=chunksize)):
+            for i, fname, key in funcs:
+                d, error = res[fname]
+                if error is not None:
+                    results[i][target.name] = Err(RuntimeError(error))
+                    continue
+                func_asm = FuncAsm(pre_asm=d['pre_asm'], func_asm=d['func_asm'], post_asm=d['post_asm'],
+                                   target=AsmTarget(**d['target']))
+                if key is not None:
+                    cache.put(key, func_asm)
+                results[i][target.name] = Ok(func_asm)
+    return results
 
 
 # TODO: literals/constats, global variables etc in LLVM, clang etc